@@ -9,6 +9,7 @@ import os
 import sys
 from waf import test_1_detection
 from waf import test_3_training_time
+from waf.test_2_waf_speed import benchmark
 from waf.test_2_waf_speed import data_server
 from waf.test_2_waf_speed import destination
 from waf.test_2_waf_speed import proxy_implementation
@@ -18,11 +19,18 @@ AVAILABLE_COMMANDS = '''{}
 
 Available commands are: 
     test1
+    test1 halving
+    test1 reduction
+    test1 sharded
+    test2 benchmark NAME (NAME: batching, engines, features, routing, scorer, upstream, workers)
     test2 dataserver
     test2 destination
     test2 proxy
     test2 source
+    test2 source load
+    test2 train
     test3
+    test3 detectors
 '''
 
 USAGE = AVAILABLE_COMMANDS.format('Usage: python run.py COMMAND')
@@ -32,20 +40,43 @@ FALSE_CMD = AVAILABLE_COMMANDS.format('"{}" is not an available command')
 def run():
     if len(sys.argv) > 1:
         if sys.argv[1] == 'test1':
-            test_1_detection.run()
+            if len(sys.argv) > 2 and sys.argv[2] == 'halving':
+                test_1_detection.run_halving()
+            elif len(sys.argv) > 2 and sys.argv[2] == 'reduction':
+                test_1_detection.run_reduction()
+            elif len(sys.argv) > 2 and sys.argv[2] == 'sharded':
+                test_1_detection.run_sharded()
+            elif len(sys.argv) > 2:
+                print(FALSE_CMD.format('test1 ' + sys.argv[2]))
+            else:
+                test_1_detection.run()
         elif sys.argv[1] == 'test2':
-            if sys.argv[2] == 'dataserver':
+            if sys.argv[2] == 'benchmark' and len(sys.argv) > 3:
+                if sys.argv[3] in benchmark.BENCHMARKS:
+                    benchmark.run(sys.argv[3])
+                else:
+                    print(FALSE_CMD.format('test2 benchmark ' + sys.argv[3]))
+            elif sys.argv[2] == 'dataserver':
                 data_server.run()
             elif sys.argv[2] == 'destination':
                 destination.run()
             elif sys.argv[2] == 'proxy':
                 proxy_implementation.run()
+            elif sys.argv[2] == 'source' and len(sys.argv) > 3 and sys.argv[3] == 'load':
+                source.run_load()
             elif sys.argv[2] == 'source':
                 source.run()
+            elif sys.argv[2] == 'train':
+                proxy_implementation.run_training()
             else:
                 print(FALSE_CMD.format('test2 ' + sys.argv[2]))
         elif sys.argv[1] == 'test3':
-            test_3_training_time.run()
+            if len(sys.argv) > 2 and sys.argv[2] == 'detectors':
+                test_3_training_time.run_detectors()
+            elif len(sys.argv) > 2:
+                print(FALSE_CMD.format('test3 ' + sys.argv[2]))
+            else:
+                test_3_training_time.run()
         elif sys.argv[1] == '-h' or sys.argv[1] == '--help':
             print(USAGE)
         else:
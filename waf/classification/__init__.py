@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Nico Epp and Ralf Funk
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from sklearn.kernel_approximation import Nystroem, RBFSampler
+from sklearn.pipeline import Pipeline
+from sklearn.svm import OneClassSVM
+from typing import Iterable, List
+from .cascade import CascadeDetector, EnvelopeFilter
+from .compiled import CompiledScorer
+from .ensemble import ShardedOneClassSVM
+from .header_filter import HeaderFilter
+from .reduction import ReducedOneClassSVM, compare, compress_pipeline
+from .sgd import SGDOneClassSVM
+
+
+DETECTOR_LIST = (
+    'svm',          # exact RBF OneClassSVM (libsvm)
+    'sharded',      # OneClassSVM per shard, trained in parallel, averaged decision functions
+    'sharded_sv',   # OneClassSVM per shard, final OneClassSVM trained on their support vectors
+    'nystroem',     # Nystroem RBF approximation + linear SGD One Class SVM
+    'rff',          # random Fourier features RBF approximation + linear SGD One Class SVM
+)
+APPROXIMATE_DETECTOR_LIST = ('nystroem', 'rff')     # these can be trained with 'fit_in_chunks'
+N_COMPONENTS = 300
+N_SHARDS = 4
+
+
+def make_steps(detector='svm', nu=0.5, gamma=0.1, random_state=None,
+               n_components=N_COMPONENTS, n_shards=N_SHARDS) -> List:
+    """
+    Returns the final steps of a detection pipeline, to be used after the feature
+    extraction, scaler and normalizer steps.
+    """
+    if detector == 'svm':
+        return [OneClassSVM(random_state=random_state, nu=nu, gamma=gamma), ]
+
+    if detector in ('sharded', 'sharded_sv'):
+        return [ShardedOneClassSVM(
+            n_shards=n_shards, combine='average' if detector == 'sharded' else 'retrain',
+            random_state=random_state, nu=nu, gamma=gamma), ]
+
+    if detector == 'nystroem':
+        kernel_approximation = Nystroem(
+            kernel='rbf', gamma=gamma, n_components=n_components, random_state=random_state)
+    elif detector == 'rff':
+        kernel_approximation = RBFSampler(
+            gamma=gamma, n_components=n_components, random_state=random_state)
+    else:
+        raise ValueError('detector "{}" is not one of {}'.format(detector, DETECTOR_LIST))
+
+    return [kernel_approximation, SGDOneClassSVM(nu=nu, random_state=random_state)]
+
+
+def fit_in_chunks(clf: Pipeline, chunk_iter: Iterable) -> Pipeline:
+    """
+    Fits an approximate detector pipeline without holding all samples in memory.
+    All steps except the last one are fitted on the first chunk only, which is enough
+    for the kernel approximations, and the last step is trained with 'partial_fit'.
+    """
+    is_first_chunk = True
+
+    for X in chunk_iter:
+        for _, step in clf.steps[:-1]:
+            if is_first_chunk:
+                X = step.fit_transform(X)
+            else:
+                X = step.transform(X)
+        clf.steps[-1][1].partial_fit(X)
+        is_first_chunk = False
+
+    return clf
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Nico Epp and Ralf Funk
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import numpy as np
+from typing import List
+from ..data_sets import Request
+from ..feature_extraction import entropy
+
+
+DICT_ATTR_NAME_LIST = ('headers', 'query_params', 'body_params')
+
+
+def _entropy(v: str) -> float:
+    return entropy.RqEntropyTransformer._evaluate(v)[0] if v else 0.0
+
+
+class EnvelopeFilter:
+    """
+    Very cheap first stage of a detection cascade.
+
+    For every header and parameter seen in the training requests, it learns the range of
+    the length and the entropy of its values, between the 'quantile' and 1 - 'quantile'
+    of the training values. A request is accepted as clearly normal only if all its keys
+    were seen and all their values are inside these ranges.
+    """
+
+    def __init__(self, quantile=0.01):
+        self.quantile = quantile
+        self._envelopes = {}        # dict attr name -> key -> (min len, max len, min ent, max ent)
+
+    def fit(self, X: List[Request], y=None):
+        q = [100 * self.quantile, 100 * (1 - self.quantile)]
+        self._envelopes = {}
+
+        for dict_attr_name in DICT_ATTR_NAME_LIST:
+            value_dict = {}
+            for req in X:
+                for k, v in getattr(req, dict_attr_name).items():
+                    value_dict.setdefault(k, []).append(v)
+
+            self._envelopes[dict_attr_name] = {}
+            for k, v_list in value_dict.items():
+                len_min, len_max = np.percentile([len(v) for v in v_list], q)
+                ent_min, ent_max = np.percentile([_entropy(v) for v in v_list], q)
+                self._envelopes[dict_attr_name][k] = (
+                    float(len_min), float(len_max), float(ent_min), float(ent_max))
+
+        return self
+
+    def accepts(self, req: Request) -> bool:
+        for dict_attr_name, envelope in self._envelopes.items():
+            for k, v in getattr(req, dict_attr_name).items():
+                e = envelope.get(k)
+                if e is None or not e[0] <= len(v) <= e[1]:
+                    return False
+                # entropy is more expensive, only computed when the length is in range
+                if not e[2] <= _entropy(v) <= e[3]:
+                    return False
+        return True
+
+
+class CascadeDetector:
+    """
+    Detection cascade: requests accepted by the envelope are predicted as normal without
+    running the detector, all others are predicted by the detector (full pipeline).
+    """
+
+    def __init__(self, envelope: EnvelopeFilter, detector):
+        self.envelope = envelope
+        self.detector = detector
+
+    def fit(self, X: List[Request], y=None):
+        self.envelope.fit(X)
+        self.detector.fit(X)
+        return self
+
+    def predict(self, X) -> np.ndarray:
+        if isinstance(X, Request):
+            X = [X, ]
+
+        y = np.ones(len(X), dtype=int)
+        idx_list = [i for i, req in enumerate(X) if not self.envelope.accepts(req)]
+        if idx_list:
+            y[idx_list] = self.detector.predict([X[i] for i in idx_list])
+        return y
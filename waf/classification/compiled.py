@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Nico Epp and Ralf Funk
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import collections
+import threading
+import numpy as np
+from sklearn.pipeline import FeatureUnion, Pipeline
+from sklearn.preprocessing import Normalizer, StandardScaler
+from sklearn.svm import OneClassSVM
+from typing import Dict, List
+from ..data_sets import Request
+from ..feature_extraction import base
+from .reduction import ReducedOneClassSVM
+
+
+class CompiledScorer:
+    """
+    Lean replacement of a fitted detection pipeline for scoring requests one at a time.
+
+    The pipeline must be a FeatureUnion of the transformers in 'feature_extraction', an
+    optional StandardScaler and/or Normalizer and a one class model with RBF kernel.
+    Instead of running every transformer with its own arrays, each request key is mapped
+    directly to the columns it fills in a preallocated feature buffer, and the RBF
+    decision function is evaluated with numpy over the support vectors.
+    It gives the same verdicts as the 'predict' method of the pipeline.
+    """
+
+    def __init__(self, clf: Pipeline):
+        step_list = [step for _, step in clf.steps]
+        if not step_list or not isinstance(step_list[0], FeatureUnion):
+            raise ValueError('first step must be a FeatureUnion')
+
+        # feature extraction: key -> list of (evaluate function, first column, n columns)
+        self._key_maps = collections.OrderedDict()      # type: Dict[str, Dict[str, List]]
+        self._req_list = []                             # type: List
+        self.n_features = self._compile_union(step_list[0])
+
+        # scaler and normalizer
+        self._mean = None
+        self._scale = None
+        self._normalize = None
+        for step in step_list[1:-1]:
+            self._compile_preprocessing(step)
+
+        # one class model
+        svm = step_list[-1]
+        if not isinstance(svm, (OneClassSVM, ReducedOneClassSVM)) or svm.kernel != 'rbf':
+            raise ValueError('last step must be a OneClassSVM with RBF kernel')
+        # views, not copies, so arrays memory mapped from the model registry stay shared
+        self.support_vectors = np.ascontiguousarray(svm.support_vectors_, dtype=np.float64)
+        self.dual_coef = np.ravel(np.asarray(svm.dual_coef_, dtype=np.float64))
+        self.intercept = float(np.ravel(svm.intercept_)[0])
+        self.gamma = float(getattr(svm, '_gamma', svm.gamma))
+        self._sv_sq_norms = np.einsum('ij,ij->i', self.support_vectors, self.support_vectors)
+
+        self._local = threading.local()     # one feature buffer per thread
+
+    def _compile_union(self, fu: FeatureUnion) -> int:
+        if fu.transformer_weights:
+            raise ValueError('transformer weights are not supported')
+
+        col = 0
+        for _, tf in fu.transformer_list:
+            n_per_key = len(tf._get_features_per_key())
+
+            if isinstance(tf, base.KeyTransformer):
+                key_map = self._key_maps.setdefault(tf._get_dict_attr_name(), {})
+                for key in tf._key_list:
+                    key_map.setdefault(key, []).append((tf._evaluate, col, n_per_key))
+                    col += n_per_key
+            elif isinstance(tf, base.ReqTransformer):
+                self._req_list.append((tf._evaluate, col, n_per_key))
+                col += n_per_key
+            else:
+                raise ValueError('transformer {} is not supported'.format(tf.__class__.__name__))
+
+        return col
+
+    def _compile_preprocessing(self, step):
+        if isinstance(step, StandardScaler):
+            if self._normalize is not None:
+                raise ValueError('scaler after normalizer is not supported')
+
+            self._mean = step.mean_ if step.with_mean else np.zeros(self.n_features)
+            self._scale = step.scale_ if step.with_std else np.ones(self.n_features)
+        elif isinstance(step, Normalizer):
+            if step.norm not in ('l1', 'l2', 'max'):
+                raise ValueError('norm "{}" is not supported'.format(step.norm))
+            self._normalize = step.norm
+        else:
+            raise ValueError('step {} is not supported'.format(step.__class__.__name__))
+
+    def _get_buffer(self) -> np.ndarray:
+        x = getattr(self._local, 'buffer', None)
+        if x is None:
+            x = np.zeros(self.n_features)
+            self._local.buffer = x
+        else:
+            x.fill(0.)
+        return x
+
+    def fill_features(self, req: Request, x: np.ndarray) -> np.ndarray:
+        return self.fill_features_from_dicts(
+            dict((name, getattr(req, name, {})) for name in self._key_maps), x, req.original_str)
+
+    def fill_features_from_dicts(self, dicts: Dict[str, Dict[str, str]], x: np.ndarray,
+                                 original_str='') -> np.ndarray:
+        """
+        Same as 'fill_features', but from the dicts of a request that was not built as a
+        Request object, e.g. {'headers': ..., 'query_params': ..., 'body_params': ...}.
+        Missing dicts are taken as empty.
+        """
+        for dict_attr_name, key_map in self._key_maps.items():
+            for key, value in dicts.get(dict_attr_name, {}).items():
+                entry_list = key_map.get(key)
+                if entry_list:
+                    for evaluate, col, n in entry_list:
+                        x[col:col + n] = evaluate(value)
+
+        for evaluate, col, n in self._req_list:
+            x[col:col + n] = evaluate(original_str)
+
+        return x
+
+    def _preprocess(self, X: np.ndarray) -> np.ndarray:
+        if self._scale is not None:
+            X = (X - self._mean) / self._scale
+
+        if self._normalize == 'l2':
+            norms = np.sqrt(np.einsum('ij,ij->i', X, X))
+        elif self._normalize == 'l1':
+            norms = np.abs(X).sum(axis=1)
+        elif self._normalize == 'max':
+            norms = np.abs(X).max(axis=1)
+        else:
+            return X
+
+        norms[norms == 0] = 1.
+        return X / norms[:, np.newaxis]
+
+    def decision_function_features(self, X: np.ndarray) -> np.ndarray:
+        X = self._preprocess(np.atleast_2d(X))
+
+        if X.shape[0] == 1:
+            # squared distances computed from the differences, like libsvm does
+            diff = X - self.support_vectors
+            sq_dist = np.einsum('ij,ij->i', diff, diff)[np.newaxis, :]
+        else:
+            # for batches a matrix product is much faster
+            sq_dist = X.dot(self.support_vectors.T)
+            sq_dist *= -2
+            sq_dist += np.einsum('ij,ij->i', X, X)[:, np.newaxis]
+            sq_dist += self._sv_sq_norms[np.newaxis, :]
+            np.maximum(sq_dist, 0, out=sq_dist)
+
+        return np.exp(sq_dist * -self.gamma).dot(self.dual_coef) + self.intercept
+
+    def decision_function(self, X) -> np.ndarray:
+        if isinstance(X, Request):
+            x = self.fill_features(X, self._get_buffer())
+            return self.decision_function_features(x)
+
+        X_features = np.zeros((len(X), self.n_features))
+        for i, req in enumerate(X):
+            self.fill_features(req, X_features[i])
+        return self.decision_function_features(X_features)
+
+    def predict_features(self, X: np.ndarray) -> np.ndarray:
+        """
+        Same as 'predict', but for rows already filled with 'fill_features'.
+        """
+        return np.where(self.decision_function_features(X) > 0, 1, -1)
+
+    def predict_dicts(self, dicts: Dict[str, Dict[str, str]], original_str='') -> int:
+        """
+        Prediction of one request given as dicts, see 'fill_features_from_dicts'.
+        """
+        x = self.fill_features_from_dicts(dicts, self._get_buffer(), original_str)
+        return int(self.predict_features(x)[0])
+
+    def predict(self, X) -> np.ndarray:
+        """
+        Same as the 'predict' method of the pipeline: X can be a Request or a list of them.
+        """
+        # same rule as libsvm for one class models
+        return np.where(self.decision_function(X) > 0, 1, -1)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Nico Epp and Ralf Funk
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import numpy as np
+from sklearn.base import BaseEstimator
+from sklearn.externals.joblib import Parallel, delayed
+from sklearn.svm import OneClassSVM
+from sklearn.utils import check_array, check_random_state
+
+
+COMBINE_LIST = (
+    'average',      # average the decision functions of all shard models
+    'retrain',      # fit a final model on the union of the support vectors of all shard models
+)
+
+
+def _fit_shard(X: np.ndarray, nu, gamma, random_state) -> OneClassSVM:
+    clf = OneClassSVM(random_state=random_state, nu=nu, gamma=gamma)
+    clf.fit(X)
+    return clf
+
+
+class ShardedOneClassSVM(BaseEstimator):
+    """
+    Divide and conquer One Class SVM: the samples are split into 'n_shards' random shards
+    and one OneClassSVM is fitted per shard in parallel worker processes. As the kernel
+    part of the training grows about quadratically with the number of samples, this is
+    roughly n_shards**2 times less work, spread over all cores.
+    """
+
+    def __init__(self, n_shards=4, combine='average', nu=0.5, gamma=0.1, n_jobs=-1,
+                 random_state=None):
+        self.n_shards = n_shards
+        self.combine = combine
+        self.nu = nu
+        self.gamma = gamma
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+
+    def fit(self, X, y=None):
+        if self.combine not in COMBINE_LIST:
+            raise ValueError('combine "{}" is not one of {}'.format(self.combine, COMBINE_LIST))
+
+        X = check_array(X, dtype=np.float64)
+        random_state = check_random_state(self.random_state)
+
+        # shards can not be smaller than one sample
+        n_shards = max(1, min(self.n_shards, X.shape[0]))
+        shard_list = np.array_split(random_state.permutation(X.shape[0]), n_shards)
+
+        self.estimators_ = Parallel(n_jobs=self.n_jobs)(
+            delayed(_fit_shard)(X[idx], self.nu, self.gamma, self.random_state)
+            for idx in shard_list)
+
+        if self.combine == 'retrain':
+            self.final_estimator_ = _fit_shard(
+                np.vstack([clf.support_vectors_ for clf in self.estimators_]),
+                self.nu, self.gamma, self.random_state)
+        else:
+            self.final_estimator_ = None
+
+        return self
+
+    def decision_function(self, X) -> np.ndarray:
+        if self.final_estimator_ is not None:
+            return np.ravel(self.final_estimator_.decision_function(X))
+
+        return np.mean(
+            [np.ravel(clf.decision_function(X)) for clf in self.estimators_],
+            axis=0)
+
+    def predict(self, X) -> np.ndarray:
+        # same rule as libsvm for one class models
+        return np.where(self.decision_function(X) > 0, 1, -1)
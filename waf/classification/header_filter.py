@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Nico Epp and Ralf Funk
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import re
+from urllib import parse
+from typing import Dict, Iterable, List
+from ..data_sets import Request
+
+
+REASON_LIST = (
+    'length',               # body longer than the limit of the endpoint
+    'unknown_headers',      # too many header names not seen in the training requests
+    'malformed_header',     # header name that is not a token, or control characters in a value
+)
+# always allowed, a client or proxy may add them to any request
+COMMON_HEADER_LIST = ('content-length', 'content-type', 'host')
+
+_TOKEN_RE = re.compile(r"^[a-z0-9!#$%&'*+.^_`|~-]+$")
+_CONTROL_RE = re.compile(r'[\x00-\x08\x0a-\x1f\x7f]')
+
+
+def _body_length(req: Request) -> int:
+    try:
+        return int(req.headers['content-length'])
+    except (KeyError, ValueError):
+        return len(parse.urlencode(req.body_params))
+
+
+class HeaderFilter:
+    """
+    Checks of a request that only need its headers, so it can be rejected before its
+    body is read.
+
+    It learns the max body length and the header names of the training requests of an
+    endpoint. A request is rejected if its content-length is above 'length_factor' times
+    the max body length (but never below 'min_length_limit'), if it has more than
+    'max_unknown_headers' header names not seen in training, or if a header is malformed.
+    """
+
+    def __init__(self, length_factor=2.0, min_length_limit=1024, max_unknown_headers=2):
+        self.length_factor = length_factor
+        self.min_length_limit = min_length_limit
+        self.max_unknown_headers = max_unknown_headers
+        self.max_length = 0
+        self.header_names = frozenset()
+
+    @property
+    def length_limit(self) -> int:
+        return max(self.min_length_limit, int(self.length_factor * self.max_length))
+
+    def fit(self, X: List[Request], y=None):
+        self.max_length = max((_body_length(req) for req in X), default=0)
+        self.header_names = frozenset(k for req in X for k in req.headers)
+        return self
+
+    def check(self, headers: Dict[str, str], length: int,
+              headers_to_exclude: Iterable[str] = ()) -> str:
+        """
+        :param headers: dict of lowercase header names
+        :param length: content-length of the request, 0 if it has no body
+        :param headers_to_exclude: header names not checked
+        :return: '' if the request passes, otherwise the failed check, see REASON_LIST
+        """
+        if length > self.length_limit:
+            return 'length'
+
+        n_unknown = 0
+        for k, v in headers.items():
+            if k in headers_to_exclude:
+                continue
+            if not _TOKEN_RE.match(k) or _CONTROL_RE.search(str(v)):
+                return 'malformed_header'
+            if k not in self.header_names and k not in COMMON_HEADER_LIST:
+                n_unknown += 1
+        if n_unknown > self.max_unknown_headers:
+            return 'unknown_headers'
+
+        return ''
+
+    def to_dict(self) -> Dict:
+        """
+        Learned values, JSON serializable, e.g. for the metadata of the model registry.
+        """
+        return {
+            'max_length': self.max_length,
+            'header_names': sorted(self.header_names),
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict, **kwargs) -> 'HeaderFilter':
+        hf = cls(**kwargs)
+        hf.max_length = d['max_length']
+        hf.header_names = frozenset(d['header_names'])
+        return hf
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Nico Epp and Ralf Funk
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+import numpy as np
+from sklearn.base import BaseEstimator
+from sklearn.cluster import KMeans
+from sklearn.metrics.pairwise import rbf_kernel
+from sklearn.pipeline import Pipeline
+from sklearn.svm import OneClassSVM
+from typing import Tuple
+
+
+# upper bound of the dual coefficients of a libsvm one class model
+ALPHA_UPPER_BOUND = 1.0
+
+
+class ReducedOneClassSVM(BaseEstimator):
+    """
+    RBF OneClassSVM whose support vectors are reduced to at most 'budget' vectors after
+    training, as the cost of the decision function grows linearly with their number.
+
+    The support vectors are merged with k-means, then the weights of the cluster centers
+    are the projection of the original decision function onto them (least squares in the
+    kernel space) and the offset is recalibrated so that the free support vectors stay
+    on the decision boundary.
+    """
+
+    kernel = 'rbf'
+
+    def __init__(self, budget=50, nu=0.5, gamma=0.1, random_state=None):
+        self.budget = budget
+        self.nu = nu
+        self.gamma = gamma
+        self.random_state = random_state
+
+    def fit(self, X, y=None):
+        svm = OneClassSVM(random_state=self.random_state, nu=self.nu, gamma=self.gamma)
+        svm.fit(X)
+        return self.reduce(svm)
+
+    def reduce(self, svm: OneClassSVM):
+        """
+        Sets the reduced support vectors of an already fitted OneClassSVM.
+        """
+        if svm.kernel != 'rbf':
+            raise ValueError('only RBF kernel is supported')
+
+        sv = svm.support_vectors_
+        alpha = np.ravel(svm.dual_coef_)
+        self._gamma = float(getattr(svm, '_gamma', svm.gamma))
+        self.n_original_support_ = sv.shape[0]
+
+        if sv.shape[0] <= self.budget:
+            self.support_vectors_ = sv.copy()
+            self.dual_coef_ = svm.dual_coef_.copy()
+            self.intercept_ = svm.intercept_.copy()
+            self._sv_sq_norms = np.einsum('ij,ij->i', sv, sv)
+            return self
+
+        km = KMeans(n_clusters=self.budget, random_state=self.random_state)
+        km.fit(sv)
+        z = km.cluster_centers_
+
+        # beta = argmin || sum(alpha * phi(sv)) - sum(beta * phi(z)) ||
+        K_zz = rbf_kernel(z, z, gamma=self._gamma)
+        K_zs = rbf_kernel(z, sv, gamma=self._gamma)
+        beta = np.linalg.lstsq(
+            K_zz + 1e-10 * np.eye(z.shape[0]), K_zs.dot(alpha), rcond=-1)[0]
+
+        # free support vectors (0 < alpha < 1) lie exactly on the boundary of the original model;
+        # libsvm scales the one class alphas so that they sum to nu * l, with upper bound 1
+        is_free = alpha < ALPHA_UPPER_BOUND - 1e-8
+        if not np.any(is_free):
+            is_free = np.ones(alpha.shape[0], dtype=bool)
+        intercept = -np.mean(K_zs[:, is_free].T.dot(beta))
+
+        self.support_vectors_ = np.ascontiguousarray(z)
+        self.dual_coef_ = beta[np.newaxis, :]
+        self.intercept_ = np.array([intercept])
+        self._sv_sq_norms = np.einsum('ij,ij->i', z, z)
+        return self
+
+    def decision_function(self, X) -> np.ndarray:
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+
+        # ||x - sv||^2 = ||x||^2 - 2 x.sv + ||sv||^2
+        D = np.dot(X, self.support_vectors_.T)
+        D *= -2
+        D += np.einsum('ij,ij->i', X, X)[:, np.newaxis]
+        D += self._sv_sq_norms
+        np.maximum(D, 0, out=D)
+        D *= -self._gamma
+        np.exp(D, out=D)
+        return np.dot(D, np.ravel(self.dual_coef_)) + self.intercept_[0]
+
+    def predict(self, X) -> np.ndarray:
+        # same rule as libsvm for one class models
+        return np.where(self.decision_function(X) > 0, 1, -1)
+
+
+def compress_pipeline(clf: Pipeline, budget: int, random_state=None) -> Pipeline:
+    """
+    Returns a copy of a fitted pipeline ending with an RBF OneClassSVM, where the last
+    step is replaced by its ReducedOneClassSVM. The other steps are shared.
+    """
+    name, svm = clf.steps[-1]
+    if not isinstance(svm, OneClassSVM):
+        raise ValueError('last step must be a OneClassSVM')
+
+    reduced = ReducedOneClassSVM(
+        budget=budget, nu=svm.nu, gamma=svm.gamma, random_state=random_state)
+    reduced.reduce(svm)
+    return Pipeline(list(clf.steps[:-1]) + [(name, reduced)])
+
+
+def compare(original: OneClassSVM, reduced: ReducedOneClassSVM,
+            X: np.ndarray) -> Tuple[float, float, float]:
+    """
+    Compares a OneClassSVM with its reduced version on samples X, which must already be
+    transformed like the input of the models.
+    Returns the agreement rate of the predictions and the mean latency in ms of the decision
+    function for one sample at a time, evaluated the same way for both models.
+    """
+    agreement = np.mean(original.predict(X) == reduced.predict(X))
+
+    # unreduced copy, so the latencies only differ by the number of support vectors
+    full = ReducedOneClassSVM(budget=original.support_vectors_.shape[0]).reduce(original)
+
+    latency_list = []
+    for clf in (full, reduced):
+        t_start = time.perf_counter()
+        for x in X:
+            clf.decision_function(x.reshape(1, -1))
+        t_end = time.perf_counter()
+        latency_list.append((t_end - t_start) * 1000 / X.shape[0])
+
+    return agreement, latency_list[0], latency_list[1]
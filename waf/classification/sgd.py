@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Nico Epp and Ralf Funk
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import numpy as np
+from sklearn.base import BaseEstimator
+from sklearn.utils import check_array, check_random_state
+
+
+class SGDOneClassSVM(BaseEstimator):
+    """
+    Linear One Class SVM trained with averaged mini-batch stochastic gradient descent.
+    It minimizes nu/2 * ||w||^2 - nu * rho + mean(max(0, rho - w * x)), so nu keeps its
+    meaning of an upper bound on the fraction of training samples treated as outliers.
+    Combined with a kernel approximation it behaves like an RBF OneClassSVM, but the
+    training time grows only linearly with the number of samples.
+    """
+
+    def __init__(self, nu=0.5, n_iter=5, batch_size=256, eta0=0.1, shuffle=True,
+                 random_state=None):
+        self.nu = nu
+        self.n_iter = n_iter
+        self.batch_size = batch_size
+        self.eta0 = eta0
+        self.shuffle = shuffle
+        self.random_state = random_state
+
+    def fit(self, X, y=None):
+        X = check_array(X, dtype=np.float64)
+        self._init_state(X.shape[1])
+
+        for _ in range(self.n_iter):
+            self._sgd_pass(X)
+
+        return self
+
+    def partial_fit(self, X, y=None):
+        """
+        Makes one pass over X, continuing from the current state. This allows training
+        with more samples than fit in memory at once.
+        """
+        X = check_array(X, dtype=np.float64)
+        if not hasattr(self, '_w'):
+            self._init_state(X.shape[1])
+
+        self._sgd_pass(X)
+        return self
+
+    def decision_function(self, X) -> np.ndarray:
+        X = check_array(X, dtype=np.float64)
+        return X.dot(self.coef_) - self.offset_[0]
+
+    def predict(self, X) -> np.ndarray:
+        # same rule as libsvm for one class models, so a score of 0 is an outlier
+        return np.where(self.decision_function(X) > 0, 1, -1)
+
+    def _init_state(self, n_features: int):
+        self._random_state = check_random_state(self.random_state)
+        self._w = np.zeros(n_features)
+        self._rho = 0.
+        self._w_sum = np.zeros(n_features)
+        self._rho_sum = 0.
+        self._t = 0
+
+    def _sgd_pass(self, X: np.ndarray):
+        n_samples = X.shape[0]
+        if self.shuffle:
+            idx = self._random_state.permutation(n_samples)
+        else:
+            idx = np.arange(n_samples)
+
+        w = self._w
+        for start in range(0, n_samples, self.batch_size):
+            X_batch = X[idx[start:start + self.batch_size]]
+            self._t += 1
+            eta = self.eta0 / (1. + self.eta0 * self.nu * self._t)
+
+            # samples inside the margin are the only ones with a hinge loss gradient
+            active = X_batch.dot(w) < self._rho
+            grad_w = self.nu * w - X_batch[active].sum(axis=0) / X_batch.shape[0]
+            grad_rho = np.mean(active) - self.nu
+
+            w -= eta * grad_w
+            self._rho -= eta * grad_rho
+
+            # averaged iterates give a much more stable solution than the last one
+            self._w_sum += w
+            self._rho_sum += self._rho
+
+        self.coef_ = self._w_sum / max(self._t, 1)
+        self.offset_ = np.array([self._rho_sum / max(self._t, 1)])
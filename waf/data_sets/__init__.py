@@ -7,7 +7,7 @@
 
 from typing import Tuple
 from . import csic, torpeda
-from .base import Request, read_and_group_requests
+from .base import Request, parse_params, read_and_group_requests
 
 
 DS_URL_LIST = csic.DS_URL_LIST + torpeda.DS_URL_LIST
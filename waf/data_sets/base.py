@@ -46,10 +46,7 @@ class Request:
 
     @query_params.setter
     def query_params(self, s: str):
-        d = _split(s, '&', '=', self._params_to_exclude)
-        self._query_params = {
-            k: parse.unquote_plus(v, encoding=self._encoding)
-            for k, v in d.items()}
+        self._query_params = parse_params(s, self._encoding, self._params_to_exclude)
 
     @property
     def body_params(self) -> Dict[str, str]:
@@ -57,10 +54,7 @@ class Request:
 
     @body_params.setter
     def body_params(self, s: str):
-        d = _split(s, '&', '=', self._params_to_exclude)
-        self._body_params = {
-            k: parse.unquote_plus(v, encoding=self._encoding)
-            for k, v in d.items()}
+        self._body_params = parse_params(s, self._encoding, self._params_to_exclude)
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
@@ -79,6 +73,16 @@ class Request:
         return NotImplemented
 
 
+def parse_params(s: str, encoding='utf-8', params_to_exclude=None) -> Dict[str, str]:
+    """
+    Query string or form body to a dict of decoded values, as in Request.query_params.
+    """
+    d = _split(s, '&', '=', params_to_exclude)
+    return {
+        k: parse.unquote_plus(v, encoding=encoding)
+        for k, v in d.items()}
+
+
 def _split(input_s: str, sep_1: str, sep_2: str, blacklist: List[str]) -> Dict:
     d = {}
 
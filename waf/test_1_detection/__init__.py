@@ -9,174 +9,329 @@ import os
 import numpy as np
 import pandas as pd
 from sklearn.externals import joblib
+from sklearn.metrics.pairwise import euclidean_distances
 from sklearn.pipeline import make_pipeline
 from sklearn.preprocessing import StandardScaler, Normalizer
 from sklearn.svm import OneClassSVM
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 from ..base import BASE_PATH
-from .. import data_sets, feature_extraction as fe
+from .. import classification, data_sets, feature_extraction as fe
+from . import metrics
+
+
+SHARDED_F_SCORE_TOLERANCE = 0.05
+HALVING_N_CANDIDATES = 64
+HALVING_MIN_TRAIN_SIZE = 50
+HALVING_ETA = 3
+HALVING_NU_RANGE = (0.0001, 0.5)
+HALVING_GAMMA_RANGE = (0.00001, 1)
+SV_BUDGET_LIST = (100, 50, 25, 10)
 
 
 _file_memory = joblib.Memory(cachedir=os.path.join(BASE_PATH, 'cache'))
 
 
 def get_result_line(df: pd.DataFrame) -> Tuple:
-    df_train = df[df[fe.META_GROUP] == 'train']
+    y_true, group = metrics.encode_df(df)
+    y_pred = metrics.encode_labels(df[fe.META_PRED_LABEL].values)
+    return tuple(metrics.count(y_true, y_pred, group)[0])
 
-    y = df_train[df_train[fe.META_TRUE_LABEL] == 'normal']
-    train_normal_count = y.shape[0]
-    train_normal_right = y[y[fe.META_TRUE_LABEL] == y[fe.META_PRED_LABEL]].shape[0]
 
-    y = df_train[df_train[fe.META_TRUE_LABEL] == 'anomalous']
-    train_anomalous_count = y.shape[0]
-    train_anomalous_right = y[y[fe.META_TRUE_LABEL] == y[fe.META_PRED_LABEL]].shape[0]
+def result_list_to_df(result_list: List) -> pd.DataFrame:
+    return metrics.counts_to_df(np.array(result_list))
 
-    df_test = df[df[fe.META_GROUP] == 'test']
 
-    y = df_test[df_test[fe.META_TRUE_LABEL] == 'normal']
-    test_normal_count = y.shape[0]
-    test_normal_right = y[y[fe.META_TRUE_LABEL] == y[fe.META_PRED_LABEL]].shape[0]
+def _get_samples(ds_url, random_state, train_size_normal, train_size_anomalous,
+                 filter_constraints) -> pd.DataFrame:
+    df = fe.get(ds_url, random_state, train_size_normal, train_size_anomalous)
+    if filter_constraints:
+        df = fe.filter_by(df, filter_constraints)
+    return df
 
-    y = df_test[df_test[fe.META_TRUE_LABEL] == 'anomalous']
-    test_anomalous_count = y.shape[0]
-    test_anomalous_right = y[y[fe.META_TRUE_LABEL] == y[fe.META_PRED_LABEL]].shape[0]
 
-    return (
-        train_normal_count, train_normal_right,
-        train_anomalous_count, train_anomalous_right,
-        test_normal_count, test_normal_right,
-        test_anomalous_count, test_anomalous_right,
-    )
+def _make_steps(use_scaler, use_normalizer) -> List:
+    step_list = []
+    if use_scaler:
+        step_list.append(StandardScaler())
+    if use_normalizer:
+        step_list.append(Normalizer())
+    return step_list
 
 
-def result_list_to_df(result_list: List) -> pd.DataFrame:
-    # prepare column headers for final output
-    prefix_base_list = (
-        'train_normal', 'train_anomalous', 'test_normal', 'test_anomalous',
-        'normal', 'anomalous', 'train', 'test', 'all',
-    )
-    column_headers_1 = [
-        '{}_{}'.format(base, suffix)
-        for base in prefix_base_list
-        for suffix in ('count', 'right', 'p')]
-    column_headers_2 = [
-        'TOTAL_POPULATION',
-        'P', 'TP', 'FN', 'TPR', 'FNR',
-        'N', 'TN', 'FP', 'TNR', 'FPR',
-        'f_score',
-    ]
-    column_headers = np.array(column_headers_1 + column_headers_2)
-
-    # build data frame
-    df = pd.DataFrame(
-        data=result_list,
-        columns=column_headers[[0, 1, 3, 4, 6, 7, 9, 10]])
-
-    # calculate sums
-    df['normal_count'] = df['train_normal_count'] + df['test_normal_count']
-    df['normal_right'] = df['train_normal_right'] + df['test_normal_right']
-    df['anomalous_count'] = df['train_anomalous_count'] + df['test_anomalous_count']
-    df['anomalous_right'] = df['train_anomalous_right'] + df['test_anomalous_right']
-    df['train_count'] = df['train_normal_count'] + df['train_anomalous_count']
-    df['train_right'] = df['train_normal_right'] + df['train_anomalous_right']
-    df['test_count'] = df['test_normal_count'] + df['test_anomalous_count']
-    df['test_right'] = df['test_normal_right'] + df['test_anomalous_right']
-    df['all_count'] = df['normal_count'] + df['anomalous_count']
-    df['all_right'] = df['normal_right'] + df['anomalous_right']
-    for _, r in df.iterrows():
-        assert r['normal_count'] + r['anomalous_count'] == r['train_count'] + r['test_count']
-        assert r['normal_right'] + r['anomalous_right'] == r['train_right'] + r['test_right']
-
-    # calculate proportions
-    for s in prefix_base_list:
-        df[s + '_p'] = (df[s + '_right'] / df[s + '_count']).map(
-            lambda x: 0 if np.isnan(x) else round(x, 2))
-
-    # calculate statistics
-    df['TOTAL_POPULATION'] = df['test_count']
-
-    df['P'] = df['test_normal_count']
-    df['TP'] = df['test_normal_right']
-    df['FN'] = df['P'] - df['TP']
-    df['TPR'] = (df['TP'] / df['P']).map(lambda x: 0 if np.isnan(x) else round(x, 2))
-    df['FNR'] = 1 - df['TPR']
-
-    df['N'] = df['test_anomalous_count']
-    df['TN'] = df['test_anomalous_right']
-    df['FP'] = df['N'] - df['TN']
-    df['TNR'] = (df['TN'] / df['N']).map(lambda x: 0 if np.isnan(x) else round(x, 2))
-    df['FPR'] = 1 - df['TNR']
-
-    df['f_score'] = ((2 * df['TP']) / (2 * df['TP'] + df['FP'] + df['FN'])).map(
-        lambda x: 0 if np.isnan(x) else round(x, 2))
-
-    return df.loc[:, column_headers]
+def _add_pred_labels(df: pd.DataFrame, y_train_pred, y_test_pred) -> pd.DataFrame:
+    df.loc[df[fe.META_GROUP] == 'train', fe.META_PRED_LABEL] = y_train_pred
+    df.loc[df[fe.META_GROUP] == 'test', fe.META_PRED_LABEL] = y_test_pred
+    df[fe.META_PRED_LABEL] = df[fe.META_PRED_LABEL].map(
+        lambda x: 'normal' if x == 1 else 'anomalous')
+    return df
+
+
+def _merge_predictions(group: np.ndarray, y_train_pred, y_test_pred) -> np.ndarray:
+    # same order as the samples in the data frame, coded for the metrics
+    y_pred = np.empty(group.shape[0], dtype=np.intp)
+    y_pred[group == metrics.TRAIN] = metrics.encode_predictions(y_train_pred)
+    y_pred[group == metrics.TEST] = metrics.encode_predictions(y_test_pred)
+    return y_pred
 
 
 def classify(ds_url, random_state, train_size_normal, train_size_anomalous, filter_constraints,
-             use_scaler, use_normalizer, clf_kwargs):
+             use_scaler, use_normalizer, clf_kwargs, detector='svm'):
     # get samples
-    df = fe.get(ds_url, random_state, train_size_normal, train_size_anomalous)
-    if filter_constraints:
-        df = fe.filter_by(df, filter_constraints)
+    df = _get_samples(
+        ds_url, random_state, train_size_normal, train_size_anomalous, filter_constraints)
     X_train, y_train_true, X_test, _ = fe.feature_numbers(df)
 
     # make and fit classifier
-    step_list = []
-    if use_scaler:
-        step_list.append(StandardScaler())
-    if use_normalizer:
-        step_list.append(Normalizer())
+    step_list = _make_steps(use_scaler, use_normalizer)
     clf_kwargs.setdefault('random_state', 0)        # for reproducibility of the results
-    step_list.append(OneClassSVM(**clf_kwargs))
+    step_list.extend(classification.make_steps(detector, **clf_kwargs))
     clf = make_pipeline(*step_list)
     clf.fit(X_train, y_train_true)
 
     # add column with predicted labels
-    df.loc[df[fe.META_GROUP] == 'train', fe.META_PRED_LABEL] = clf.predict(X_train)
-    df.loc[df[fe.META_GROUP] == 'test', fe.META_PRED_LABEL] = clf.predict(X_test)
-    df[fe.META_PRED_LABEL] = df[fe.META_PRED_LABEL].map(
-        lambda x: 'normal' if x == 1 else 'anomalous')
+    df = _add_pred_labels(df, clf.predict(X_train), clf.predict(X_test))
 
     return df, X_train.shape[1]
 
 
+def classify_precomputed(ds_url, random_state, train_size_normal, train_size_anomalous,
+                         filter_constraints, use_scaler, use_normalizer, gamma_list,
+                         nu_list) -> Tuple:
+    """
+    Same as 'classify' with an RBF kernel, but for a whole grid of gamma and nu values.
+    The kernel matrix is computed only once per gamma value and all nu values are fitted
+    on it using kernel='precomputed'.
+    Returns the samples, the number of features and a dict of (nu, gamma) -> predictions.
+    """
+    # get samples
+    df = _get_samples(
+        ds_url, random_state, train_size_normal, train_size_anomalous, filter_constraints)
+    X_train, y_train_true, X_test, _ = fe.feature_numbers(df)
+    n_features = X_train.shape[1]
+
+    # scaler and normalizer do not depend on nu or gamma, so they are fitted only once
+    step_list = _make_steps(use_scaler, use_normalizer)
+    if step_list:
+        pre = make_pipeline(*step_list)
+        X_train = pre.fit_transform(X_train, y_train_true)
+        X_test = pre.transform(X_test)
+
+    D_train = euclidean_distances(X_train, squared=True)
+    D_test = euclidean_distances(X_test, X_train, squared=True)
+
+    pred_dict = {}
+    for gamma in gamma_list:
+        # same calculation as sklearn.metrics.pairwise.rbf_kernel
+        K_train = np.exp(D_train * -gamma)
+        K_test = np.exp(D_test * -gamma)
+
+        for nu in nu_list:
+            clf = OneClassSVM(kernel='precomputed', nu=nu, random_state=0)
+            clf.fit(K_train, y_train_true)
+            pred_dict[(nu, gamma)] = (clf.predict(K_train), clf.predict(K_test))
+
+    return df, n_features, pred_dict
+
+
 @_file_memory.cache
 def do_one_class(random_state, train_size_normal, train_size_anomalous, filter_constraints,
-                 use_scaler, use_normalizer):
+                 use_scaler, use_normalizer, use_precomputed_kernel=True, detector='svm'):
+    # the precomputed kernel can only be used with the exact RBF OneClassSVM
+    use_precomputed_kernel = use_precomputed_kernel and detector == 'svm'
+    nu_list = (0.1, 0.01, 0.001, 0.0001)
+    gamma_list = (0.1, 0.01, 0.001, 0.0001)
+    sample_kwargs = {
+        'random_state': random_state,
+        'train_size_normal': train_size_normal,
+        'train_size_anomalous': train_size_anomalous,
+        'filter_constraints': filter_constraints,
+        'use_scaler': use_scaler,
+        'use_normalizer': use_normalizer,
+    }
+
     df_list = []
     for ds_url in data_sets.DS_URL_LIST:
-        for nu in (0.1, 0.01, 0.001, 0.0001):
-            for gamma in (0.1, 0.01, 0.001, 0.0001):
-                df, n_features = classify(
-                    ds_url=ds_url,
-                    random_state=random_state,
-                    train_size_normal=train_size_normal,
-                    train_size_anomalous=train_size_anomalous,
-                    filter_constraints=filter_constraints,
-                    use_scaler=use_scaler,
-                    use_normalizer=use_normalizer,
-                    clf_kwargs={'nu': nu, 'gamma': gamma})
-
-                result_line = get_result_line(df)
-                res_df = result_list_to_df([result_line, ])
-                res_df.insert(0, 'ds_url', ds_url)
-                res_df.insert(1, 'n_features', n_features)
-                res_df.insert(2, 'nu', nu)
-                res_df.insert(3, 'gamma', gamma)
-                df_list.append(res_df)
+        if use_precomputed_kernel:
+            df, n_features, pred_dict = classify_precomputed(
+                ds_url=ds_url,
+                gamma_list=gamma_list,
+                nu_list=nu_list,
+                **sample_kwargs)
+            y_true, group = metrics.encode_df(df)
+
+        param_list = []
+        y_pred_list = []
+        for nu in nu_list:
+            for gamma in gamma_list:
+                if use_precomputed_kernel:
+                    y_pred = _merge_predictions(group, *pred_dict[(nu, gamma)])
+                else:
+                    df, n_features = classify(
+                        ds_url=ds_url,
+                        clf_kwargs={'nu': nu, 'gamma': gamma},
+                        detector=detector,
+                        **sample_kwargs)
+                    y_true, group = metrics.encode_df(df)
+                    y_pred = metrics.encode_labels(df[fe.META_PRED_LABEL].values)
+
+                param_list.append((nu, gamma))
+                y_pred_list.append(y_pred)
+
+        # metrics of all fits of this group at once
+        res_df = metrics.counts_to_df(metrics.count(y_true, np.vstack(y_pred_list), group))
+        res_df.insert(0, 'ds_url', ds_url)
+        res_df.insert(1, 'n_features', n_features)
+        res_df.insert(2, 'nu', [nu for nu, _ in param_list])
+        res_df.insert(3, 'gamma', [gamma for _, gamma in param_list])
+        df_list.append(res_df)
 
     df = pd.concat(df_list)         # type: pd.DataFrame
 
     df_list = []
     for ds_url, sub_df in df.groupby(['ds_url', ]):
-        best_row = sub_df.sort_values(['f_score', 'TPR'], ascending=False).iloc[:1, :]
+        best_row = _sort_best(sub_df).iloc[:1, :]
+        df_list.append(best_row)
+
+    df = pd.concat(df_list)         # type: pd.DataFrame
+    return df.set_index('ds_url', verify_integrity=True)
+
+
+@_file_memory.cache
+def do_one_class_halving(random_state, train_size_normal, train_size_anomalous, filter_constraints,
+                         use_scaler, use_normalizer, n_candidates=HALVING_N_CANDIDATES,
+                         min_train_size=HALVING_MIN_TRAIN_SIZE, eta=HALVING_ETA):
+    """
+    Successive halving alternative to the grid search of 'do_one_class'.
+    Random (nu, gamma) candidates from a continuous log-uniform range are fitted on a small
+    subsample of the training samples, only the best 1/eta of them are kept and the
+    subsample is made eta times larger for the next round, until the survivors are fitted
+    on all training samples. The best model is chosen with the same rule as the grid search.
+    """
+    rs = np.random.RandomState(random_state)
+    candidate_list = list(zip(
+        10 ** rs.uniform(*np.log10(HALVING_NU_RANGE), size=n_candidates),
+        10 ** rs.uniform(*np.log10(HALVING_GAMMA_RANGE), size=n_candidates)))
+
+    df_list = []
+    for ds_url in data_sets.DS_URL_LIST:
+        df = _get_samples(
+            ds_url, random_state, train_size_normal, train_size_anomalous, filter_constraints)
+        X_train, y_train_true, X_test, _ = fe.feature_numbers(df)
+        n_features = X_train.shape[1]
+        n_train = X_train.shape[0]
+
+        # scaler and normalizer do not depend on nu or gamma, so they are fitted only once
+        step_list = _make_steps(use_scaler, use_normalizer)
+        if step_list:
+            pre = make_pipeline(*step_list)
+            X_train = pre.fit_transform(X_train, y_train_true)
+            X_test = pre.transform(X_test)
+        else:
+            X_train = X_train.values
+            X_test = X_test.values
+
+        # the subsamples are nested, every round adds samples to the previous ones
+        perm = rs.permutation(n_train)
+        y_true, group = metrics.encode_df(df)
+
+        survivor_list = candidate_list
+        train_size = min_train_size
+        n_fit_samples = 0
+        while True:
+            train_size = min(train_size, n_train)
+
+            y_pred_list = []
+            for nu, gamma in survivor_list:
+                clf = OneClassSVM(random_state=0, nu=nu, gamma=gamma)
+                clf.fit(X_train[perm[:train_size]])
+                n_fit_samples += train_size
+                y_pred_list.append(
+                    _merge_predictions(group, clf.predict(X_train), clf.predict(X_test)))
+
+            res_df = metrics.counts_to_df(metrics.count(y_true, np.vstack(y_pred_list), group))
+            res_df.insert(0, 'ds_url', ds_url)
+            res_df.insert(1, 'n_features', n_features)
+            res_df.insert(2, 'nu', [nu for nu, _ in survivor_list])
+            res_df.insert(3, 'gamma', [gamma for _, gamma in survivor_list])
+            res_df = _sort_best(res_df)
+
+            if train_size == n_train:
+                break
+
+            n_keep = max(1, len(survivor_list) // eta)
+            survivor_list = list(zip(res_df['nu'].iloc[:n_keep], res_df['gamma'].iloc[:n_keep]))
+            train_size *= eta
+
+        best_row = res_df.iloc[:1, :].copy()
+        best_row['n_fit_samples'] = n_fit_samples
         df_list.append(best_row)
 
     df = pd.concat(df_list)         # type: pd.DataFrame
     return df.set_index('ds_url', verify_integrity=True)
 
 
+@_file_memory.cache
+def do_sv_reduction(random_state, train_size_normal, train_size_anomalous, filter_constraints,
+                    use_scaler, use_normalizer, budget_list=SV_BUDGET_LIST):
+    """
+    Compares the best model of the grid search of each group with its reduced versions,
+    one per budget of support vectors. Agreement and latency are measured on the test samples.
+    """
+    df_best = do_one_class(
+        random_state, train_size_normal, train_size_anomalous, filter_constraints,
+        use_scaler, use_normalizer)
+
+    df_list = []
+    for ds_url in data_sets.DS_URL_LIST:
+        df = _get_samples(
+            ds_url, random_state, train_size_normal, train_size_anomalous, filter_constraints)
+        X_train, y_train_true, X_test, _ = fe.feature_numbers(df)
+
+        step_list = _make_steps(use_scaler, use_normalizer)
+        if step_list:
+            pre = make_pipeline(*step_list)
+            X_train = pre.fit_transform(X_train, y_train_true)
+            X_test = pre.transform(X_test)
+        else:
+            X_train = X_train.values
+            X_test = X_test.values
+
+        nu = df_best.loc[ds_url, 'nu']
+        gamma = df_best.loc[ds_url, 'gamma']
+        svm = OneClassSVM(random_state=0, nu=nu, gamma=gamma)
+        svm.fit(X_train)
+        n_sv = svm.support_vectors_.shape[0]
+        y_true, group = metrics.encode_df(df)
+
+        row_list = []
+        y_pred_list = [_merge_predictions(group, svm.predict(X_train), svm.predict(X_test))]
+        for budget in budget_list:
+            reduced = classification.ReducedOneClassSVM(budget=budget, random_state=0)
+            reduced.reduce(svm)
+            agreement, t_original, t_reduced = classification.compare(svm, reduced, X_test)
+            row_list.append((budget, reduced.support_vectors_.shape[0], agreement,
+                             t_original, t_reduced))
+            y_pred_list.append(
+                _merge_predictions(group, reduced.predict(X_train), reduced.predict(X_test)))
+
+        f_score_list = metrics.counts_to_df(
+            metrics.count(y_true, np.vstack(y_pred_list), group))['f_score'].values
+        res_df = pd.DataFrame(
+            data=row_list,
+            columns=['budget', 'n_sv_reduced', 'agreement', 't_original_ms', 't_reduced_ms'])
+        res_df.insert(0, 'ds_url', ds_url)
+        res_df.insert(1, 'n_sv', n_sv)
+        res_df['f_score_original'] = f_score_list[0]
+        res_df['f_score_reduced'] = f_score_list[1:]
+        df_list.append(res_df)
+
+    return pd.concat(df_list)
+
+
+def _sort_best(df: pd.DataFrame) -> pd.DataFrame:
+    return df.sort_values(['f_score', 'TPR'], ascending=False)
+
+
 def run():
     random_state = 2
     train_size_normal = 500
@@ -233,3 +388,96 @@ def run():
             scenario['df']['FPR'].mean(), scenario['df']['FPR'].std(),
             scenario['df']['f_score'].mean(), scenario['df']['f_score'].std(),
             scenario['df']['f_score'].max()))
+
+
+def run_sharded():
+    random_state = 2
+    train_size_normal = 1500        # sharding only makes sense for larger training sets
+    train_size_anomalous = 0
+
+    df_dict = {}
+    for detector in ('svm', 'sharded', 'sharded_sv'):
+        df_dict[detector] = do_one_class(
+            random_state=random_state,
+            train_size_normal=train_size_normal,
+            train_size_anomalous=train_size_anomalous,
+            filter_constraints={},
+            use_scaler=True,
+            use_normalizer=True,
+            detector=detector)
+
+    df_base = df_dict['svm']
+    for detector in ('sharded', 'sharded_sv'):
+        diff = df_dict[detector]['f_score'] - df_base['f_score']
+
+        print()
+        print('{} with {} shards vs single model | f1-score tolerance {:4.2f}'.format(
+            detector, classification.N_SHARDS, SHARDED_F_SCORE_TOLERANCE))
+        print(pd.DataFrame({
+            'f_score_single': df_base['f_score'],
+            'f_score_sharded': df_dict[detector]['f_score'],
+            'diff': diff,
+            'within_tolerance': diff.abs() <= SHARDED_F_SCORE_TOLERANCE,
+        }).loc[:, ['f_score_single', 'f_score_sharded', 'diff', 'within_tolerance']])
+        print('{} of {} groups within tolerance | mean diff {:5.2f}'.format(
+            (diff.abs() <= SHARDED_F_SCORE_TOLERANCE).sum(), diff.shape[0], diff.mean()))
+
+
+def run_halving():
+    random_state = 2
+    train_size_normal = 500
+    train_size_anomalous = 0
+    n_grid_fit_samples = 16 * train_size_normal         # 4x4 grid, all on the full training set
+
+    print()
+    print('{:40s} | {:25s} | {:27s} | {:27s} | {:13s}'.format(
+        '', 'scaler and normalizer', 'grid f1-score', 'halving f1-score', 'fit samples'))
+    for label, filter_constraints in (
+            ('Using only whole request as string', fe.COMMON_FILTER_CONSTRAINTS['R']),
+            ('Including analysis of parameter values', {}),
+    ):
+        for scaler_normalizer in (False, True):
+            kwargs = {
+                'random_state': random_state,
+                'train_size_normal': train_size_normal,
+                'train_size_anomalous': train_size_anomalous,
+                'filter_constraints': filter_constraints,
+                'use_scaler': scaler_normalizer,
+                'use_normalizer': scaler_normalizer,
+            }
+            df_grid = do_one_class(**kwargs)
+            df_halving = do_one_class_halving(**kwargs)
+
+            print('{:40s} | {:25s} | {:4.2f} +/- {:4.2f} max {:4.2f} | '
+                  '{:4.2f} +/- {:4.2f} max {:4.2f} | {:5.2f} x grid'.format(
+                      label,
+                      str(scaler_normalizer),
+                      df_grid['f_score'].mean(), df_grid['f_score'].std(),
+                      df_grid['f_score'].max(),
+                      df_halving['f_score'].mean(), df_halving['f_score'].std(),
+                      df_halving['f_score'].max(),
+                      df_halving['n_fit_samples'].mean() / n_grid_fit_samples))
+
+
+def run_reduction():
+    df = do_sv_reduction(
+        random_state=2,
+        train_size_normal=500,
+        train_size_anomalous=0,
+        filter_constraints={},
+        use_scaler=True,
+        use_normalizer=True)
+
+    print()
+    print('{:6s} | {:11s} | {:9s} | {:23s} | {:23s}'.format(
+        'budget', 'mean n_sv', 'agreement', 'latency ms/req', 'f1-score'))
+    print('{:6s} | {:11s} | {:9s} | {:10s} | {:10s} | {:10s} | {:10s}'.format(
+        '', 'orig -> red', '', 'original', 'reduced', 'original', 'reduced'))
+    for budget, sub_df in df.groupby('budget', sort=False):
+        print('{:6d} | {:4.0f} -> {:3.0f} | {:9.4f} | '
+              '{:10.4f} | {:10.4f} | {:10.2f} | {:10.2f}'.format(
+                  budget,
+                  sub_df['n_sv'].mean(), sub_df['n_sv_reduced'].mean(),
+                  sub_df['agreement'].mean(),
+                  sub_df['t_original_ms'].mean(), sub_df['t_reduced_ms'].mean(),
+                  sub_df['f_score_original'].mean(), sub_df['f_score_reduced'].mean()))
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Nico Epp and Ralf Funk
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Vectorized calculation of the detection metrics. The labels and groups
+# are coded as integers, so the results of many fits can be counted at
+# once with a single 'np.bincount'.
+
+import numpy as np
+import pandas as pd
+from typing import Tuple
+from .. import feature_extraction as fe
+
+
+NORMAL = 0
+ANOMALOUS = 1
+TRAIN = 0
+TEST = 1
+
+PREFIX_BASE_LIST = (
+    'train_normal', 'train_anomalous', 'test_normal', 'test_anomalous',
+    'normal', 'anomalous', 'train', 'test', 'all',
+)
+COLUMN_HEADERS = [
+    '{}_{}'.format(base, suffix)
+    for base in PREFIX_BASE_LIST
+    for suffix in ('count', 'right', 'p')
+] + [
+    'TOTAL_POPULATION',
+    'P', 'TP', 'FN', 'TPR', 'FNR',
+    'N', 'TN', 'FP', 'TNR', 'FPR',
+    'f_score',
+]
+_N_CELLS = 4        # train normal, train anomalous, test normal, test anomalous
+
+
+def encode_labels(labels) -> np.ndarray:
+    return (np.asarray(labels) != 'normal').astype(np.intp)
+
+
+def encode_predictions(y_pred) -> np.ndarray:
+    # classifiers predict 1 for normal and -1 for anomalous samples
+    return (np.asarray(y_pred) != 1).astype(np.intp)
+
+
+def encode_df(df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    y_true = encode_labels(df[fe.META_TRUE_LABEL].values)
+    group = (df[fe.META_GROUP].values != 'train').astype(np.intp)
+    return y_true, group
+
+
+def count(y_true: np.ndarray, y_pred: np.ndarray, group: np.ndarray) -> np.ndarray:
+    """
+    Counts the samples and the correctly classified samples of each group and label.
+    y_pred can have one row of coded predictions per fit.
+    Returns one row per fit with the same 8 values as 'get_result_line'.
+    """
+    y_pred = np.atleast_2d(y_pred)
+    n_fits = y_pred.shape[0]
+
+    cell = group * 2 + y_true
+    code = (
+        np.arange(n_fits)[:, np.newaxis] * 2 * _N_CELLS
+        + (y_pred == y_true) * _N_CELLS
+        + cell)
+    counts = np.bincount(code.ravel(), minlength=n_fits * 2 * _N_CELLS).reshape(
+        n_fits, 2, _N_CELLS)
+
+    result = np.empty((n_fits, 2 * _N_CELLS), dtype=np.int64)
+    result[:, 0::2] = counts.sum(axis=1)        # count
+    result[:, 1::2] = counts[:, 1, :]           # right
+    return result
+
+
+def _round(x: np.ndarray) -> np.ndarray:
+    y = np.round(x, 2)
+
+    # np.round scales by 100 before rounding, so values close to a tie like 0.495 can give
+    # a different result than the built-in round, which works with the exact binary value
+    with np.errstate(invalid='ignore'):
+        is_tie = np.abs(x * 100 - np.floor(x * 100) - 0.5) < 1e-6
+    y[is_tie] = [round(float(v), 2) for v in x[is_tie]]
+    return y
+
+
+def _ratio(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = (a / b).astype(np.float64)
+    return np.where(np.isnan(x), 0, _round(x))
+
+
+def counts_to_df(counts: np.ndarray) -> pd.DataFrame:
+    """
+    Builds the final result data frame from the output of 'count', one row per fit.
+    """
+    counts = np.atleast_2d(counts)
+    data = {}
+
+    # counts of each group and label
+    for i, base in enumerate(PREFIX_BASE_LIST[:_N_CELLS]):
+        data[base + '_count'] = counts[:, 2 * i]
+        data[base + '_right'] = counts[:, 2 * i + 1]
+
+    # calculate sums
+    for base, (part_1, part_2) in (
+            ('normal', ('train_normal', 'test_normal')),
+            ('anomalous', ('train_anomalous', 'test_anomalous')),
+            ('train', ('train_normal', 'train_anomalous')),
+            ('test', ('test_normal', 'test_anomalous')),
+            ('all', ('normal', 'anomalous')),
+    ):
+        for suffix in ('_count', '_right'):
+            data[base + suffix] = data[part_1 + suffix] + data[part_2 + suffix]
+
+    # calculate proportions
+    for base in PREFIX_BASE_LIST:
+        data[base + '_p'] = _ratio(data[base + '_right'], data[base + '_count'])
+
+    # calculate statistics
+    data['TOTAL_POPULATION'] = data['test_count']
+
+    data['P'] = data['test_normal_count']
+    data['TP'] = data['test_normal_right']
+    data['FN'] = data['P'] - data['TP']
+    data['TPR'] = _ratio(data['TP'], data['P'])
+    data['FNR'] = 1 - data['TPR']
+
+    data['N'] = data['test_anomalous_count']
+    data['TN'] = data['test_anomalous_right']
+    data['FP'] = data['N'] - data['TN']
+    data['TNR'] = _ratio(data['TN'], data['N'])
+    data['FPR'] = 1 - data['TNR']
+
+    data['f_score'] = _ratio(2 * data['TP'], 2 * data['TP'] + data['FP'] + data['FN'])
+
+    return pd.DataFrame(data, columns=COLUMN_HEADERS)
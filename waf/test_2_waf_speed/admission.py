@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Nico Epp and Ralf Funk
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import threading
+import time
+from typing import Dict
+
+
+COUNTER_LIST = (
+    'scored',       # scored by the detection model
+    'late',         # scored by the detection model, but after the deadline
+    'degraded',     # scored by the fallback model
+    'shed',         # not scored
+)
+
+
+class AdmissionController:
+    """
+    Limits the number of requests scored at the same time and the time a request may
+    spend on scoring.
+
+    A running scoring can not be interrupted, so the deadline is enforced before it starts:
+    a request waits for a free scoring slot only while the time waited plus the expected
+    scoring time of its endpoint (moving average) is within the deadline.
+    A request that was not admitted may take a free slot of the fallback model, without
+    waiting, so that the fallback scorings are limited too.
+    :param max_concurrency: maximum number of requests scored at the same time, by the
+        detection models and by the fallback models each
+    :param deadline_ms: scoring time budget of a request, in milliseconds
+    :param smoothing: weight of the last scoring time in the moving average
+    """
+
+    def __init__(self, max_concurrency: int, deadline_ms: float, smoothing=0.1):
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._fallback_semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._deadline = deadline_ms / 1000
+        self._smoothing = smoothing
+        self._lock = threading.Lock()
+        self._expected_times = {}       # type: Dict[str, float]
+        self._counts = dict((name, 0) for name in COUNTER_LIST)
+
+    def count(self, name: str):
+        with self._lock:
+            self._counts[name] += 1
+
+    def get_counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counts)
+
+    def admit(self, key: str, t_start: float) -> bool:
+        """
+        Returns True if the request can be scored; then 'release' must be called after it.
+        """
+        with self._lock:
+            t_expected = self._expected_times.get(key, 0.0)
+        timeout = self._deadline - (time.perf_counter() - t_start) - t_expected
+        if timeout <= 0:
+            # no scoring updates the estimate of a refused endpoint, so it decays instead;
+            # after a slow scoring the endpoint is scored again and measured anew
+            with self._lock:
+                if key in self._expected_times:
+                    self._expected_times[key] *= 1 - self._smoothing
+            return False
+        return self._semaphore.acquire(timeout=timeout)
+
+    def admit_fallback(self) -> bool:
+        """
+        Returns True if a request that was not admitted can be scored by the fallback model;
+        then 'release_fallback' must be called after it.
+        """
+        return self._fallback_semaphore.acquire(blocking=False)
+
+    def release_fallback(self):
+        self._fallback_semaphore.release()
+
+    def release(self, key: str, t_start: float, t_scoring: float):
+        """
+        :param t_start: time the request started waiting for a slot (time.perf_counter)
+        :param t_scoring: seconds the scoring took
+        """
+        self._semaphore.release()
+
+        with self._lock:
+            t_expected = self._expected_times.get(key, 0.0)
+            self._expected_times[key] = (
+                (1 - self._smoothing) * t_expected + self._smoothing * t_scoring)
+            if time.perf_counter() - t_start > self._deadline:
+                self._counts['late'] += 1
+            else:
+                self._counts['scored'] += 1
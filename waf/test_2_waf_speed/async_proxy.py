@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Nico Epp and Ralf Funk
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import asyncio
+import collections
+import io
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from urllib import parse
+from .proxy import CherryProxy, HOP_BY_HOP_HEADERS, RETRY_METHODS
+
+
+class _BoundState(threading.local):
+    """
+    Request or response data of the request handled by the current thread.
+    The asyncio engine handles many requests in one thread, so the data of each request
+    is kept in its own object, which is bound to the thread while one of its hooks runs.
+    """
+
+    def bind(self, state):
+        self.__dict__['_state'] = state
+
+    def __getattr__(self, name):
+        try:
+            state = self.__dict__['_state']
+        except KeyError:
+            raise AttributeError(name)
+        return getattr(state, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.__dict__['_state'], name, value)
+
+
+class AsyncConnectionPool:
+    """
+    Pool of persistent connections to one server, for use in one event loop.
+    """
+
+    def __init__(self, host, port, max_size=10, idle_timeout=30.0):
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._idle = collections.deque()        # (reader, writer, time it was put back)
+
+    async def get(self):
+        """
+        :return: tuple (reader, writer, True if the connection was used before)
+        """
+        now = time.monotonic()
+        while self._idle:
+            reader, writer, t_idle = self._idle.pop()       # most recently used first
+            # at EOF if the server closed it while idle
+            if now - t_idle < self.idle_timeout and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        return reader, writer, False
+
+    def put(self, reader, writer):
+        if len(self._idle) < self.max_size:
+            self._idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+
+    def close(self):
+        while self._idle:
+            self._idle.pop()[1].close()
+
+
+async def _read_headers(reader):
+    header_list = []
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            return header_list
+        name, _, value = line.decode('latin-1').partition(':')
+        header_list.append((name.strip(), value.strip()))
+
+
+async def _read_body(reader, header_dict):
+    """
+    :return: tuple (body bytes, True if the connection is closed after the body)
+    """
+    will_close = header_dict.get('connection', '').lower() == 'close'
+
+    if 'chunked' in header_dict.get('transfer-encoding', '').lower():
+        chunk_list = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                await _read_headers(reader)         # trailers
+                return b''.join(chunk_list), will_close
+            chunk_list.append(await reader.readexactly(size))
+            await reader.readexactly(2)             # CRLF after each chunk
+
+    if 'content-length' in header_dict:
+        return await reader.readexactly(int(header_dict['content-length'])), will_close
+
+    return await reader.read(), True
+
+
+class AsyncCherryProxy(CherryProxy):
+    """
+    CherryProxy engine based on asyncio instead of a thread per connection, so that many
+    slow or idle client connections can be held at the same time.
+
+    The same filter methods are called with the same attributes in self.req and self.resp,
+    except self.resp.httpconn and self.resp.response, which are not available.
+    filter_request, where requests are usually analysed, runs in a pool of 'n_workers'
+    threads; the other filter methods run in the event loop and must not block.
+    """
+
+    def __init__(self, listen_address, listen_port, redirect_address, redirect_port, verbosity,
+                 n_workers=10, keep_alive_timeout=60.0, **kwargs):
+        self._n_workers = n_workers
+        self._keep_alive_timeout = keep_alive_timeout
+        self._loop = None
+        self._executor = None
+        self._writers = set()
+        super().__init__(listen_address, listen_port, redirect_address, redirect_port,
+                         verbosity, **kwargs)
+        # bodies are read completely by this engine, no streaming
+        self._inspection_window = 0
+        self._stream_responses = False
+
+        # per request data, see _BoundState
+        self.req = _BoundState()
+        self.resp = _BoundState()
+
+        self._async_pool = None
+        if self._pool:
+            self._async_pool = AsyncConnectionPool(
+                self._pool.host, self._pool.port, self._pool.max_size, self._pool.idle_timeout)
+            self._pool = None
+
+    def _make_server(self):
+        return None         # made in the event loop by start()
+
+    def start(self):
+        self.log('Starting asyncio proxy to listen on {} and redirect to {}',
+                 (self.listen_address, self.listen_port),
+                 (self.redirect_address, self.redirect_port))
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._executor = ThreadPoolExecutor(max_workers=self._n_workers)
+        if self._listen_socket:
+            server_coro = asyncio.start_server(self._handle_connection, sock=self._listen_socket)
+        else:
+            server_coro = asyncio.start_server(
+                self._handle_connection, self.listen_address, self.listen_port)
+        self.server = self._loop.run_until_complete(server_coro)
+        self.log('Proxy listening ... (press Ctrl+C to stop)')
+        self._start_metrics_server()
+        self._start_log_writer()
+        try:
+            self._loop.run_forever()
+        finally:
+            self.server.close()
+            self._loop.run_until_complete(self.server.wait_closed())
+            # idle client connections end their handlers when closed
+            for writer in list(self._writers):
+                writer.close()
+            self._loop.run_until_complete(asyncio.sleep(0.1))
+            if self._async_pool:
+                self._async_pool.close()
+            self._executor.shutdown(wait=False)
+            self._loop.close()
+            self._stop_metrics_server()
+            self._stop_log_writer()
+
+    def stop(self):
+        # may be called from another thread
+        if self._loop and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        self.log('Proxy stopped.')
+
+    def _bind(self, req, resp):
+        self.req.bind(req)
+        self.resp.bind(resp)
+
+    def _run_hook(self, req, resp, hook):
+        self._bind(req, resp)
+        hook()
+
+    async def _handle_connection(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    environ = await self._read_request_head(reader)
+                except (asyncio.TimeoutError, ValueError, ConnectionError):
+                    break
+                if environ is None:
+                    break
+                keep_alive = await self._handle_request(environ, reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as err:        # an error in one request must not stop the server
+            self.log('error in connection: {!r}', err)
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _read_request_head(self, reader):
+        line = await asyncio.wait_for(reader.readline(), self._keep_alive_timeout)
+        if not line:
+            return None
+        method, target, version = line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        parts = parse.urlsplit(target)
+
+        # same format as the WSGI environ given by CherryPyWSGIServer
+        environ = {
+            'REQUEST_METHOD': method,
+            'PATH_INFO': parse.unquote(parts.path),
+            'QUERY_STRING': parts.query,
+            'SERVER_PROTOCOL': version,
+            'wsgi.url_scheme': 'http',
+        }
+        for name, value in await _read_headers(reader):
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            environ[key] = value
+        return environ
+
+    async def _handle_request(self, environ, reader, writer) -> bool:
+        """
+        Same steps as CherryProxy._proxy_app.
+        Returns True if the client connection can be used for the next request.
+        """
+        t_start = time.perf_counter()
+        req = types.SimpleNamespace()
+        resp = types.SimpleNamespace()
+        self._bind(req, resp)
+        self._init_request_response()
+        self.log('START', req_id=req.id)
+
+        self._parse_request(environ)
+        self.record_time('parse', t_start)
+        self.filter_request_headers()
+
+        if not resp.status:
+            self._check_request_framing()
+        if resp.status:
+            resp.close_connection = True    # the body, if any, is still in the client connection
+        else:
+            t = time.perf_counter()
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            environ['wsgi.input'] = io.BytesIO(await reader.readexactly(length))
+            self._bind(req, resp)
+            self._read_request_body()
+            self.record_time('body_read', t)
+
+            # usually the most expensive method, it is run in a thread
+            await self._loop.run_in_executor(
+                self._executor, self._run_hook, req, resp, self.filter_request)
+
+        self._bind(req, resp)
+        self.log('request {} {}', req.method, req.url, req_id=req.id)
+
+        upstream = None
+        if not resp.status:
+            try:
+                t = time.perf_counter()
+                upstream = await self._send_request_async(req, resp)
+                self._bind(req, resp)
+                resp.t_sent = self.record_time('upstream_send', t)  # with the response headers
+                self.filter_response_headers()
+            except (OSError, ValueError, asyncio.IncompleteReadError) as err:
+                self._bind(req, resp)
+                self.log_debug('_send_request_async', 'error: {}', err)
+                self.set_response(502)
+                upstream = None
+
+        if not resp.data:
+            will_close = True
+            if upstream:
+                try:
+                    resp.data, will_close = await _read_body(upstream[0], upstream[2])
+                except (OSError, ValueError, asyncio.IncompleteReadError):
+                    resp.data = b''
+            if upstream and self._async_pool and not will_close:
+                self._async_pool.put(upstream[0], upstream[1])
+            elif upstream:
+                upstream[1].close()
+            upstream = None
+
+            self._bind(req, resp)
+            if resp.t_sent:
+                self.record_time('upstream_response', resp.t_sent)
+            self.filter_response()
+
+        if upstream:
+            upstream[1].close()         # response replaced before reading its body
+
+        keep_alive = (environ['SERVER_PROTOCOL'] == 'HTTP/1.1' and
+                      environ.get('HTTP_CONNECTION', '').lower() != 'close' and
+                      not resp.close_connection)
+        t = time.perf_counter()
+        await self._send_response_async(req, resp, writer, keep_alive)
+
+        self._bind(req, resp)
+        self.record_time('response_write', t)
+        self._finish_request(t_start)
+        return keep_alive
+
+    async def _send_request_async(self, req, resp):
+        """
+        Sends the request to the server and reads the response without its body.
+        Returns (reader, writer, dict of lowercase headers) of the server connection.
+        """
+        data = req.data or b''
+        header_list = ['{} {} HTTP/1.1'.format(req.method, req.url)]
+        for k, v in req.headers.items():
+            if k not in HOP_BY_HOP_HEADERS and k != 'content-length':
+                header_list.append('{}: {}'.format(k, v))
+        if 'host' not in req.headers:
+            header_list.append('host: {}:{}'.format(self.redirect_address, self.redirect_port))
+        header_list.append('content-length: {}'.format(len(data)))
+        request_bytes = '\r\n'.join(header_list).encode('latin-1') + b'\r\n\r\n' + data
+
+        while True:
+            if self._async_pool:
+                reader, writer, is_reused = await self._async_pool.get()
+            else:
+                reader, writer = await asyncio.open_connection(
+                    self.redirect_address, self.redirect_port)
+                is_reused = False
+
+            try:
+                writer.write(request_bytes)
+                await writer.drain()
+                line = await reader.readline()
+                if not line:
+                    raise ConnectionError('connection closed by server')
+                break
+            except (OSError, asyncio.IncompleteReadError) as err:
+                writer.close()
+                if not is_reused or req.method not in RETRY_METHODS:
+                    raise
+                # the server closed the idle connection, retry with another one
+                self._bind(req, resp)
+                self.log_debug('_send_request_async', 'stale connection: {}', err)
+
+        version, status, reason = (line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        resp.status = int(status)
+        resp.reason = reason
+        resp.headers = await _read_headers(reader)
+        header_dict = dict((k.lower(), v) for k, v in resp.headers)
+        resp.content_type = header_dict.get('content-type', 'text/plain').split(';')[0]
+        resp.content_type = resp.content_type.strip().lower()
+
+        if version == 'HTTP/1.0' and header_dict.get('connection', '').lower() != 'keep-alive':
+            header_dict['connection'] = 'close'
+        if req.method == 'HEAD' or resp.status in (204, 304) or resp.status < 200:
+            header_dict['content-length'] = '0'
+        return reader, writer, header_dict
+
+    async def _send_response_async(self, req, resp, writer, keep_alive):
+        data = resp.data
+        if isinstance(data, str):
+            data = data.encode()
+
+        header_list = ['HTTP/1.1 {} {}'.format(resp.status, resp.reason)]
+        for k, v in resp.headers:
+            if k.lower() not in HOP_BY_HOP_HEADERS and k.lower() != 'content-length':
+                header_list.append('{}: {}'.format(k, v))
+        header_list.append('Content-Length: {}'.format(len(data)))
+        if not keep_alive:
+            header_list.append('Connection: close')
+
+        writer.write('\r\n'.join(header_list).encode('latin-1') + b'\r\n\r\n')
+        if req.method != 'HEAD':
+            writer.write(data)
+        await writer.drain()
@@ -12,9 +12,28 @@ TEST_CONFIG = {
     'PROXY_ADDRESS': 'localhost',
     'PROXY_PORT': 8801,
     'PROXY_VERBOSITY': 1,
+    'LOG_BUFFER_SIZE': 10000,   # log records waiting for the writer thread, 0 to write directly
+    'PROXY_ENGINE': 'threads',  # 'threads' (CherryPyWSGIServer) or 'asyncio'
+    'ASYNC_N_WORKERS': 10,      # threads running filter_request with the asyncio engine
+    'PROXY_WORKERS': 1,         # proxy processes sharing the listen port and the models
+    'WORKER_STATS_INTERVAL': 10,    # seconds between stats of all proxy processes
+    'WORKER_MAX_RESTARTS': 5,   # restarts of a crashing proxy process before giving up on it
+    'WORKER_RESTART_WINDOW': 300,   # seconds in which those restarts are counted
+    'UPSTREAM_POOL_SIZE': 10,   # idle persistent connections to the destination, 0 to disable
+    'UPSTREAM_IDLE_TIMEOUT': 30,    # seconds an idle connection may be reused
+    'INSPECTION_WINDOW': 65536,     # request body bytes filtered before streaming, 0 to buffer
+    'MAX_BODY_SIZE': 10 * 1024 * 1024,  # request body bytes, 413 for longer ones, 0 for no limit
+    'BLOCK_UNINSPECTED': True,  # with blocking ON, 413 for bodies longer than the window
+    'RESPONSE_CHUNK_SIZE': 65536,   # response bytes per chunk streamed to the client, 0 to buffer
+    'METRICS_PORT': 8803,       # admin endpoint /metrics of the proxy, 0 to disable
     'DESTINATION_ADDRESS': 'localhost',
     'DESTINATION_PORT': 8802,
     'REQ_TIMEOUT': 10,
+    'CLIENT_KEEP_ALIVE': (True, False),     # source runs: connections kept alive and/or new
+    'LOAD_RPS': 200,            # source load runs: target requests per second, open loop
+    'LOAD_CONCURRENCY': 32,     # threads sending the requests, each with its own session
+    'LOAD_DURATION': 30,        # seconds
+    'LOAD_REQ_PER_CLASS': 500,  # requests of each data set and class in the corpus
     'DS_URL_SLICE': slice(16),  # exclude TORPEDA data because it has the same URLs as CSIC
     'REQ_RANGES': (
         ('n', range(2)),
@@ -22,4 +41,33 @@ TEST_CONFIG = {
     ),
     'DO_DETECTION': True,
     'DO_BLOCKING': False,
+    'ASYNC_MONITOR': False,     # with blocking OFF, score requests after forwarding them
+    'MONITOR_WORKERS': 2,
+    'MONITOR_QUEUE_SIZE': 1000,     # requests waiting to be scored, more are dropped
+    'ADMISSION_CONTROL': False,     # limit concurrent scorings and their time per request
+    'SCORING_MAX_CONCURRENCY': 4,
+    'SCORING_DEADLINE_MS': 50,
+    'ADMISSION_FALLBACK': 'model',  # if not in time: 'model' smaller SVM, 'pass' not scored
+    'FALLBACK_SV_BUDGET': 10,       # support vectors of the fallback model
+    'DETECTOR': 'svm',          # see classification.DETECTOR_LIST
+    'USE_MODEL_REGISTRY': True,  # load models trained with 'run.py test2 train' if available
+    'USE_COMPILED_SCORER': True,  # score requests without the sklearn pipeline, if possible
+    'DIRECT_FEATURES': True,    # compiled scorer: features from the parsed parts, no Request
+    'USE_CASCADE': False,       # accept requests inside the length/entropy envelope without SVM
+    'CASCADE_QUANTILE': 0.01,   # quantile of the training values excluded at each envelope end
+    'ROUTE_MATCHING': True,     # find the model of paths differing in case, slashes or ids
+    'ROUTE_TEMPLATES': True,    # route ids in the paths of the endpoints to any value
+    'HEADER_PHASE': True,       # check content-length and header names before reading the body
+    'HEADER_LENGTH_FACTOR': 2.0,    # body length limit, times the max length in training
+    'HEADER_MAX_UNKNOWN': 2,    # header names not seen in training allowed per request
+    'REJECT_UNKNOWN_ENDPOINTS': False,  # with blocking ON, 404 for requests without a model
+    'VERDICT_CACHE_SIZE': 10000,    # predictions of identical requests kept, 0 to disable
+    'VERDICT_CACHE_TTL': 60,        # seconds a cached prediction is used
+    'SV_BUDGET': 0,             # max support vectors kept per model after training, 0 to disable
+    'RETRAIN_INTERVAL': 0,      # seconds between background retraining rounds, 0 to disable
+    'RETRAIN_RESERVOIR_SIZE': 2000,     # max requests judged normal kept per endpoint
+    'RETRAIN_MIN_SAMPLES': 500,         # min requests collected to retrain an endpoint model
+    'BATCH_SCORING': False,     # score concurrent requests of an endpoint in micro batches
+    'BATCH_MAX_SIZE': 32,
+    'BATCH_MAX_WAIT_US': 500,   # max microseconds to wait for more requests to fill a batch
 }
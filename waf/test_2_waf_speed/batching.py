@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Nico Epp and Ralf Funk
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import collections
+import threading
+import time
+import numpy as np
+from typing import Dict
+
+
+class _Slot:
+    """
+    Place where the scorer thread leaves the verdict for a waiting request thread.
+    """
+
+    __slots__ = ('req', 'clf', 'event', 'y', 'error')
+
+    def __init__(self, req, clf):
+        self.req = req
+        self.clf = clf
+        self.event = threading.Event()
+        self.y = None
+        self.error = None
+
+
+class _EndpointQueue:
+
+    def __init__(self, max_batch_size: int, max_wait: float):
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait
+        self._pending = collections.deque()
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, req, clf) -> _Slot:
+        slot = _Slot(req, clf)
+        with self._condition:
+            self._pending.append(slot)
+            if len(self._pending) == 1 or len(self._pending) >= self._max_batch_size:
+                self._condition.notify()
+        return slot
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+
+            # wait for more requests until the batch is full or the first one waited enough
+            deadline = time.perf_counter() + self._max_wait
+            while len(self._pending) < self._max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            n = min(len(self._pending), self._max_batch_size)
+            return [self._pending.popleft() for _ in range(n)]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+
+            # models can be swapped, so a batch may contain requests for different models
+            clf_dict = collections.OrderedDict()
+            for slot in batch:
+                clf_dict.setdefault(id(slot.clf), []).append(slot)
+
+            for slot_list in clf_dict.values():
+                clf = slot_list[0].clf
+                try:
+                    if hasattr(clf, 'predict_features'):
+                        y = clf.predict_features(np.vstack([slot.req for slot in slot_list]))
+                    else:
+                        y = clf.predict([slot.req for slot in slot_list])
+                    for slot, y_i in zip(slot_list, y):
+                        slot.y = int(y_i)
+                except Exception as err:    # the error is raised in the request thread
+                    for slot in slot_list:
+                        slot.error = err
+
+                for slot in slot_list:
+                    slot.event.set()
+
+
+class MicroBatchScorer:
+    """
+    Scores the requests of concurrent request threads in batches.
+    Each endpoint has a queue and a scorer thread, which collects up to
+    'max_batch_size' requests or waits at most 'max_wait_us' microseconds after the first
+    one, scores the whole batch with one 'predict' call and wakes up the waiting threads.
+    With a CompiledScorer the request threads extract the features themselves, so the
+    scorer thread only evaluates the decision function of the whole batch.
+    """
+
+    def __init__(self, max_batch_size: int, max_wait_us: int):
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait_us / 10**6
+        self._queues = {}       # type: Dict[str, _EndpointQueue]
+        self._lock_queues = threading.Lock()
+
+    def predict(self, key: str, clf, req) -> int:
+        """
+        Blocks until the request is scored and returns its verdict (1 normal, -1 anomalous).
+        """
+        queue = self._queues.get(key)
+        if queue is None:
+            with self._lock_queues:
+                queue = self._queues.get(key)
+                if queue is None:
+                    queue = _EndpointQueue(self._max_batch_size, self._max_wait)
+                    self._queues[key] = queue
+
+        if hasattr(clf, 'fill_features'):
+            req = clf.fill_features(req, np.zeros(clf.n_features))
+
+        slot = queue.submit(req, clf)
+        slot.event.wait()
+        if slot.error is not None:
+            raise slot.error
+        return slot.y
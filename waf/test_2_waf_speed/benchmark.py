@@ -0,0 +1,541 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Nico Epp and Ralf Funk
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Micro benchmarks for single parts of the proxy, run in one process
+# without the other parts of the speed test.
+
+import asyncio
+import multiprocessing
+import numpy as np
+import os
+import random
+import socket
+import threading
+import time
+from http import client
+from http.server import BaseHTTPRequestHandler
+from typing import List, Tuple
+from urllib import parse
+from . import routing
+from .base import TEST_CONFIG
+from .async_proxy import AsyncCherryProxy
+from .batching import MicroBatchScorer
+from .destination import ThreadingHTTPServer
+from .proxy import CherryProxy, ConnectionPool
+from .proxy_implementation import build_request, train_model
+from .. import classification, data_sets
+
+
+N_THREADS = 32
+N_UPSTREAM_REQUESTS = 5000
+N_CONNECTIONS = 1000
+N_REQUESTS_PER_CONNECTION = 5
+N_ROUTING_LOOKUPS = 100000
+ROUTING_ENDPOINT_COUNTS = (100, 1000, 10000)
+
+
+def _time_per_call(func, arg_list) -> float:
+    t_start = time.perf_counter()
+    for arg in arg_list:
+        func(arg)
+    t_end = time.perf_counter()
+    return (t_end - t_start) * 1000 / len(arg_list)
+
+
+def run_scorer():
+    """
+    Compares the per-request latency and verdicts of the fitted pipelines and the
+    compiled scorers exported from them.
+    """
+    print()
+    print('{:6s} | {:9s} | {:15s} | {:15s} | {:7s} | {:9s}'.format(
+        'ds_url', 'requests', 'pipeline (ms)', 'compiled (ms)', 'speedup', 'agreement'))
+
+    for ds_url in data_sets.DS_URL_LIST[TEST_CONFIG['DS_URL_SLICE']]:
+        normal_list, anomalous_list = data_sets.get(ds_url)
+        if not normal_list:
+            continue
+
+        clf, _ = train_model(normal_list)
+        scorer = classification.CompiledScorer(clf)
+        req_list = normal_list + anomalous_list
+
+        y_pipeline = np.array([clf.predict(req)[0] for req in req_list])
+        y_compiled = np.array([scorer.predict(req)[0] for req in req_list])
+        t_pipeline = _time_per_call(clf.predict, req_list)
+        t_compiled = _time_per_call(scorer.predict, req_list)
+
+        print('{:6s} | {:9,d} | {:15.4f} | {:15.4f} | {:6.1f}x | {:9.4f}'.format(
+            ds_url, len(req_list), t_pipeline, t_compiled, t_pipeline / t_compiled,
+            np.mean(y_pipeline == y_compiled)))
+
+
+def _to_raw(req: data_sets.Request) -> Tuple:
+    """
+    Parts of the request as received by the proxy. The query and body are taken as they
+    are in the original text of CSIC requests ('METHOD url?query HTTP/1.1', headers,
+    empty line, body, empty line), otherwise rebuilt from the parsed params.
+    """
+    line_list = req.original_str.split('\n')
+    word_list = line_list[0].split()
+    if len(line_list) > 2 and len(word_list) == 3 and word_list[0] == req.method:
+        query = word_list[1].split('?', 1)[1] if '?' in word_list[1] else ''
+        body = line_list[-2]
+    else:
+        query = parse.urlencode(req.query_params)
+        body = parse.urlencode(req.body_params)
+    return req.method, req.url, dict(req.headers), query, body
+
+
+def _edge_case_raws(raw: Tuple) -> List[Tuple]:
+    """
+    Variants of a request with a repeated key, empty values and percent-encoding added to
+    its body, or to its query if it has no body.
+    """
+    i = 4 if raw[4] else 3
+    s = raw[i]
+    key = s.split('&', 1)[0].split('=', 1)[0] if s else 'p'
+    raw_list = []
+    for suffix in (
+            '{}=repeated'.format(key),
+            '{}=&empty='.format(key),
+            'flag&&=novalue',
+            '{}=%27%20OR%201%3D1+--+%E9%C3%B1%2'.format(key),
+    ):
+        raw = list(raw)
+        raw[i] = '{}&{}'.format(s, suffix) if s else suffix
+        raw_list.append(tuple(raw))
+    return raw_list
+
+
+def _score_with_request(scorer: classification.CompiledScorer, raw: Tuple) -> int:
+    return scorer.predict(build_request(*raw))[0]
+
+
+def _score_direct(scorer: classification.CompiledScorer, raw: Tuple) -> int:
+    return scorer.predict_dicts({
+        'headers': raw[2],
+        'query_params': data_sets.parse_params(raw[3]),
+        'body_params': data_sets.parse_params(raw[4]),
+    })
+
+
+def run_features():
+    """
+    Checks that the features and predictions of the compiled scorer, filled directly from
+    the raw query and body strings of a request, are the same as the ones of the fitted
+    pipeline for the Request object built from them, and compares the latency of the
+    compiled scorer with and without the Request object.
+    Every 10th request is also checked with the variants of '_edge_case_raws'.
+    """
+    print()
+    print('{:6s} | {:9s} | {:10s} | {:10s} | {:15s} | {:15s} | {:7s}'.format(
+        'ds_url', 'requests', 'features', 'verdicts', 'Request (ms)', 'direct (ms)',
+        'speedup'))
+
+    for ds_url in data_sets.DS_URL_LIST[TEST_CONFIG['DS_URL_SLICE']]:
+        normal_list, anomalous_list = data_sets.get(ds_url)
+        if not normal_list:
+            continue
+
+        clf, _ = train_model(normal_list)
+        scorer = classification.CompiledScorer(clf)
+        raw_list = [_to_raw(req) for req in normal_list + anomalous_list]
+
+        check_list = list(raw_list)
+        for raw in raw_list[::10]:
+            check_list.extend(_edge_case_raws(raw))
+
+        # reference: the proxy before the direct path, Request object and pipeline
+        req_list = [build_request(*raw) for raw in check_list]
+        X_pipeline = clf.steps[0][1].transform(req_list)
+        y_pipeline = clf.predict(req_list)
+
+        n_feature_mismatches = 0
+        n_verdict_mismatches = 0
+        for raw, x_pipeline, y in zip(check_list, X_pipeline, y_pipeline):
+            x_direct = scorer.fill_features_from_dicts({
+                'headers': raw[2],
+                'query_params': data_sets.parse_params(raw[3]),
+                'body_params': data_sets.parse_params(raw[4]),
+            }, np.zeros(scorer.n_features))
+            if not np.allclose(x_pipeline, x_direct):
+                n_feature_mismatches += 1
+            if _score_direct(scorer, raw) != y:
+                n_verdict_mismatches += 1
+
+        t_req = _time_per_call(lambda raw: _score_with_request(scorer, raw), raw_list)
+        t_direct = _time_per_call(lambda raw: _score_direct(scorer, raw), raw_list)
+
+        print('{:6s} | {:9,d} | {:10,d} | {:10,d} | {:15.4f} | {:15.4f} | {:6.1f}x'.format(
+            ds_url, len(check_list), n_feature_mismatches, n_verdict_mismatches, t_req, t_direct,
+            t_req / t_direct))
+
+
+def _run_threads(score_func, req_list, n_threads) -> Tuple[float, np.ndarray]:
+    latency_list = [[] for _ in range(n_threads)]
+
+    def work(i):
+        for req in req_list[i::n_threads]:
+            t_start = time.perf_counter()
+            score_func(req)
+            latency_list[i].append(time.perf_counter() - t_start)
+
+    thread_list = [threading.Thread(target=work, args=(i, )) for i in range(n_threads)]
+    t_start = time.perf_counter()
+    for t in thread_list:
+        t.start()
+    for t in thread_list:
+        t.join()
+    t_end = time.perf_counter()
+
+    return t_end - t_start, np.concatenate([np.array(e) for e in latency_list]) * 1000
+
+
+def run_batching():
+    """
+    Compares the detection throughput of concurrent request threads scoring one request
+    per call with the micro-batched scorer.
+    """
+    print()
+    print('{} request threads | batches of max {} requests, max wait {} us'.format(
+        N_THREADS, TEST_CONFIG['BATCH_MAX_SIZE'], TEST_CONFIG['BATCH_MAX_WAIT_US']))
+    print('{:6s} | {:7s} | {:9s} | {:12s} | {:12s} | {:12s}'.format(
+        'ds_url', 'mode', 'requests', 'req/s', 'mean (ms)', 'p99 (ms)'))
+
+    for ds_url in data_sets.DS_URL_LIST[TEST_CONFIG['DS_URL_SLICE']]:
+        normal_list, anomalous_list = data_sets.get(ds_url)
+        if not normal_list:
+            continue
+
+        clf, meta = train_model(normal_list)
+        try:
+            clf = classification.CompiledScorer(clf)
+        except ValueError:
+            pass
+        req_list = normal_list + anomalous_list
+        batch_scorer = MicroBatchScorer(
+            TEST_CONFIG['BATCH_MAX_SIZE'], TEST_CONFIG['BATCH_MAX_WAIT_US'])
+
+        for mode, score_func in (
+                ('direct', lambda req: clf.predict(req)[0]),
+                ('batched', lambda req: batch_scorer.predict(meta['key'], clf, req)),
+        ):
+            duration, latency = _run_threads(score_func, req_list, N_THREADS)
+            print('{:6s} | {:7s} | {:9,d} | {:12,.1f} | {:12.4f} | {:12.4f}'.format(
+                ds_url, mode, len(req_list), len(req_list) / duration,
+                latency.mean(), np.percentile(latency, 99)))
+
+
+class _EmptyRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def _forward(pool: ConnectionPool, address, port):
+    # same steps as CherryProxy for one request, without the filters
+    if pool:
+        conn, _ = pool.get()
+    else:
+        conn = client.HTTPConnection(address, port)
+    conn.request('GET', '/')
+    response = conn.getresponse()
+    response.read()
+    if pool and not response.will_close:
+        pool.put(conn)
+    else:
+        conn.close()
+
+
+def run_upstream():
+    """
+    Compares the per-request overhead of opening a new connection to the server for
+    every request with reusing the connections of the pool.
+    """
+    httpd = ThreadingHTTPServer(('localhost', 0), _EmptyRequestHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    address, port = httpd.server_address
+
+    print()
+    print('{:7s} | {:11s} | {:9s} | {:12s} | {:12s} | {:12s}'.format(
+        'threads', 'connections', 'requests', 'req/s', 'mean (ms)', 'p99 (ms)'))
+
+    for n_threads in (1, N_THREADS):
+        for mode, pool in (
+                ('new', None),
+                ('pool', ConnectionPool(
+                    address, port, TEST_CONFIG['UPSTREAM_POOL_SIZE'],
+                    TEST_CONFIG['UPSTREAM_IDLE_TIMEOUT'])),
+        ):
+            duration, latency = _run_threads(
+                lambda _: _forward(pool, address, port), range(N_UPSTREAM_REQUESTS), n_threads)
+            print('{:7d} | {:11s} | {:9,d} | {:12,.1f} | {:12.4f} | {:12.4f}'.format(
+                n_threads, mode, N_UPSTREAM_REQUESTS, N_UPSTREAM_REQUESTS / duration,
+                latency.mean(), np.percentile(latency, 99)))
+            if pool:
+                pool.close()
+
+    httpd.shutdown()
+
+
+async def _serve_empty(reader, writer):
+    # minimal HTTP/1.1 server, so the server is not the bottleneck of the engines benchmark
+    try:
+        while True:
+            length = 0
+            line = await reader.readline()
+            if not line:
+                break
+            while line not in (b'\r\n', b''):
+                line = await reader.readline()
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+            await reader.readexactly(length)
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n')
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    writer.close()
+
+
+def _start_empty_server() -> int:
+    port_list = []
+    is_ready = threading.Event()
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server = loop.run_until_complete(asyncio.start_server(_serve_empty, 'localhost', 0))
+        port_list.append(server.sockets[0].getsockname()[1])
+        is_ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, daemon=True).start()
+    is_ready.wait()
+    return port_list[0]
+
+
+def _wait_for_port(address, port, timeout=10.0):
+    t_end = time.perf_counter() + timeout
+    while True:
+        try:
+            socket.create_connection((address, port), timeout=1).close()
+            return
+        except OSError:
+            if time.perf_counter() > t_end:
+                raise
+            time.sleep(0.05)
+
+
+async def _client(address, port, latency_list, error_list):
+    try:
+        reader, writer = await asyncio.open_connection(address, port)
+        for _ in range(N_REQUESTS_PER_CONNECTION):
+            t_start = time.perf_counter()
+            writer.write('GET / HTTP/1.1\r\nhost: {}:{}\r\n\r\n'.format(address, port).encode())
+            length = 0
+            line = await reader.readline()
+            if not line:
+                raise ConnectionError('connection closed by proxy')
+            while line not in (b'\r\n', b''):
+                line = await reader.readline()
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+            await reader.readexactly(length)
+            latency_list.append(time.perf_counter() - t_start)
+        writer.close()
+    except (OSError, asyncio.IncompleteReadError) as err:
+        error_list.append(err)
+
+
+def run_engines():
+    """
+    Compares the throughput and latency of the proxy engines with many concurrent
+    client connections, without filtering.
+    """
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))   # clients, proxy and server
+    except (ImportError, ValueError):
+        pass
+
+    server_port = _start_empty_server()
+    address, port = TEST_CONFIG['PROXY_ADDRESS'], TEST_CONFIG['PROXY_PORT']
+
+    print()
+    print('{:,d} concurrent connections with {} requests each'.format(
+        N_CONNECTIONS, N_REQUESTS_PER_CONNECTION))
+    print('{:7s} | {:9s} | {:7s} | {:12s} | {:12s} | {:12s}'.format(
+        'engine', 'requests', 'errors', 'req/s', 'mean (ms)', 'p99 (ms)'))
+
+    for engine, proxy_class in (
+            ('threads', CherryProxy),
+            ('asyncio', AsyncCherryProxy),
+    ):
+        proxy = proxy_class(
+            listen_address=address, listen_port=port, redirect_address='localhost',
+            redirect_port=server_port, verbosity=0,
+            pool_size=TEST_CONFIG['UPSTREAM_POOL_SIZE'],
+            pool_idle_timeout=TEST_CONFIG['UPSTREAM_IDLE_TIMEOUT'])
+        threading.Thread(target=proxy.start, daemon=True).start()
+        _wait_for_port(address, port)
+
+        latency_list = []
+        error_list = []
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        t_start = time.perf_counter()
+        loop.run_until_complete(asyncio.gather(*[
+            _client(address, port, latency_list, error_list)
+            for _ in range(N_CONNECTIONS)]))
+        t_end = time.perf_counter()
+        loop.close()
+        proxy.stop()
+
+        latency = np.array(latency_list) * 1000
+        print('{:7s} | {:9,d} | {:7,d} | {:12,.1f} | {:12.4f} | {:12.4f}'.format(
+            engine, latency.shape[0], len(error_list), latency.shape[0] / (t_end - t_start),
+            latency.mean() if latency.shape[0] else np.nan,
+            np.percentile(latency, 99) if latency.shape[0] else np.nan))
+        time.sleep(1)       # let the proxy release its port
+
+
+def _predict_all(clf, req_list):
+    for req in req_list:
+        clf.predict(req)
+
+
+def run_workers():
+    """
+    Compares the detection throughput of several threads with several forked processes
+    sharing the same model, as in the pre-fork mode of the proxy.
+    """
+    ds_url = data_sets.DS_URL_LIST[TEST_CONFIG['DS_URL_SLICE']][0]
+    normal_list, anomalous_list = data_sets.get(ds_url)
+    clf, _ = train_model(normal_list)
+    try:
+        clf = classification.CompiledScorer(clf)
+    except ValueError:
+        pass
+    req_list = normal_list + anomalous_list
+    context = multiprocessing.get_context('fork')
+
+    print()
+    print('{} | {:,d} requests'.format(ds_url, len(req_list)))
+    print('{:7s} | {:9s} | {:12s} | {:7s}'.format('workers', 'mode', 'req/s', 'speedup'))
+
+    t_single = None
+    for n_workers in sorted({1, 2, 4, os.cpu_count() or 1}):
+        for mode, worker_class in (
+                ('threads', threading.Thread),
+                ('processes', context.Process),
+        ):
+            worker_list = [
+                worker_class(target=_predict_all, args=(clf, req_list[i::n_workers]))
+                for i in range(n_workers)]
+            t_start = time.perf_counter()
+            for w in worker_list:
+                w.start()
+            for w in worker_list:
+                w.join()
+            t = time.perf_counter() - t_start
+
+            if t_single is None:
+                t_single = t
+            print('{:7d} | {:9s} | {:12,.1f} | {:6.2f}x'.format(
+                n_workers, mode, len(req_list) / t, t_single / t))
+
+
+def _make_endpoint_keys(n: int, rnd: random.Random) -> List[str]:
+    word_list = [
+        '{}{}'.format(w, i) for w in ('shop', 'item', 'user', 'cart', 'api') for i in range(20)]
+    key_set = set()
+    while len(key_set) < n:
+        seg_list = [rnd.choice(word_list) for _ in range(rnd.randint(1, 5))]
+        if rnd.random() < 0.3:
+            seg_list.insert(rnd.randint(1, len(seg_list)), str(rnd.randint(1, 99999)))
+        key_set.add('{} /{}.jsp'.format(rnd.choice(('GET', 'POST')), '/'.join(seg_list)))
+    return sorted(key_set)
+
+
+def _vary_path(path: str, rnd: random.Random) -> str:
+    # same endpoint as a client may request it: other id, other case or a trailing slash
+    path = '/'.join(str(rnd.randint(1, 99999)) if seg.isdigit() else seg
+                    for seg in path.split('/'))
+    r = rnd.random()
+    if r < 0.3:
+        return path.upper()
+    if r < 0.6:
+        return path + '/'
+    return path
+
+
+def run_routing():
+    """
+    Compares the endpoint lookup of the proxy with and without the route table, for
+    thousands of endpoints: half of the requests have the exact path of an endpoint and
+    half a variation of it.
+    """
+    rnd = random.Random(0)
+    print()
+    print('{:9s} | {:7s} | {:10s} | {:25s} | {:25s}'.format(
+        'endpoints', 'routes', 'build (ms)', 'dict: us / matched', 'route table: us / matched'))
+
+    for n_endpoints in ROUTING_ENDPOINT_COUNTS:
+        key_list = _make_endpoint_keys(n_endpoints, rnd)
+        key_dict = dict((key, None) for key in key_list)
+
+        t_start = time.perf_counter()
+        table = routing.RouteTable.from_keys(key_list)
+        t_build = time.perf_counter() - t_start
+
+        lookup_list = []
+        for _ in range(N_ROUTING_LOOKUPS):
+            method, path = rnd.choice(key_list).split(' ', 1)
+            lookup_list.append((method, path if rnd.random() < 0.5 else _vary_path(path, rnd)))
+
+        def find_exact(lookup):
+            key = '{} {}'.format(*lookup)
+            return key if key in key_dict else None
+
+        def find_routed(lookup):
+            key = '{} {}'.format(*lookup)
+            return key if key in key_dict else table.match(*lookup)
+
+        result_list = []
+        for find in (find_exact, find_routed):
+            n_matched = sum(find(lookup) is not None for lookup in lookup_list)
+            t = _time_per_call(find, lookup_list) * 1000
+            result_list.append('{:12.3f} / {:10.1%}'.format(t, n_matched / len(lookup_list)))
+
+        print('{:9,d} | {:7,d} | {:10.1f} | {:25s} | {:25s}'.format(
+            n_endpoints, table.n_routes, t_build * 1000, *result_list))
+
+
+BENCHMARKS = {
+    'batching': run_batching,
+    'engines': run_engines,
+    'features': run_features,
+    'routing': run_routing,
+    'scorer': run_scorer,
+    'upstream': run_upstream,
+    'workers': run_workers,
+}
+
+
+def run(name: str):
+    if name not in BENCHMARKS:
+        raise ValueError('benchmark "{}" is not one of {}'.format(name, sorted(BENCHMARKS)))
+    BENCHMARKS[name]()
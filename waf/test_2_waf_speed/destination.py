@@ -9,6 +9,7 @@ import pickle
 import requests
 import time
 from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
 from typing import List
 from .base import TEST_CONFIG
 from ..data_sets.base import Request
@@ -21,7 +22,19 @@ def _str(req: Request, dict_name: str) -> List[str]:
         for k, v in sorted(d.items())]
 
 
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # with persistent connections, each connection needs its own thread
+    daemon_threads = True
+
+
 class RequestHandler(BaseHTTPRequestHandler):
+    # keep the connections of the proxy open between requests
+    protocol_version = 'HTTP/1.1'
+
+    def _send_empty_response(self, code: int):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
 
     def _get_from_data_server(self, ds_url: str, req_class: str, req_n: int) -> Request:
         self.log_message('{:25s} | ds_url {} | req_class {} | req_n {}'.format(
@@ -73,8 +86,8 @@ class RequestHandler(BaseHTTPRequestHandler):
                 obt_req.body_params = body_bytes.decode()
             except ValueError as err:
                 self.log_message('{:25s} | {}'.format('_process_req', err))
-                self.send_response(400)     # 400: bad request
-                self.end_headers()
+                self.close_connection = True        # the body may not be fully read
+                self._send_empty_response(400)     # 400: bad request
                 return
 
         # get expected Request object
@@ -85,8 +98,7 @@ class RequestHandler(BaseHTTPRequestHandler):
             exp_req = self._get_from_data_server(ds_url, req_class, req_n)
         except (KeyError, IndexError, ValueError) as err:
             self.log_message('{:25s} | {}'.format('_process_req', err))
-            self.send_response(404)
-            self.end_headers()
+            self._send_empty_response(404)
             return
 
         # this header gives differences
@@ -126,13 +138,11 @@ class RequestHandler(BaseHTTPRequestHandler):
                 self.log_message('{:25s} | expected {:3d} {}'.format(
                     '_process_req', len(exp_req.body_params), _str(exp_req, 'body_params')))
 
-            self.send_response(400)     # 400: bad request
-            self.end_headers()
+            self._send_empty_response(400)     # 400: bad request
             return
 
         self.log_message('{:25s} | END {}'.format('_process_req', '-' * 10))
-        self.send_response(200)
-        self.end_headers()
+        self._send_empty_response(200)
 
     def do_GET(self):
         self._process_req()
@@ -142,7 +152,7 @@ class RequestHandler(BaseHTTPRequestHandler):
 
 
 def run():
-    httpd = HTTPServer(
+    httpd = ThreadingHTTPServer(
         (TEST_CONFIG['DESTINATION_ADDRESS'], TEST_CONFIG['DESTINATION_PORT']),
         RequestHandler)
 
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Nico Epp and Ralf Funk
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import collections
+import threading
+from typing import Tuple
+
+
+def format_record(record: Tuple) -> str:
+    """
+    :param record: tuple (prefix, request id or None, message, message format arguments)
+    """
+    prefix, req_id, s, args = record
+    if args:
+        s = s.format(*args)
+    if req_id:
+        return '{}{:06} | {}\n'.format(prefix, req_id, s)
+    return '{}{}\n'.format(prefix, s)
+
+
+class LogWriter:
+    """
+    Writes log records to 'stream' in a background thread, so that request threads only
+    append a tuple to a ring buffer; the message is formatted by the writer thread, so its
+    arguments should not be modified after they are logged.
+    When the writer falls behind by more than 'max_size' records the oldest ones are
+    dropped and counted. After stop() no record is accepted, so none is left unwritten.
+    """
+
+    def __init__(self, stream, max_size: int):
+        self._stream = stream
+        self._max_size = max_size
+        self._buffer = collections.deque(maxlen=max_size)
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._is_closed = False
+        self._thread = None
+        self.n_dropped = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Writes the pending records and stops the thread.
+        """
+        with self._lock:
+            self._is_closed = True
+        self._event.set()
+        self._thread.join()
+        if self.n_dropped:
+            self._stream.write('### log writer | {} records dropped\n'.format(self.n_dropped))
+            self._stream.flush()
+
+    def put(self, record: Tuple) -> bool:
+        """
+        Returns False if the writer is stopped, the record should then be written directly.
+        """
+        with self._lock:
+            if self._is_closed:
+                return False
+            if len(self._buffer) == self._max_size:
+                self.n_dropped += 1     # the oldest record is dropped by append
+            self._buffer.append(record)
+        if not self._event.is_set():
+            self._event.set()
+        return True
+
+    def _run(self):
+        while True:
+            self._event.wait()
+            self._event.clear()
+            # read before the last drain: records put after stop() are refused, not lost
+            is_closed = self._is_closed
+            while self._buffer:
+                self._write(self._buffer.popleft())
+            try:
+                self._stream.flush()
+            except Exception:
+                pass
+            if is_closed:
+                return
+
+    def _write(self, record: Tuple):
+        # a bad format argument or a broken stream must not stop the writer thread
+        try:
+            self._stream.write(format_record(record))
+        except Exception as err:
+            try:
+                self._stream.write('### log writer | {!r}: {!r}\n'.format(err, record))
+            except Exception:
+                pass
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Nico Epp and Ralf Funk
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import bisect
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from typing import Callable, Dict, List, Tuple
+
+
+STAGE_LIST = (
+    'parse',                # WSGI environ to request attributes
+    'body_read',            # request body, or its inspection window
+    'features',             # request parts parsed, or the Request object built
+    'scoring',              # features filled and detection model
+    'upstream_send',        # connection to the server and request sent
+    'upstream_response',    # response from the server, its body if it is not streamed
+    'response_write',       # response sent to the client, a streamed body read meanwhile
+)
+
+# upper bounds in seconds, the last bucket (+Inf) is implicit
+BUCKET_LIST = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(s: str) -> str:
+    return s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class LatencyHistograms:
+    """
+    Histograms of the time of each request stage, by endpoint and verdict.
+
+    Every thread writes only to its own accumulators, so no lock is taken when a request
+    is recorded; 'render' adds the accumulators of all threads, which may miss the last
+    updates of a request being recorded at that moment.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()       # only to register the accumulators of a thread
+        self._accumulators = []             # type: List[Dict[Tuple[str, str, str], List]]
+
+    def _get_accumulator(self) -> Dict:
+        acc = getattr(self._local, 'acc', None)
+        if acc is None:
+            acc = {}
+            self._local.acc = acc
+            with self._lock:
+                self._accumulators.append(acc)
+        return acc
+
+    def record(self, timing_list: List[Tuple[str, float]], endpoint: str, verdict: str):
+        """
+        :param timing_list: list of (stage, seconds) of one request
+        """
+        acc = self._get_accumulator()
+        for stage, t in timing_list:
+            h = acc.get((stage, endpoint, verdict))
+            if h is None:
+                # bucket counts, sum of seconds, count
+                h = [[0] * (len(BUCKET_LIST) + 1), 0.0, 0]
+                acc[(stage, endpoint, verdict)] = h
+            h[0][bisect.bisect_left(BUCKET_LIST, t)] += 1
+            h[1] += t
+            h[2] += 1
+
+    def _merge(self) -> Dict[Tuple[str, str, str], List]:
+        with self._lock:
+            acc_list = list(self._accumulators)
+
+        total = {}
+        for acc in acc_list:
+            for labels, (bucket_counts, t_sum, n) in list(acc.items()):
+                h = total.get(labels)
+                if h is None:
+                    h = [[0] * (len(BUCKET_LIST) + 1), 0.0, 0]
+                    total[labels] = h
+                h[0] = [a + b for a, b in zip(h[0], bucket_counts)]
+                h[1] += t_sum
+                h[2] += n
+        return total
+
+    def render(self) -> str:
+        """
+        Histograms in the Prometheus text format.
+        """
+        line_list = [
+            '# HELP waf_proxy_stage_seconds Time of each stage of a request through the proxy.',
+            '# TYPE waf_proxy_stage_seconds histogram',
+        ]
+        for (stage, endpoint, verdict), (bucket_counts, t_sum, n) in sorted(
+                self._merge().items()):
+            labels = 'stage="{}",endpoint="{}",verdict="{}"'.format(
+                stage, _escape(endpoint), verdict)
+            cumulative = 0
+            for le, count in zip(BUCKET_LIST + ('+Inf', ), bucket_counts):
+                cumulative += count
+                line_list.append('waf_proxy_stage_seconds_bucket{{{},le="{}"}} {}'.format(
+                    labels, le, cumulative))
+            line_list.append('waf_proxy_stage_seconds_sum{{{}}} {}'.format(labels, t_sum))
+            line_list.append('waf_proxy_stage_seconds_count{{{}}} {}'.format(labels, n))
+        return '\n'.join(line_list) + '\n'
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer:
+    """
+    Admin HTTP server answering GET /metrics with the text returned by 'render_func'.
+    """
+
+    def __init__(self, address, port, render_func: Callable[[], str]):
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                data = render_func().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass        # scraped every few seconds, not logged
+
+        self._httpd = _ThreadingHTTPServer((address, port), Handler)
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Nico Epp and Ralf Funk
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import queue
+import threading
+from typing import Callable, Dict
+
+
+class AsyncMonitor:
+    """
+    Scores requests outside of the request threads, for when the verdicts are only logged.
+    Requests are put in a bounded queue and scored by a pool of worker threads; when the
+    queue is full the request is dropped (not scored) and counted, so that the request
+    threads never wait for the detection.
+    :param score_func: function(*item) -> prediction, 1 normal or -1 anomalous
+    :param log_func: function(method_name, s, *args), for debug messages
+    """
+
+    def __init__(self, n_workers: int, queue_size: int, score_func: Callable,
+                 log_func: Callable):
+        self._score_func = score_func
+        self._log_func = log_func
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._counts = {'queued': 0, 'dropped': 0, 'scored': 0, 'anomalous': 0, 'errors': 0}
+        self._thread_list = [
+            threading.Thread(target=self._run, name='monitor-{}'.format(i), daemon=True)
+            for i in range(n_workers)]
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counts[name] += 1
+
+    def start(self):
+        for t in self._thread_list:
+            t.start()
+
+    def stop(self):
+        for _ in self._thread_list:
+            self._queue.put(None)
+        for t in self._thread_list:
+            t.join()
+
+    def submit(self, *item) -> bool:
+        """
+        Returns False if the request was dropped because the queue is full.
+        """
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self._count('dropped')
+            return False
+        self._count('queued')
+        return True
+
+    def get_counts(self) -> Dict[str, int]:
+        with self._lock:
+            counts = dict(self._counts)
+        counts['pending'] = self._queue.qsize()
+        return counts
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            try:
+                y = self._score_func(*item)
+            except Exception as err:        # a failed scoring must not stop the worker
+                self._log_func('AsyncMonitor', 'could not score: {}', err)
+                self._count('errors')
+                continue
+
+            self._count('scored')
+            if y == -1:
+                self._count('anomalous')
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Nico Epp and Ralf Funk
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Pre-fork mode of the proxy: the detection models are loaded once and several worker
+# processes, forked after that, share them copy-on-write and accept connections on the
+# same listening socket. Only available where processes can be forked (not on Windows).
+
+import collections
+import multiprocessing
+import queue
+import socket
+import sys
+import threading
+import time
+from typing import Dict
+
+
+def make_listen_socket(address, port, backlog=128) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((address, port))
+    sock.listen(backlog)
+    return sock
+
+
+class _QueueStream:
+    """
+    File-like log stream of a worker, the lines are written by the supervisor.
+    """
+
+    def __init__(self, q, worker_id: int):
+        self._queue = q
+        self._worker_id = worker_id
+
+    def write(self, s: str):
+        self._queue.put(('log', self._worker_id, s))
+
+    def flush(self):
+        pass
+
+
+def _send_stats(proxy, q, worker_id: int, interval: float):
+    while True:
+        time.sleep(interval)
+        q.put(('stats', worker_id, proxy.get_stats()))
+
+
+def _run_worker(proxy, q, worker_id: int, stats_interval: float):
+    proxy._log_stream = _QueueStream(q, worker_id)
+    if proxy._metrics_port:
+        proxy._metrics_port += worker_id        # each worker serves its own metrics
+    threading.Thread(
+        target=_send_stats, args=(proxy, q, worker_id, stats_interval), daemon=True).start()
+    try:
+        proxy.start()
+    except KeyboardInterrupt:
+        proxy.stop()
+
+
+class Supervisor:
+    """
+    Starts 'n_workers' processes running 'proxy', restarts the ones that exit unexpectedly
+    and writes their logs and the sum of their stats to 'log_stream'.
+    The proxy must use an already bound listen_socket and should have its models loaded.
+
+    A worker is restarted after 'restart_backoff' seconds, doubled for each restart in the
+    last 'restart_window' seconds up to 'max_backoff'; a worker that already needed
+    'max_restarts' restarts in that window, e.g. one that crashes at startup, is given up.
+    """
+
+    def __init__(self, proxy, n_workers: int, stats_interval=10.0, log_stream=sys.stdout,
+                 restart_backoff=1.0, max_backoff=60.0, max_restarts=5, restart_window=300.0):
+        self._proxy = proxy
+        self._n_workers = n_workers
+        self._stats_interval = stats_interval
+        self._log_stream = log_stream
+        self._context = multiprocessing.get_context('fork')
+        self._queue = self._context.Queue()
+        self._workers = {}          # type: Dict[int, multiprocessing.Process]
+        self._stats = {}            # type: Dict[int, Dict[str, int]]
+        self._n_restarts = 0
+        self._restart_backoff = restart_backoff
+        self._max_backoff = max_backoff
+        self._max_restarts = max_restarts
+        self._restart_window = restart_window
+        self._restart_times = {}    # type: Dict[int, collections.deque]
+        self._restart_at = {}       # type: Dict[int, float]
+
+    def _log(self, s: str):
+        self._log_stream.write('### supervisor | {}\n'.format(s))
+
+    def _start_worker(self, worker_id: int):
+        p = self._context.Process(
+            target=_run_worker,
+            args=(self._proxy, self._queue, worker_id, self._stats_interval),
+            name='proxy-worker-{}'.format(worker_id))
+        p.start()
+        self._workers[worker_id] = p
+        self._log('worker {} started with pid {}'.format(worker_id, p.pid))
+
+    def _log_stats(self):
+        total = {}
+        for stats in self._stats.values():
+            for k, v in stats.items():
+                total[k] = total.get(k, 0) + v
+        self._log('{} workers | {} restarts | {}'.format(
+            sum(p.is_alive() for p in self._workers.values()), self._n_restarts,
+            ' | '.join('{} {}'.format(k, v) for k, v in sorted(total.items()))))
+
+    def _process_queue(self, timeout: float):
+        try:
+            kind, worker_id, content = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+
+        if kind == 'log':
+            self._log_stream.write('w{:02d} {}'.format(worker_id, content))
+        else:
+            self._stats[worker_id] = content
+
+    def run(self):
+        for worker_id in range(self._n_workers):
+            self._start_worker(worker_id)
+
+        t_next_stats = time.perf_counter() + self._stats_interval
+        try:
+            while True:
+                self._process_queue(timeout=0.5)
+
+                for worker_id, p in list(self._workers.items()):
+                    if p.is_alive():
+                        continue
+                    if p.exitcode == 0:         # stopped cleanly, e.g. with Ctrl+C
+                        self._log('worker {} stopped'.format(worker_id))
+                        del self._workers[worker_id]
+                    else:
+                        del self._workers[worker_id]
+                        self._schedule_restart(worker_id, p.exitcode)
+
+                now = time.perf_counter()
+                for worker_id, t_restart in list(self._restart_at.items()):
+                    if now >= t_restart:
+                        del self._restart_at[worker_id]
+                        self._n_restarts += 1
+                        self._start_worker(worker_id)
+
+                if not self._workers and not self._restart_at:
+                    break
+
+                if time.perf_counter() > t_next_stats:
+                    self._log_stats()
+                    t_next_stats += self._stats_interval
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+    def _schedule_restart(self, worker_id: int, exitcode: int):
+        now = time.perf_counter()
+        t_list = self._restart_times.setdefault(worker_id, collections.deque())
+        while t_list and now - t_list[0] > self._restart_window:
+            t_list.popleft()
+
+        if len(t_list) >= self._max_restarts:
+            self._log('worker {} exited with code {}, given up after {} restarts in {} s'.format(
+                worker_id, exitcode, len(t_list), self._restart_window))
+            return
+
+        t_list.append(now)
+        delay = min(self._max_backoff, self._restart_backoff * 2 ** (len(t_list) - 1))
+        self._restart_at[worker_id] = now + delay
+        self._log('worker {} exited with code {}, restarting in {:.1f} s'.format(
+            worker_id, exitcode, delay))
+
+    def stop(self):
+        # the workers also get the KeyboardInterrupt from the terminal, if not they are terminated
+        for p in self._workers.values():
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+        while not self._queue.empty():
+            self._process_queue(timeout=0)
+        self._log_stats()
+        self._log('all workers stopped')
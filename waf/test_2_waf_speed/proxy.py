@@ -33,17 +33,121 @@ PERFORMANCE OF THIS SOFTWARE.
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import collections
+import re
+import socket
 import threading
 import time
 import sys
 from http import client
 from urllib import parse
-from cherrypy.wsgiserver import CherryPyWSGIServer
+from cherrypy.wsgiserver import CherryPyWSGIServer, WSGIGateway_10
+from .log_writer import LogWriter, format_record
+from .metrics import LatencyHistograms, MetricsServer
 
 
 # supported methods and schemes
 ALLOWED_METHODS = ['GET', 'POST', 'PUT', 'DELETE', 'HEAD']
 ALLOWED_SCHEMES = ['http']
+# methods retried on another connection if a reused one fails after the request was written,
+# as the server may have received it (see RFC 7230, section 6.3.1)
+RETRY_METHODS = ('GET', 'HEAD')
+
+# headers of one connection, not forwarded (see RFC 2616, section 13.5.1)
+HOP_BY_HOP_HEADERS = (
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailers',
+    'transfer-encoding', 'upgrade')
+
+_DIGITS_RE = re.compile(r'[0-9]+\Z')
+
+
+def _is_closed_by_server(conn: client.HTTPConnection) -> bool:
+    # an idle connection is only readable if the server closed it (EOF or reset);
+    # a non-blocking peek instead of select(), which fails for descriptors above FD_SETSIZE
+    sock = conn.sock
+    if sock is None:
+        return True
+    timeout = sock.gettimeout()
+    sock.settimeout(0)
+    try:
+        sock.recv(1, socket.MSG_PEEK)
+        return True
+    except BlockingIOError:
+        return False
+    except OSError:
+        return True
+    finally:
+        sock.settimeout(timeout)
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of persistent HTTP connections to one server.
+    Connections idle for more than 'idle_timeout' seconds, or already closed by the server,
+    are closed instead of reused, and at most 'max_size' idle connections are kept.
+    """
+
+    def __init__(self, host, port, max_size=10, idle_timeout=30.0):
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._idle = collections.deque()        # (connection, time it was put back)
+
+    def get(self):
+        """
+        Returns an idle connection, or a new one if there is none.
+        :return: tuple (http.client.HTTPConnection, True if it was used before)
+        """
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, t_idle = self._idle.pop()     # most recently used first
+            if now - t_idle < self.idle_timeout and not _is_closed_by_server(conn):
+                return conn, True
+            conn.close()
+        return client.HTTPConnection(self.host, self.port), False
+
+    def put(self, conn):
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            while self._idle:
+                self._idle.pop()[0].close()
+
+
+class ClosingGateway(WSGIGateway_10):
+    """
+    WSGI gateway that closes the client connection when the application sends
+    'Connection: close'. The server would otherwise read and discard the rest of a request
+    body that was not read before reusing the connection.
+    """
+
+    def start_response(self, status, headers, exc_info=None):
+        if any(k.lower() == 'connection' and v.lower() == 'close' for k, v in headers):
+            self.req.close_connection = True
+        return super().start_response(status, headers, exc_info)
+
+
+class InheritedSocketServer(CherryPyWSGIServer):
+    """
+    CherryPyWSGIServer using a socket that is already bound, e.g. shared by several processes.
+    """
+
+    def __init__(self, listen_socket, *args, **kwargs):
+        self._listen_socket = listen_socket
+        super().__init__(*args, **kwargs)
+
+    def bind(self, family, type, proto=0):
+        self.socket = self._listen_socket
 
 
 class CherryProxy:
@@ -56,54 +160,142 @@ class CherryProxy:
     _lock_req_id = threading.Lock()
 
     def __init__(self, listen_address, listen_port, redirect_address, redirect_port, verbosity,
-                 log_stream=sys.stdout):
+                 log_stream=sys.stdout, pool_size=10, pool_idle_timeout=30.0, listen_socket=None,
+                 inspection_window=0, response_chunk_size=65536, metrics_port=0,
+                 log_buffer_size=0, max_request_body_size=0):
         self.listen_address = listen_address
         self.listen_port = listen_port
         self.redirect_address = redirect_address
         self.redirect_port = redirect_port
         self._verbosity = verbosity
         self._log_stream = log_stream
+        # log records written by a background thread, log_buffer_size 0 to write them directly
+        self._log_buffer_size = log_buffer_size
+        self._log_writer = None
+        self._listen_socket = listen_socket     # already bound socket to use instead of the port
+
+        # request bodies longer than inspection_window bytes are streamed to the server after
+        # filter_request has seen the first inspection_window bytes, 0 to read them completely
+        self._inspection_window = inspection_window
+        # responses are streamed to the client in chunks if filter_response is not overridden,
+        # response_chunk_size 0 to read them completely
+        self._response_chunk_size = response_chunk_size
+        self._stream_responses = (
+            response_chunk_size > 0 and type(self).filter_response is CherryProxy.filter_response)
+
+        # requests with a longer content-length get 413, 0 for no limit
+        self._max_request_body_size = max_request_body_size
+
+        # latency of the request stages, served on metrics_port, 0 to disable
+        self._metrics_port = metrics_port
+        self._histograms = LatencyHistograms() if metrics_port > 0 else None
+        self._metrics_server = None
 
         # thread local variables to store request/response data per thread:
         self.req = threading.local()
         self.resp = threading.local()
 
-        self.server = CherryPyWSGIServer(
-            (self.listen_address, self.listen_port), self._proxy_app)
-        self.log_debug('__init__', 'server.bind_addr: {}'.format(self.server.bind_addr))
-
-    def log(self, s, prefix='### ', req_id=None):
+        # persistent connections to the server, pool_size 0 to open one per request
+        self._pool = None
+        if pool_size > 0:
+            self._pool = ConnectionPool(
+                self.redirect_address, self.redirect_port, pool_size, pool_idle_timeout)
+
+        self.server = self._make_server()
+
+    def _make_server(self):
+        if self._listen_socket:
+            server = InheritedSocketServer(
+                self._listen_socket, (self.listen_address, self.listen_port), self._proxy_app)
+        else:
+            server = CherryPyWSGIServer((self.listen_address, self.listen_port), self._proxy_app)
+        server.gateway = ClosingGateway
+        self.log_debug('__init__', 'server.bind_addr: {}', server.bind_addr)
+        return server
+
+    def log(self, s, *args, prefix='### ', req_id=None):
+        """
+        With 'args', 's' is a format string, only formatted if the message is written.
+        """
         if self._verbosity > 0:
-            if req_id:
-                prefix += '{:06} | '.format(req_id)
-            self._log_stream.write('{}{}\n'.format(prefix, s))
+            record = (prefix, req_id, s, args)
+            log_writer = self._log_writer
+            if not log_writer or not log_writer.put(record):
+                self._log_stream.write(format_record(record))
 
-    def log_debug(self, method_name, s):
+    def log_debug(self, method_name, s, *args):
         if self._verbosity > 1:
-            options = {
-                's': '{:25s} | {}'.format(method_name, s),
-                'prefix': '*** ',
-            }
-            if hasattr(self.req, 'id'):
-                options['req_id'] = self.req.id
-            self.log(**options)
+            if args:
+                s, args = '{:25s} | ' + s, (method_name, ) + args
+            else:
+                s, args = '{:25s} | {}', (method_name, s)     # s is not a format string
+            self.log(s, *args, prefix='*** ', req_id=getattr(self.req, 'id', None))
+
+    def _start_log_writer(self):
+        if self._log_buffer_size > 0 and self._verbosity > 0:
+            self._log_writer = LogWriter(self._log_stream, self._log_buffer_size)
+            self._log_writer.start()
+
+    def _stop_log_writer(self):
+        if self._log_writer:
+            log_writer, self._log_writer = self._log_writer, None
+            log_writer.stop()
 
     def start(self):
-        self.log('Starting proxy to listen on {} and redirect to {}'.format(
-            self.server.bind_addr, (self.redirect_address, self.redirect_port)))
-        self.log('Proxy listening ... (press Ctrl+C to stop)'.format(self.server.bind_addr))
+        self.log('Starting proxy to listen on {} and redirect to {}',
+                 self.server.bind_addr, (self.redirect_address, self.redirect_port))
+        self.log('Proxy listening ... (press Ctrl+C to stop)')
+        self._start_metrics_server()
+        self._start_log_writer()
         self.server.start()
 
     def stop(self):
         self.server.stop()
+        if self._pool:
+            self._pool.close()
+        self._stop_metrics_server()
+        self._stop_log_writer()
         self.log('Proxy stopped.')
 
+    def _start_metrics_server(self):
+        if self._histograms:
+            self._metrics_server = MetricsServer(
+                self.listen_address, self._metrics_port, self.render_metrics)
+            self._metrics_server.start()
+            self.log('Metrics on http://{}:{}/metrics', self.listen_address, self._metrics_port)
+
+    def _stop_metrics_server(self):
+        if self._metrics_server:
+            self._metrics_server.stop()
+            self._metrics_server = None
+
+    def render_metrics(self) -> str:
+        """
+        Stage latency histograms and stats in the Prometheus text format.
+        """
+        line_list = ['waf_proxy_{} {}'.format(k, v) for k, v in sorted(self.get_stats().items())]
+        return self._histograms.render() + '\n'.join(line_list) + '\n'
+
+    def record_time(self, stage: str, t_start: float, t_end=None) -> float:
+        """
+        Adds the time of a stage (see metrics.STAGE_LIST) to the current request.
+        Returns the end time, by default now.
+        """
+        if t_end is None:
+            t_end = time.perf_counter()
+        if self._histograms:
+            self.req.timing_list.append((stage, t_end - t_start))
+        return t_end
+
+    def get_stats(self) -> dict:
+        return {'requests': self._req_id}
+
     def set_response(self, status, reason=None, data=None, content_type='text/plain'):
         """
         Set a HTTP response to be sent to the client instead of the one from the server.
         :param status: int, HTTP status code (see RFC 2616)
         :param reason: str, optional text for the response line, standard text by default
-        :param data: str, optional body for the response, default="status reason"
+        :param data: str or bytes, optional body for the response, default="status reason"
         :param content_type: str, content-type corresponding to data
         :return:
         """
@@ -115,16 +307,25 @@ class CherryProxy:
 
         if not data:
             data = '{} {}'.format(status, reason)
+        if isinstance(data, str):
+            data = data.encode()        # WSGI bodies are bytes
         self.resp.data = data
 
         # reset all headers
         self.resp.headers = []
         self.resp.headers.append(('content-type', content_type))
-        # self.resp.headers.append(('content-length', str(len(data))))
+        self.resp.headers.append(('content-length', str(len(data))))
 
     def set_response_forbidden(self):
         self.set_response(403, reason='Forbidden')
 
+    def request_body_limit(self) -> int:
+        """
+        Method that may be overridden:
+        Max content-length of the current request, 0 for no limit.
+        """
+        return self._max_request_body_size
+
     def filter_request_headers(self):
         """
         Method to be overridden:
@@ -133,7 +334,9 @@ class CherryProxy:
         before it is sent to the server.
 
         This method may call set_response() if the request needs to be blocked
-        before being sent to the server.
+        before being sent to the server; the body of the request is then not read, so
+        self.resp.close_connection should be set to True to close the client connection
+        after the response instead of reading the body to reuse it.
 
         The following attributes can be read and MODIFIED:
             self.req.headers: dictionary of HTTP headers, with lowercase names
@@ -165,6 +368,10 @@ class CherryProxy:
 
         The following attributes can also be read and MODIFIED:
             self.req.data: data sent with the request (POST or PUT)
+
+        The following attributes can be READ only:
+            self.req.is_streamed: True if self.req.data has only the first inspection_window
+                bytes of the body, the rest is sent to the server without reading it here
         """
         pass
 
@@ -204,6 +411,9 @@ class CherryProxy:
 
         The following attributes can be read and MODIFIED:
             self.resp.data: data sent with the response
+
+        If this method is not overridden, the response body is not read completely but
+        streamed to the client in chunks of response_chunk_size bytes.
         """
         pass
 
@@ -219,17 +429,23 @@ class CherryProxy:
         self.log('START', req_id=self.req.id)
 
         self._parse_request(environ)
+        self.record_time('parse', t_start)
 
         # method to be overridden by subclass: filter request headers before reading the body
         self.filter_request_headers()
 
         if not self.resp.status:
+            self._check_request_framing()
+
+        if not self.resp.status:
+            t = time.perf_counter()
             self._read_request_body()
+            self.record_time('body_read', t)
 
             # method to be overridden by subclass: filter request before sending it to the server
             self.filter_request()
 
-        self.log('request {} {}'.format(self.req.method, self.req.url), req_id=self.req.id)
+        self.log('request {} {}', self.req.method, self.req.url, req_id=self.req.id)
 
         if not self.resp.status:
             self._send_request()
@@ -238,23 +454,35 @@ class CherryProxy:
             # method to be overridden by subclass: filter response headers before reading the body
             self.filter_response_headers()
 
+        if not self.resp.data and self._stream_responses:
+            # the connection is released and the response logged when the last chunk is sent
+            self.record_time('upstream_response', self.resp.t_sent)
+            self._send_response(f_start_response)
+            return self._iter_response_body(t_start)
+
         if not self.resp.data:          # here we need to check resp.data
             self._read_response_body()
+            self.record_time('upstream_response', self.resp.t_sent)
 
             # method to be overridden by subclass: filter request before sending it to the client
             self.filter_response()
 
-        # for now we always close the connection, even if the client sends several requests;
-        # this is not optimal performance-wise, but simpler to code
         if self.resp.httpconn:
-            self.resp.httpconn.close()
+            self._release_connection()
 
+        if isinstance(self.resp.data, str):
+            self.resp.data = self.resp.data.encode()
         self._send_response(f_start_response)
+        return self._iter_response_data(t_start)
 
+    def _finish_request(self, t_start):
         t_end = time.perf_counter()
-        self.log('response {} {} in {:5.3f} seconds'.format(
-            self.resp.status, self.resp.reason, t_end - t_start), req_id=self.req.id)
-        return [self.resp.data]
+        self.log('response {} {} in {:5.3f} seconds',
+                 self.resp.status, self.resp.reason, t_end - t_start, req_id=self.req.id)
+        if self._histograms:
+            # only endpoints with a detection model get their own label, to bound their number
+            self._histograms.record(
+                self.req.timing_list, self.req.endpoint or 'other', self.req.verdict)
 
     def _init_request_response(self):
         # set request id (simply increase number at each request)
@@ -274,6 +502,10 @@ class CherryProxy:
         self.req.charset = None
         self.req.length = 0
         self.req.data = None
+        self.req.is_streamed = False
+        self.req.timing_list = []       # (stage, seconds)
+        self.req.endpoint = None        # label of the metrics, set by filters
+        self.req.verdict = 'none'       # label of the metrics, set by filters
 
         # response variables
         self.resp.httpconn = None
@@ -283,12 +515,16 @@ class CherryProxy:
         self.resp.headers = []          # http.client headers is a list of (header, value) tuples
         self.resp.content_type = None
         self.resp.data = None
+        self.resp.t_sent = None
+        self.resp.close_connection = False     # set by filters, e.g. if the body was not read
 
     def _parse_request(self, environ):
         self.req.environ = environ
-        self.log_debug('_parse_request', 'req.environ:')
-        for k, v in sorted(environ.items(), key=lambda x: x[0]):
-            self.log_debug('_parse_request', '   {}: {}'.format(k, v))
+        is_debug = self._verbosity > 1
+        if is_debug:
+            self.log_debug('_parse_request', 'req.environ:')
+            for k, v in sorted(environ.items(), key=lambda x: x[0]):
+                self.log_debug('_parse_request', '   {}: {}', k, v)
 
         # convert WSGI environ to a dict of HTTP headers:
         self.req.headers = {}
@@ -309,25 +545,28 @@ class CherryProxy:
                 self.req.content_type = content_type.strip()
                 ct = self.req.content_type
             self.req.headers['content-type'] = ct
-        self.log_debug('_parse_request', 'req.content_type: {}'.format(self.req.content_type))
-        self.log_debug('_parse_request', 'req.charset: {}'.format(self.req.charset))
+        if is_debug:
+            self.log_debug('_parse_request', 'req.content_type: {}', self.req.content_type)
+            self.log_debug('_parse_request', 'req.charset: {}', self.req.charset)
 
         # content-length is also stored without 'HTTP_'
         self.req.headers['content-length'] = environ.get('CONTENT_LENGTH', 0)
-        self.log_debug('_parse_request', 'req.headers:')
-        for k, v in sorted(self.req.headers.items(), key=lambda x: x[0]):
-            self.log_debug('_parse_request', '   {}: {}'.format(k, v))
+        if is_debug:
+            self.log_debug('_parse_request', 'req.headers:')
+            for k, v in sorted(self.req.headers.items(), key=lambda x: x[0]):
+                self.log_debug('_parse_request', '   {}: {}', k, v)
 
         self.req.method = environ.get('REQUEST_METHOD', None)
         self.req.scheme = environ.get('wsgi.url_scheme', None)      # http
         self.req.path = environ.get('PATH_INFO', None)
         self.req.query = environ.get('QUERY_STRING', None)
         self.req.url = parse.urlunsplit(('', '', self.req.path, self.req.query, ''))
-        self.log_debug('_parse_request', 'req.method: {}'.format(self.req.method))
-        self.log_debug('_parse_request', 'req.scheme: {}'.format(self.req.scheme))
-        self.log_debug('_parse_request', 'req.path: {}'.format(self.req.path))
-        self.log_debug('_parse_request', 'req.query: {}'.format(self.req.query))
-        self.log_debug('_parse_request', 'req.url: {}'.format(self.req.url))
+        if is_debug:
+            self.log_debug('_parse_request', 'req.method: {}', self.req.method)
+            self.log_debug('_parse_request', 'req.scheme: {}', self.req.scheme)
+            self.log_debug('_parse_request', 'req.path: {}', self.req.path)
+            self.log_debug('_parse_request', 'req.query: {}', self.req.query)
+            self.log_debug('_parse_request', 'req.url: {}', self.req.url)
 
         if self.req.method not in ALLOWED_METHODS:
             # here I use 501 "not implemented" rather than 405 or 401, because it seems to be the
@@ -342,6 +581,26 @@ class CherryProxy:
             self.set_response(501, reason=msg)
             self.log_debug('_parse_request', msg)
 
+    def _check_request_framing(self):
+        """
+        Calls set_response() if the request body can not be read safely: a transfer-encoding
+        (a chunked body is not parsed, and with a content-length too the request could be
+        smuggled), an invalid content-length, or one above request_body_limit().
+        The body is then not read, so the client connection is closed after the response.
+        """
+        environ = self.req.environ
+        value = environ.get('CONTENT_LENGTH') or '0'
+        if 'HTTP_TRANSFER_ENCODING' in environ:
+            self.set_response(411)
+        elif not _DIGITS_RE.match(value):
+            self.set_response(400)
+        elif 0 < self.request_body_limit() < int(value):
+            self.set_response(413)
+        else:
+            return
+        self.log_debug('_check_request_framing', 'request rejected: {}', self.resp.status)
+        self.resp.close_connection = True
+
     def _read_request_body(self):
         try:
             length = int(self.req.environ.get('CONTENT_LENGTH', 0))
@@ -352,9 +611,14 @@ class CherryProxy:
             self.req.length = length
             input_ = self.req.environ.get('wsgi.input')
             if input_:
-                self.req.data = input_.read(self.req.length)
-                self.log_debug('_read_request_body', 'req.length: {}'.format(self.req.length))
-                self.log_debug('_read_request_body', 'req.data: {} b'.format(len(self.req.data)))
+                if 0 < self._inspection_window < length:
+                    self.req.is_streamed = True
+                    self.req.data = input_.read(self._inspection_window)
+                else:
+                    self.req.data = input_.read(self.req.length)
+                self.log_debug('_read_request_body', 'req.length: {}', self.req.length)
+                self.log_debug('_read_request_body', 'req.data: {} b, streamed {}',
+                               len(self.req.data), self.req.is_streamed)
                 return
 
         self.log_debug('_read_request_body', 'No request body')
@@ -364,37 +628,127 @@ class CherryProxy:
 
         # forward a request received from a client to the server.
         # TO DO: handle connection errors
-        self.resp.httpconn = client.HTTPConnection(self.redirect_address, self.redirect_port)
-        self.log_debug('_send_request', 'initialized connection')
+        # the connection headers of the client are not forwarded, the server connection is ours
+        headers = dict(
+            (k, v) for k, v in self.req.headers.items() if k not in HOP_BY_HOP_HEADERS)
+        body = self.req.data
+        use_pool = self._pool is not None
+        if self.req.is_streamed:
+            body = self._iter_request_body()
+            headers['content-length'] = str(
+                len(self.req.data) + self.req.length - self._inspection_window)
+            # a streamed body can not be sent again if a reused connection turns out to be stale
+            use_pool = False
+        else:
+            # the body may have been modified by filter_request
+            headers['content-length'] = str(len(body) if body else 0)
 
-        self.resp.httpconn.request(
-            self.req.method, self.req.url, body=self.req.data, headers=self.req.headers)
-        self.log_debug('_send_request', 'made request')
-
-        # Get the response (but not the response body yet).
-        self.resp.response = self.resp.httpconn.getresponse()
-        self.log_debug('_send_request', 'got response')
+        t_start = time.perf_counter()
+        while True:
+            if use_pool:
+                self.resp.httpconn, is_reused = self._pool.get()
+            else:
+                self.resp.httpconn = client.HTTPConnection(
+                    self.redirect_address, self.redirect_port)
+                is_reused = False
+            self.log_debug('_send_request', 'initialized connection, reused {}', is_reused)
+
+            try:
+                self.resp.httpconn.request(
+                    self.req.method, self.req.url, body=body, headers=headers)
+                self.log_debug('_send_request', 'made request')
+                t_sent = time.perf_counter()
+
+                # Get the response (but not the response body yet).
+                self.resp.response = self.resp.httpconn.getresponse()
+                self.log_debug('_send_request', 'got response')
+                self.resp.t_sent = self.record_time('upstream_send', t_start, t_sent)
+                return
+            except (client.HTTPException, OSError) as err:
+                self.resp.httpconn.close()
+                if not is_reused or self.req.method not in RETRY_METHODS:
+                    raise
+                # the server closed the idle connection, retry with another one
+                self.log_debug('_send_request', 'stale connection: {}', err)
+
+    def _iter_request_body(self):
+        # the inspected part (maybe modified by filter_request), then the rest of the input
+        yield self.req.data
+        input_ = self.req.environ['wsgi.input']
+        remaining = self.req.length - self._inspection_window
+        while remaining > 0:
+            chunk = input_.read(min(remaining, 65536))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    def _release_connection(self):
+        # the connection can only be reused if the response was read completely
+        response = self.resp.response
+        if (self._pool and response is not None and response.isclosed() and
+                not response.will_close):
+            self._pool.put(self.resp.httpconn)
+        else:
+            self.resp.httpconn.close()
+        self.resp.httpconn = None
 
     def _parse_response(self):
         self.resp.status = self.resp.response.status
         self.resp.reason = self.resp.response.reason
-        self.log_debug('_parse_response', 'resp: {} {}'.format(self.resp.status, self.resp.reason))
+        self.log_debug('_parse_response', 'resp: {} {}', self.resp.status, self.resp.reason)
 
         self.resp.headers = self.resp.response.getheaders()
-        self.log_debug('_parse_response', 'resp.headers:')
-        for e in sorted(self.resp.headers):
-            self.log_debug('_parse_response', '   {}: {}'.format(e[0], e[1]))
+        if self._verbosity > 1:
+            self.log_debug('_parse_response', 'resp.headers:')
+            for e in sorted(self.resp.headers):
+                self.log_debug('_parse_response', '   {}: {}', e[0], e[1])
 
         self.resp.content_type = self.resp.response.msg.get_content_type().lower()
-        self.log_debug('_parse_response', 'resp.content_type: {}'.format(self.resp.content_type))
+        self.log_debug('_parse_response', 'resp.content_type: {}', self.resp.content_type)
 
     def _read_response_body(self):
         # TO DO: check content-length?
         self.resp.data = self.resp.response.read()
-        self.log_debug('_read_response_body', 'resp.data: {} b'.format(len(self.resp.data)))
+        self.log_debug('_read_response_body', 'resp.data: {} b', len(self.resp.data))
+
+    def _iter_response_body(self, t_start):
+        # iterated by the server in the thread of the request, so self.resp is still this one
+        n_bytes = 0
+        t = time.perf_counter()
+        try:
+            while True:
+                chunk = self.resp.response.read(self._response_chunk_size)
+                if not chunk:
+                    break
+                n_bytes += len(chunk)
+                yield chunk
+        finally:
+            self._release_connection()
+            self.log_debug('_iter_response_body', 'resp.data: {} b streamed', n_bytes)
+            self.record_time('response_write', t)     # with the reading of the server response
+            self._finish_request(t_start)
+
+    def _iter_response_data(self, t_start):
+        # same as _iter_response_body, for a response read completely
+        t = time.perf_counter()
+        try:
+            yield self.resp.data
+        finally:
+            self.record_time('response_write', t)
+            self._finish_request(t_start)
 
     def _send_response(self, f_start_response):
         # Send the response with headers (but no body yet).
+        # The server keeps the client connection alive if the response has a content-length
+        # (or it can use chunked encoding), so the connection headers of the server are removed
+        # and the content-length of a read body is set to the length of the data actually sent.
         status = '{} {}'.format(self.resp.status, self.resp.reason)
-        f_start_response(status, self.resp.headers)
-        self.log_debug('_send_response', 'status: {}'.format(status))
+        headers = [(k, v) for k, v in self.resp.headers if k.lower() not in HOP_BY_HOP_HEADERS]
+        if self.resp.data is not None and self.req.method != 'HEAD':
+            headers = [(k, v) for k, v in headers if k.lower() != 'content-length']
+            headers.append(('content-length', str(len(self.resp.data))))
+        if self.resp.close_connection:
+            headers.append(('connection', 'close'))
+        f_start_response(status, headers)
+        self.log_debug('_send_response', 'status: {}', status)
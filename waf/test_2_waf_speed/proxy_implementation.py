@@ -5,17 +5,25 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import functools
 import pickle
 import requests
+import threading
 import time
 import sys
 from sklearn.model_selection import train_test_split
-from sklearn.pipeline import make_pipeline, make_union
+from sklearn.pipeline import Pipeline, make_pipeline, make_union
 from sklearn.svm import OneClassSVM
-from typing import List
+from typing import Callable, Dict, List, Tuple
+from . import prefork, registry, routing, verdict_cache
+from .admission import AdmissionController
+from .async_proxy import AsyncCherryProxy
 from .base import TEST_CONFIG
+from .batching import MicroBatchScorer
+from .monitoring import AsyncMonitor
 from .proxy import CherryProxy
-from .. import data_sets, feature_extraction
+from .retraining import RetrainingWorker
+from .. import classification, data_sets, feature_extraction
 
 
 TF_LIST = tuple(
@@ -26,19 +34,157 @@ RANDOM_STATE = 2
 TRAIN_SIZE = 500
 NU = 0.01
 GAMMA = 0.01
+# headers added by the source process only for this test, not seen by the detection models
+TEST_HEADER_LIST = ('x-proxy-test-ds-url', 'x-proxy-test-req-class', 'x-proxy-test-req-n')
+# checks of the header phase, before the request body is read
+HEADER_REJECT_LIST = ('unknown_endpoint', ) + classification.header_filter.REASON_LIST
+# requests with a body that could not be scored completely
+UNSCORED_LIST = (
+    'undecodable_body',     # not UTF-8
+    'body_past_window',     # only its first inspection window was read and scored
+)
 
 
-class FilteringProxy(CherryProxy):
+def build_request(method: str, path: str, headers: Dict[str, str], query: str,
+                  body: str) -> data_sets.Request:
+    """
+    Request object with the parts of a request received by the proxy, as seen by the models.
+    """
+    req = data_sets.Request(method=method, url=path)
+    req._headers = dict(headers)
+    req.query_params = query
+    if body:
+        req.body_params = body
+
+    # remove headers that are there only for this test
+    for h in TEST_HEADER_LIST:
+        req.headers.pop(h, None)
+    return req
+
+
+def _decode_body(data: bytes, is_streamed: bool):
+    """
+    Returns the body as str, None if it is not UTF-8.
+    """
+    if not data:
+        return ''
+    try:
+        return data.decode()
+    except UnicodeDecodeError as err:
+        # a character cut at the end of the inspection window, the bytes before it are valid
+        if is_streamed and err.start >= len(data) - 3:
+            return data[:err.start].decode()
+        return None
+
+
+def _join_counts(counts: Dict[str, int]) -> str:
+    return ' | '.join('{} {}'.format(k, v) for k, v in sorted(counts.items()))
+
+
+def fit_model(train_list: List[data_sets.Request]):
+    clf = make_pipeline(
+        make_union(*[class_() for class_ in TF_LIST]),
+        *classification.make_steps(
+            TEST_CONFIG['DETECTOR'], random_state=0, nu=NU, gamma=GAMMA))
+    if TEST_CONFIG['USE_CASCADE']:
+        clf = classification.CascadeDetector(
+            classification.EnvelopeFilter(quantile=TEST_CONFIG['CASCADE_QUANTILE']), clf)
+    clf.fit(train_list)
+    return clf
+
+
+def fit_model_with_meta(train_list: List[data_sets.Request]) -> Tuple[object, Dict]:
+    """
+    Fits the detection model and the header filter of one endpoint.
+    Returns the fitted model and its metadata for the model registry.
+    """
+    clf = fit_model(train_list)
+    pipeline = clf.detector if isinstance(clf, classification.CascadeDetector) else clf
+    header_filter = classification.HeaderFilter().fit(train_list)
+
+    meta = {
+        'key': str(train_list[0]),
+        'train_size': len(train_list),
+        'detector': TEST_CONFIG['DETECTOR'],
+        'nu': NU,
+        'gamma': GAMMA,
+        'cascade': pipeline is not clf,
+        'feature_list': pipeline.steps[0][1].get_feature_names(),
+        'header_filter': header_filter.to_dict(),
+    }
+    return clf, meta
+
+
+def train_model(normal_list: List[data_sets.Request]) -> Tuple[object, Dict]:
+    """
+    Fits the detection model of one endpoint with its training split.
+    Returns the fitted pipeline and its metadata for the model registry.
+    """
+    train_list, _ = train_test_split(
+        normal_list,
+        random_state=RANDOM_STATE,
+        train_size=TRAIN_SIZE)
+    return fit_model_with_meta(train_list)
+
+
+def check_meta(meta: Dict):
+    """
+    Raises ValueError if a model of the registry was trained with other settings than the
+    current ones, so that it is trained again instead of being used.
+    """
+    expected = {
+        'detector': TEST_CONFIG['DETECTOR'],
+        'nu': NU,
+        'gamma': GAMMA,
+        'cascade': TEST_CONFIG['USE_CASCADE'],
+    }
+    for name, value in sorted(expected.items()):
+        if meta.get(name) != value:
+            raise ValueError('trained with {} {!r}, expected {!r}'.format(
+                name, meta.get(name), value))
+
+    if TEST_CONFIG['HEADER_PHASE'] and 'header_filter' not in meta:
+        raise ValueError('trained without header filter')
+
+
+class FilteringMixin:
+    """
+    Detection of anomalous requests, for any of the proxy engines.
+    """
 
     def __init__(self, do_detection, do_blocking, **kwargs):
         super().__init__(**kwargs)
         self._do_detection = do_detection
         self._do_blocking = do_blocking
         self._detection_models = {}
+        self._fallback_models = {}
+        self._header_filters = {}
+        self._route_table = None
+        self._header_counts = dict((name, 0) for name in HEADER_REJECT_LIST)
+        self._unscored_counts = dict((name, 0) for name in UNSCORED_LIST)
+        self._lock_counts = threading.Lock()
+        self._are_models_loaded = False
+        self._lock_detection_models = threading.Lock()
+        self._retraining_worker = None
+        self._batch_scorer = None
+        if TEST_CONFIG['BATCH_SCORING']:
+            self._batch_scorer = MicroBatchScorer(
+                max_batch_size=TEST_CONFIG['BATCH_MAX_SIZE'],
+                max_wait_us=TEST_CONFIG['BATCH_MAX_WAIT_US'])
+        self._monitor = None
+        self._verdict_cache = None
+        if TEST_CONFIG['VERDICT_CACHE_SIZE'] > 0:
+            self._verdict_cache = verdict_cache.VerdictCache(
+                max_size=TEST_CONFIG['VERDICT_CACHE_SIZE'],
+                ttl=TEST_CONFIG['VERDICT_CACHE_TTL'])
+        self._admission = None
+        if TEST_CONFIG['ADMISSION_CONTROL']:
+            self._admission = AdmissionController(
+                max_concurrency=TEST_CONFIG['SCORING_MAX_CONCURRENCY'],
+                deadline_ms=TEST_CONFIG['SCORING_DEADLINE_MS'])
 
     def _get_from_data_server(self, ds_url: str, req_class: str) -> List[data_sets.Request]:
-        self.log_debug('_get_from_data_server', 'ds_url {} | req_class {}'.format(
-            ds_url, req_class))
+        self.log_debug('_get_from_data_server', 'ds_url {} | req_class {}', ds_url, req_class)
 
         t_start = time.perf_counter()
 
@@ -55,8 +201,8 @@ class FilteringProxy(CherryProxy):
 
         t_end = time.perf_counter()
 
-        self.log_debug('_get_from_data_server', 'response code {} in {:5.3f} seconds'.format(
-            resp.status_code, t_end - t_start))
+        self.log_debug('_get_from_data_server', 'response code {} in {:5.3f} seconds',
+                       resp.status_code, t_end - t_start)
 
         if not resp.ok:
             raise ValueError('status_code {}'.format(resp.status_code))
@@ -69,75 +215,498 @@ class FilteringProxy(CherryProxy):
 
     def _load_detection_models(self):
         self._detection_models = {}
+        self._fallback_models = {}
+        self._header_filters = {}
 
         for ds_url in data_sets.DS_URL_LIST[TEST_CONFIG['DS_URL_SLICE']]:
+            if TEST_CONFIG['USE_MODEL_REGISTRY']:
+                try:
+                    clf, meta = registry.load(ds_url)
+                    check_meta(meta)
+                    self._add_detection_model(meta['key'], clf)
+                    self._add_header_filter(meta['key'], meta)
+                    self.log_debug('_load_detection_models', 'loaded "{}" version {}',
+                                   meta['key'], meta['version'])
+                    continue
+                except KeyError as err:
+                    self.log_debug('_load_detection_models', 'not from registry "{}": {}',
+                                   ds_url, err)
+                except ValueError as err:
+                    self.log('Model of "{}" in the registry not used, training it: {}',
+                             ds_url, err)
+
             try:
                 normal_list = self._get_from_data_server(ds_url, 'n')
             except ValueError as err:
-                self.log_debug('_load_detection_models', 'could not get req_list "{}": {}'.format(
-                    ds_url, err))
+                self.log_debug('_load_detection_models', 'could not get req_list "{}": {}',
+                               ds_url, err)
                 return
 
-            train_list, _ = train_test_split(
-                normal_list,
-                random_state=RANDOM_STATE,
-                train_size=TRAIN_SIZE)
+            clf, meta = train_model(normal_list)
+            self._add_detection_model(meta['key'], clf)
+            self._add_header_filter(meta['key'], meta)
+            self.log_debug('_load_detection_models', 'trained "{}"', meta['key'])
+
+    def _reduce_model(self, clf: Pipeline) -> Pipeline:
+        budget = TEST_CONFIG['SV_BUDGET']
+        svm = clf.steps[-1][1]
+        if not isinstance(svm, OneClassSVM) or svm.support_vectors_.shape[0] <= budget:
+            return clf
+
+        try:
+            reduced_clf = classification.compress_pipeline(clf, budget, random_state=0)
+        except ValueError as err:
+            self.log_debug('_reduce_model', 'can not reduce: {}', err)
+            return clf
+
+        # the support vectors are the samples closest to the decision boundary
+        reduced_svm = reduced_clf.steps[-1][1]
+        agreement, t_original, t_reduced = classification.compare(
+            svm, reduced_svm, svm.support_vectors_)
+        self.log('Reduced support vectors {} -> {} | agreement {:5.3f} | '
+                 '{:6.4f} -> {:6.4f} ms/req',
+                 svm.support_vectors_.shape[0], reduced_svm.support_vectors_.shape[0],
+                 agreement, t_original, t_reduced)
+        return reduced_clf
+
+    def _prepare_model(self, clf):
+        if isinstance(clf, classification.CascadeDetector):
+            return classification.CascadeDetector(clf.envelope, self._prepare_model(clf.detector))
+
+        if TEST_CONFIG['SV_BUDGET'] > 0:
+            clf = self._reduce_model(clf)
+        if TEST_CONFIG['USE_COMPILED_SCORER']:
+            try:
+                return classification.CompiledScorer(clf)
+            except ValueError as err:
+                self.log_debug('_prepare_model', 'using pipeline, can not compile: {}', err)
+        return clf
 
-            clf = make_pipeline(
-                make_union(*[class_() for class_ in TF_LIST]),
-                OneClassSVM(random_state=0, nu=NU, gamma=GAMMA))
-            clf.fit(train_list)
+    def _prepare_fallback_model(self, clf):
+        # smaller model for when there is no time to score with the full one
+        if not self._admission or TEST_CONFIG['ADMISSION_FALLBACK'] != 'model':
+            return None
 
-            key = str(normal_list[0])
-            self._detection_models[key] = clf
-            self.log_debug('_load_detection_models', 'loaded "{}"'.format(key))
+        envelope = None
+        if isinstance(clf, classification.CascadeDetector):
+            envelope, clf = clf.envelope, clf.detector
+
+        try:
+            fallback = classification.compress_pipeline(
+                clf, TEST_CONFIG['FALLBACK_SV_BUDGET'], random_state=0)
+        except ValueError as err:
+            self.log_debug('_prepare_fallback_model', 'no fallback model: {}', err)
+            return None
+
+        fallback = self._prepare_model(fallback)
+        if envelope:
+            fallback = classification.CascadeDetector(envelope, fallback)
+        return fallback
+
+    def _add_detection_model(self, key: str, clf):
+        self._detection_models[key] = self._prepare_model(clf)
+        self._fallback_models[key] = self._prepare_fallback_model(clf)
+
+    @staticmethod
+    def _make_header_filter(meta: Dict):
+        if not TEST_CONFIG['HEADER_PHASE']:
+            return None
+        return classification.HeaderFilter.from_dict(
+            meta['header_filter'],
+            length_factor=TEST_CONFIG['HEADER_LENGTH_FACTOR'],
+            max_unknown_headers=TEST_CONFIG['HEADER_MAX_UNKNOWN'])
+
+    def _add_header_filter(self, key: str, meta: Dict):
+        header_filter = self._make_header_filter(meta)
+        if header_filter:
+            self._header_filters[key] = header_filter
+
+    def _swap_detection_model(self, key: str, clf, meta: Dict):
+        fallback = self._prepare_fallback_model(clf)
+        clf = self._prepare_model(clf)
+        header_filter = self._make_header_filter(meta)
+
+        # the request threads always see a complete dict, either the old or the new one;
+        # the header filter is fitted with the same requests, so it is replaced with the model
+        with self._lock_detection_models:
+            detection_models = dict(self._detection_models)
+            detection_models[key] = clf
+            self._detection_models = detection_models
+            fallback_models = dict(self._fallback_models)
+            fallback_models[key] = fallback
+            self._fallback_models = fallback_models
+            if header_filter:
+                header_filters = dict(self._header_filters)
+                header_filters[key] = header_filter
+                self._header_filters = header_filters
+
+        # after the swap, so verdicts of the old model stored later are also discarded
+        if self._verdict_cache:
+            self._verdict_cache.invalidate(key)
+
+    def load_detection_models(self):
+        """
+        Called by start(), or before it to share the loaded models with forked processes.
+        """
+        self.log('Loading {} detection models ...',
+                 len(data_sets.DS_URL_LIST[TEST_CONFIG['DS_URL_SLICE']]))
+        t_start = time.perf_counter()
+        self._load_detection_models()
+        if TEST_CONFIG['ROUTE_MATCHING']:
+            self._route_table = routing.RouteTable.from_keys(
+                self._detection_models, infer_templates=TEST_CONFIG['ROUTE_TEMPLATES'])
+        t_end = time.perf_counter()
+        self._are_models_loaded = True
+        self.log('{} detection models loaded in {:5.3f} seconds.',
+                 len(self._detection_models), t_end - t_start)
+
+    def get_stats(self) -> Dict[str, int]:
+        stats = super().get_stats()
+        for name, obj in (
+                ('monitor', self._monitor),
+                ('admission', self._admission),
+                ('verdict_cache', self._verdict_cache),
+        ):
+            if obj:
+                for k, v in obj.get_counts().items():
+                    stats['{}_{}'.format(name, k)] = v
+        if self._header_filters:
+            for k, v in self._header_counts.items():
+                stats['header_phase_{}'.format(k)] = v
+        for k, v in self._unscored_counts.items():
+            stats['unscored_{}'.format(k)] = v
+        return stats
 
     def start(self):
+        if self._do_detection and TEST_CONFIG['RETRAIN_INTERVAL'] > 0:
+            self._retraining_worker = RetrainingWorker(
+                interval=TEST_CONFIG['RETRAIN_INTERVAL'],
+                reservoir_size=TEST_CONFIG['RETRAIN_RESERVOIR_SIZE'],
+                min_samples=TEST_CONFIG['RETRAIN_MIN_SAMPLES'],
+                fit_func=fit_model_with_meta,
+                swap_func=self._swap_detection_model,
+                log_func=self.log_debug)
+
+        if self._do_detection and not self._do_blocking and TEST_CONFIG['ASYNC_MONITOR']:
+            self._monitor = AsyncMonitor(
+                n_workers=TEST_CONFIG['MONITOR_WORKERS'],
+                queue_size=TEST_CONFIG['MONITOR_QUEUE_SIZE'],
+                score_func=self._score_monitored,
+                log_func=self.log_debug)
+
         if self._do_detection:
-            self.log('Loading {} detection models ...'.format(
-                len(data_sets.DS_URL_LIST[TEST_CONFIG['DS_URL_SLICE']])))
-            self._load_detection_models()
-            self.log('{} detection models loaded.'.format(len(self._detection_models)))
+            if not self._are_models_loaded:
+                self.load_detection_models()
         else:
             self.log('Filtering is OFF.')
 
+        if self._retraining_worker:
+            self._retraining_worker.start()
+            self.log('Retraining models every {} seconds.', TEST_CONFIG['RETRAIN_INTERVAL'])
+
+        if self._monitor:
+            self._monitor.start()
+            self.log('Monitor mode: scoring asynchronously with {} workers.',
+                     TEST_CONFIG['MONITOR_WORKERS'])
+
         super().start()
 
-    def filter_request(self):
+    def stop(self):
+        if self._retraining_worker:
+            self._retraining_worker.stop()
+        if self._monitor:
+            self._monitor.stop()
+            self.log('Monitor: {}', _join_counts(self._monitor.get_counts()))
+        if self._admission:
+            self.log('Admission: {}', _join_counts(self._admission.get_counts()))
+        if self._header_filters:
+            self.log('Header phase: {}', _join_counts(self._header_counts))
+        self.log('Unscored: {}', _join_counts(self._unscored_counts))
+        if self._verdict_cache:
+            self.log('Verdict cache: {}', _join_counts(self._verdict_cache.get_counts()))
+        super().stop()
+
+    def _score(self, key: str, clf, obt_req: data_sets.Request) -> Tuple[int, int]:
+        """
+        Returns the prediction for the request and the detection stage that decided it.
+        """
+        stage = 2
+        if isinstance(clf, classification.CascadeDetector):
+            if clf.envelope.accepts(obt_req):
+                stage = 1
+            clf = clf.detector
+
+        if stage == 1:
+            y = 1
+        elif self._batch_scorer:
+            y = self._batch_scorer.predict(key, clf, obt_req)
+        else:
+            y = clf.predict(obt_req)[0]
+
+        if y == 1 and self._retraining_worker:
+            self._retraining_worker.add(key, obt_req)
+
+        return y, stage
+
+    def _score_admitted(self, key: str, clf, make_request: Callable) -> Tuple[int, int]:
+        """
+        Same as '_score', but with admission control: requests that can not be scored in
+        time are scored by the fallback model (stage 4), if one of its slots is free, or
+        pass without scoring (stage 5). The Request object is only built by 'make_request'
+        for the requests that are scored.
+        """
+        t_start = time.perf_counter()
+        if self._admission.admit(key, t_start):
+            try:
+                t_scoring = time.perf_counter()
+                return self._score(key, clf, make_request())
+            finally:
+                self._admission.release(key, t_start, time.perf_counter() - t_scoring)
+
+        fallback = self._fallback_models.get(key)
+        if fallback is not None and self._admission.admit_fallback():
+            try:
+                self._admission.count('degraded')
+                return fallback.predict(make_request())[0], 4
+            finally:
+                self._admission.release_fallback()
+
+        self._admission.count('shed')
+        self.log_debug('_score_admitted', 'request not scored')
+        return 1, 5
+
+    def _score_monitored(self, key: str, clf, method: str, path: str, headers: Dict[str, str],
+                         query: str, data: bytes, is_streamed: bool, fp=None,
+                         generation=0) -> int:
+        # the parts of the request are decoded and parsed here, not in the request thread
+        body = _decode_body(data, is_streamed)
+        if body is None:
+            self._count_unscored('undecodable_body', key)
+            return 1
+        if is_streamed:
+            self._count_unscored('body_past_window', key)
+
+        obt_req = build_request(method, path, headers, query, body)
+        y, _ = self._score(key, clf, obt_req)
+        if fp is not None:
+            self._verdict_cache.put(key, fp, y, generation)
+        if y == -1:
+            self.log('monitor: anomalous request {}', key)
+        return y
+
+    def _add_stage_header(self):
+        # for use in the source process:
+        # 0 no detection, 1 envelope, 2 detection model, 3 scored asynchronously,
+        # 4 fallback model, 5 not scored, 6 verdict cache, 7 header phase,
+        # 8 body not scored completely
+        self.resp.headers.append(('x-proxy-test-stage', str(self.req.detection_stage)))
+
+    def _find_endpoint(self, method: str, path: str):
+        """
+        Returns the key of the detection model for the request, None if there is none.
+        """
+        key = '{} {}'.format(method, path)      # same as str(obt_req)
+        if key in self._detection_models:
+            return key
+        if self._route_table:
+            return self._route_table.match(method, path)
+        return None
+
+    def filter_request_headers(self):
+        self.req.detection_stage = 0
+
         if not self._do_detection:
-            self.log_debug('filter_request', 'filtering is OFF')
             return
 
-        # build obtained Request object
-        obt_req = data_sets.Request(method=self.req.method, url=self.req.path)
-        obt_req._headers = dict(self.req.headers)
-        obt_req.query_params = self.req.query
-        if self.req.data:
-            obt_req.body_params = self.req.data.decode()
+        # only endpoints with a detection model get their own label in the metrics
+        key = self._find_endpoint(self.req.method, self.req.path)
+        self.req.endpoint = key
+
+        if not TEST_CONFIG['HEADER_PHASE']:
+            return
+
+        if key is None:
+            if TEST_CONFIG['REJECT_UNKNOWN_ENDPOINTS']:
+                self._reject_headers(
+                    '{} {}'.format(self.req.method, self.req.path), 'unknown_endpoint', 404)
+            return
+
+        header_filter = self._header_filters.get(key)
+        if header_filter is None:
+            return
+
+        try:
+            length = int(self.req.headers.get('content-length') or 0)
+        except ValueError:
+            self._reject_headers(key, 'malformed_header', 400)
+            return
+
+        reason = header_filter.check(self.req.headers, length, TEST_HEADER_LIST)
+        if reason:
+            self._reject_headers(key, reason, 413 if reason == 'length' else 403)
+
+    def request_body_limit(self) -> int:
+        limit = super().request_body_limit()
+        header_filter = self._header_filters.get(self.req.endpoint)
+        # with blocking OFF a longer body is only counted and logged, by _reject_headers
+        if self._do_blocking and TEST_CONFIG['HEADER_PHASE'] and header_filter is not None:
+            limit = min(limit, header_filter.length_limit) if limit else header_filter.length_limit
+        return limit
+
+    def _reject_headers(self, key: str, reason: str, status: int):
+        with self._lock_counts:
+            self._header_counts[reason] += 1
 
-        # remove headers that are there only for this test
-        obt_req.headers.pop('x-proxy-test-ds-url', None)
-        obt_req.headers.pop('x-proxy-test-req-class', None)
-        obt_req.headers.pop('x-proxy-test-req-n', None)
+        if self._do_blocking:
+            # the body is not read, so the client connection can not be reused
+            self.log_debug('filter_request_headers', 'request blocked: {}', reason)
+            self.req.verdict = 'anomalous'
+            self.req.detection_stage = 7
+            self.set_response(status)
+            self.resp.close_connection = True
+            self._add_stage_header()
+        else:
+            self.log('header phase: {} for {}', reason, key)
 
-        key = str(obt_req)
-        self.log_debug('filter_request', 'do filtering for key "{}"'.format(key))
+    def filter_request(self):
+        if not self._do_detection:
+            self.log_debug('filter_request', 'filtering is OFF')
+            return
 
-        if key not in self._detection_models:
+        key = self.req.endpoint         # found by filter_request_headers
+        if key is None:
             # let the request pass, no blocking because there is no detection model
             self.log_debug('filter_request', 'no detection model found')
             return
 
+        fp = None
+        generation = 0
+        if self._verdict_cache:
+            # before building the Request object, which is not needed for a cached verdict
+            fp = verdict_cache.fingerprint(
+                self.req.method, self.req.path, self.req.query, self.req.data,
+                self.req.headers, TEST_HEADER_LIST)
+            y = self._verdict_cache.get(key, fp)
+            if y is not None:
+                self.log_debug('filter_request', 'cached prediction {}', y)
+                self.req.detection_stage = 6
+                self._apply_prediction(y)
+                return
+            generation = self._verdict_cache.generation(key)
+
+        self.log_debug('filter_request', 'do filtering for key "{}"', key)
+
         clf = self._detection_models[key]
-        y = clf.predict(obt_req)
-        self.log_debug('filter_request', 'prediction {}'.format(y))
 
-        if y[0] == -1:
+        if self._monitor:
+            # forward the request now, the verdict is only logged
+            self.req.detection_stage = 3
+            self._monitor.submit(
+                key, clf, self.req.method, self.req.path, dict(self.req.headers),
+                self.req.query, self.req.data, self.req.is_streamed, fp, generation)
+            return
+
+        t = time.perf_counter()
+        body = _decode_body(self.req.data, self.req.is_streamed)
+        if body is None:
+            self._reject_unscored('undecodable_body', 400)
+            return
+        if self.req.is_streamed:
+            # the window is scored, with its last parameter as it is; see _apply_prediction
+            self._count_unscored('body_past_window', key)
+
+        if self._can_score_directly(clf):
+            # the test headers are not keys of any model, so they are ignored like unknown keys
+            dicts = {
+                'headers': self.req.headers,
+                'query_params': data_sets.parse_params(self.req.query),
+                'body_params': data_sets.parse_params(body),
+            }
+            t = self.record_time('features', t)
+            y = clf.predict_dicts(dicts)
+            self.record_time('scoring', t)
+            self.req.detection_stage = 2
+            self.log_debug('filter_request', 'prediction {} (direct)', y)
+            if fp is not None:
+                self._verdict_cache.put(key, fp, y, generation)
+            self._apply_prediction(y)
+            return
+
+        if self._admission:
+            # the time to build the Request object is part of the scoring time here
+            make_request = functools.partial(
+                build_request, self.req.method, self.req.path, self.req.headers,
+                self.req.query, body)
+            y, self.req.detection_stage = self._score_admitted(key, clf, make_request)
+            if self.req.detection_stage != 5:
+                self.record_time('scoring', t)
+        else:
+            obt_req = build_request(
+                self.req.method, self.req.path, self.req.headers, self.req.query, body)
+            t = self.record_time('features', t)
+            y, self.req.detection_stage = self._score(key, clf, obt_req)
+            self.record_time('scoring', t)
+        self.log_debug('filter_request', 'prediction {}', y)
+
+        # verdicts of the fallback model or without scoring are not cached
+        if fp is not None and self.req.detection_stage in (1, 2):
+            self._verdict_cache.put(key, fp, y, generation)
+
+        self._apply_prediction(y)
+
+    def _can_score_directly(self, clf) -> bool:
+        # the other options need the Request object
+        return (TEST_CONFIG['DIRECT_FEATURES'] and
+                isinstance(clf, classification.CompiledScorer) and
+                not (self._monitor or self._admission or self._batch_scorer or
+                     self._retraining_worker))
+
+    def _apply_prediction(self, y: int):
+        self.req.verdict = 'normal' if y == 1 else 'anomalous'
+        if y == -1:
             if self._do_blocking:
                 self.log_debug('filter_request', 'request blocked')
                 self.set_response_forbidden()
+                if self.req.is_streamed:
+                    # the rest of the body is still in the client connection
+                    self.resp.close_connection = True
+                self._add_stage_header()
             else:
                 self.log_debug('filter_request', 'blocking is OFF')
+        elif self.req.is_streamed and self._do_blocking and TEST_CONFIG['BLOCK_UNINSPECTED']:
+            # the rest of the body could hide a payload that was never scored
+            self.set_response(413)
+            self.resp.close_connection = True
+            self.req.detection_stage = 8
+            self._add_stage_header()
+
+    def _count_unscored(self, reason: str, key: str):
+        with self._lock_counts:
+            self._unscored_counts[reason] += 1
+        if not self._do_blocking:
+            self.log('not scored completely: {} for {}', reason, key)
+
+    def _reject_unscored(self, reason: str, status: int):
+        self._count_unscored(reason, self.req.endpoint)
+        if self._do_blocking:
+            self.log_debug('filter_request', 'request blocked: {}', reason)
+            self.req.verdict = 'anomalous'
+            self.req.detection_stage = 8
+            self.set_response(status)
+            if self.req.is_streamed:
+                self.resp.close_connection = True
+            self._add_stage_header()
+
+    def filter_response_headers(self):
+        self._add_stage_header()
+
+
+class FilteringProxy(FilteringMixin, CherryProxy):
+    pass
+
+
+class AsyncFilteringProxy(FilteringMixin, AsyncCherryProxy):
+    pass
 
 
 def run():
@@ -147,10 +716,35 @@ def run():
         'redirect_address': TEST_CONFIG['DESTINATION_ADDRESS'],
         'redirect_port': TEST_CONFIG['DESTINATION_PORT'],
         'verbosity': TEST_CONFIG['PROXY_VERBOSITY'],
+        'pool_size': TEST_CONFIG['UPSTREAM_POOL_SIZE'],
+        'pool_idle_timeout': TEST_CONFIG['UPSTREAM_IDLE_TIMEOUT'],
+        'inspection_window': TEST_CONFIG['INSPECTION_WINDOW'],
+        'response_chunk_size': TEST_CONFIG['RESPONSE_CHUNK_SIZE'],
+        'metrics_port': TEST_CONFIG['METRICS_PORT'],
+        'log_buffer_size': TEST_CONFIG['LOG_BUFFER_SIZE'],
+        'max_request_body_size': TEST_CONFIG['MAX_BODY_SIZE'],
         'do_detection': TEST_CONFIG['DO_DETECTION'],
         'do_blocking': TEST_CONFIG['DO_BLOCKING'],
     }
-    proxy = FilteringProxy(**proxy_options)
+    if TEST_CONFIG['PROXY_WORKERS'] > 1:
+        proxy_options['listen_socket'] = prefork.make_listen_socket(
+            TEST_CONFIG['PROXY_ADDRESS'], TEST_CONFIG['PROXY_PORT'])
+
+    if TEST_CONFIG['PROXY_ENGINE'] == 'asyncio':
+        proxy_options['n_workers'] = TEST_CONFIG['ASYNC_N_WORKERS']
+        proxy = AsyncFilteringProxy(**proxy_options)
+    else:
+        proxy = FilteringProxy(**proxy_options)
+
+    if TEST_CONFIG['PROXY_WORKERS'] > 1:
+        # loaded before forking, so all workers share the same models
+        if TEST_CONFIG['DO_DETECTION']:
+            proxy.load_detection_models()
+        prefork.Supervisor(
+            proxy, TEST_CONFIG['PROXY_WORKERS'], TEST_CONFIG['WORKER_STATS_INTERVAL'],
+            max_restarts=TEST_CONFIG['WORKER_MAX_RESTARTS'],
+            restart_window=TEST_CONFIG['WORKER_RESTART_WINDOW']).run()
+        return
 
     while True:
         try:
@@ -158,3 +752,23 @@ def run():
         except KeyboardInterrupt:
             proxy.stop()
             sys.exit()
+
+
+def run_training():
+    """
+    Trains the detection models offline and stores them in the model registry,
+    so the proxy can load them at startup instead of training them.
+    """
+    for ds_url in data_sets.DS_URL_LIST[TEST_CONFIG['DS_URL_SLICE']]:
+        normal_list, _ = data_sets.get(ds_url)
+        if not normal_list:
+            print('{} | no normal requests, skipped'.format(ds_url))
+            continue
+
+        t_start = time.perf_counter()
+        clf, meta = train_model(normal_list)
+        t_end = time.perf_counter()
+
+        version = registry.save(ds_url, clf, meta)
+        print('{} | version {} | {:40s} | trained in {:5.3f} seconds'.format(
+            ds_url, version, meta['key'], t_end - t_start))
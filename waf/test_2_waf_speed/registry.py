@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Nico Epp and Ralf Funk
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Versioned on-disk registry of fitted detection models.
+#
+# Each version of a model is stored in its own directory:
+#   <REGISTRY_PATH>/<ds_url>/<version>/model.pkl     fitted pipeline (joblib)
+#   <REGISTRY_PATH>/<ds_url>/<version>/meta.json     metadata and checksum
+#   <REGISTRY_PATH>/<ds_url>/LATEST                  name of the newest version
+#
+# Versions are written to a temporary directory first and renamed when
+# complete, so a reader never sees a partially written model.
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from sklearn.externals import joblib
+from typing import Dict, List, Tuple
+from ..base import BASE_PATH
+
+
+REGISTRY_PATH = os.path.join(BASE_PATH, 'cache', 'models')
+MODEL_FILE_NAME = 'model.pkl'
+META_FILE_NAME = 'meta.json'
+LATEST_FILE_NAME = 'LATEST'
+
+
+def _checksum(file_path: str) -> str:
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def list_versions(ds_url: str, registry_path=REGISTRY_PATH) -> List[str]:
+    ds_path = os.path.join(registry_path, ds_url)
+    if not os.path.isdir(ds_path):
+        return []
+
+    return sorted(
+        e for e in os.listdir(ds_path)
+        if e.isdigit() and os.path.isdir(os.path.join(ds_path, e)))
+
+
+def get_latest_version(ds_url: str, registry_path=REGISTRY_PATH) -> str:
+    try:
+        with open(os.path.join(registry_path, ds_url, LATEST_FILE_NAME)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        raise KeyError('no model in registry for ds_url "{}"'.format(ds_url))
+
+
+def save(ds_url: str, clf, meta: Dict, registry_path=REGISTRY_PATH) -> str:
+    """
+    Stores a fitted model as a new version and marks it as the latest one.
+    :param ds_url: data set url the model was trained for
+    :param clf: fitted model, usually a pipeline
+    :param meta: dict with additional metadata, must be JSON serializable
+    :return: the new version
+    """
+    ds_path = os.path.join(registry_path, ds_url)
+    os.makedirs(ds_path, exist_ok=True)
+
+    version_list = list_versions(ds_url, registry_path)
+    version = '{:04d}'.format(int(version_list[-1]) + 1 if version_list else 1)
+
+    tmp_path = os.path.join(ds_path, '.tmp_{}_{}'.format(version, os.getpid()))
+    os.makedirs(tmp_path)
+    try:
+        # uncompressed, so the numpy arrays can be memory mapped when loading
+        model_file_path = os.path.join(tmp_path, MODEL_FILE_NAME)
+        joblib.dump(clf, model_file_path)
+
+        meta = dict(meta)
+        meta.update({
+            'ds_url': ds_url,
+            'version': version,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'checksum': _checksum(model_file_path),
+        })
+        with open(os.path.join(tmp_path, META_FILE_NAME), 'w') as f:
+            json.dump(meta, f, indent=2, sort_keys=True)
+
+        os.rename(tmp_path, os.path.join(ds_path, version))
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    # update pointer to the latest version atomically
+    tmp_file_path = os.path.join(ds_path, '.{}_{}'.format(LATEST_FILE_NAME, os.getpid()))
+    with open(tmp_file_path, 'w') as f:
+        f.write(version)
+    os.replace(tmp_file_path, os.path.join(ds_path, LATEST_FILE_NAME))
+
+    return version
+
+
+def load_meta(ds_url: str, version=None, registry_path=REGISTRY_PATH) -> Dict:
+    if version is None:
+        version = get_latest_version(ds_url, registry_path)
+
+    try:
+        with open(os.path.join(registry_path, ds_url, version, META_FILE_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise KeyError('no version "{}" in registry for ds_url "{}"'.format(version, ds_url))
+
+
+def load(ds_url: str, version=None, registry_path=REGISTRY_PATH, verify=True,
+         mmap_mode='c') -> Tuple:
+    """
+    Loads a model from the registry.
+    :param ds_url: data set url the model was trained for
+    :param version: version to load, the latest one by default
+    :param verify: whether to compare the checksum of the model file with its metadata
+    :param mmap_mode: mmap_mode for the numpy arrays of the model, like the support vectors;
+        the default 'c' (copy-on-write) shares the pages between processes and still gives
+        writable arrays, as some compiled sklearn code requires
+    :return: tuple (model, metadata)
+    """
+    meta = load_meta(ds_url, version, registry_path)
+    model_file_path = os.path.join(registry_path, ds_url, meta['version'], MODEL_FILE_NAME)
+
+    if verify and _checksum(model_file_path) != meta['checksum']:
+        raise ValueError('checksum mismatch for ds_url "{}" version "{}"'.format(
+            ds_url, meta['version']))
+
+    clf = joblib.load(model_file_path, mmap_mode=mmap_mode)
+    return clf, meta
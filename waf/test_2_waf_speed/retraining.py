@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Nico Epp and Ralf Funk
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import random
+import threading
+import time
+from typing import Callable, Dict, List
+
+
+class Reservoir:
+    """
+    Thread-safe uniform sample of at most 'size' of all the items added since the last
+    'clear' (reservoir sampling, algorithm R).
+    """
+
+    def __init__(self, size: int, random_state=None):
+        self._size = size
+        self._random = random.Random(random_state)
+        self._lock = threading.Lock()
+        self._item_list = []
+        self._n_seen = 0
+
+    def __len__(self) -> int:
+        return len(self._item_list)
+
+    def add(self, item):
+        with self._lock:
+            self._n_seen += 1
+            if len(self._item_list) < self._size:
+                self._item_list.append(item)
+            else:
+                i = self._random.randrange(self._n_seen)
+                if i < self._size:
+                    self._item_list[i] = item
+
+    def get_list(self) -> List:
+        with self._lock:
+            return list(self._item_list)
+
+    def clear(self):
+        with self._lock:
+            self._item_list = []
+            self._n_seen = 0
+
+
+class RetrainingWorker(threading.Thread):
+    """
+    Background thread that collects the requests judged normal for each endpoint and
+    periodically refits the endpoint models with them, outside of the request threads.
+    :param interval: seconds between retraining rounds
+    :param reservoir_size: maximum number of requests kept per endpoint
+    :param min_samples: minimum number of collected requests to retrain an endpoint model
+    :param fit_func: function(List[Request]) -> (fitted model, metadata)
+    :param swap_func: function(key, model, metadata), called to replace the model of an
+        endpoint and what was fitted with it, like its header filter
+    :param log_func: function(method_name, s, *args), for debug messages
+    """
+
+    def __init__(self, interval: float, reservoir_size: int, min_samples: int,
+                 fit_func: Callable, swap_func: Callable, log_func: Callable):
+        super().__init__(name='RetrainingWorker', daemon=True)
+        self._interval = interval
+        self._reservoir_size = reservoir_size
+        self._min_samples = min_samples
+        self._fit_func = fit_func
+        self._swap_func = swap_func
+        self._log_func = log_func
+        self._reservoirs = {}           # type: Dict[str, Reservoir]
+        self._lock_reservoirs = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def add(self, key: str, req):
+        reservoir = self._reservoirs.get(key)
+        if reservoir is None:
+            with self._lock_reservoirs:
+                reservoir = self._reservoirs.setdefault(key, Reservoir(self._reservoir_size))
+        reservoir.add(req)
+
+    def run(self):
+        while not self._stop_event.wait(self._interval):
+            self.retrain_all()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def retrain_all(self):
+        for key, reservoir in list(self._reservoirs.items()):
+            if len(reservoir) < self._min_samples:
+                continue
+
+            train_list = reservoir.get_list()
+            t_start = time.perf_counter()
+            try:
+                clf, meta = self._fit_func(train_list)
+            except Exception as err:        # a failed retraining must not stop the worker
+                self._log_func('retrain_all', 'could not retrain "{}": {}', key, err)
+                continue
+            t_end = time.perf_counter()
+
+            self._swap_func(key, clf, meta)
+            reservoir.clear()
+            self._log_func('retrain_all', 'retrained "{}" with {} requests in {:5.3f} s',
+                           key, len(train_list), t_end - t_start)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Nico Epp and Ralf Funk
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import re
+from typing import Dict, Iterable, List, Optional
+
+
+# segments replaced by a template when the routes are inferred from the endpoint keys:
+# numbers, long hex strings and UUIDs
+ID_SEGMENT_RE = re.compile(
+    r'^(\d+|[0-9a-f]{16,}|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})$')
+ID_TEMPLATE = '{id}'
+
+
+def split_path(path: str) -> List[str]:
+    """
+    Lowercase segments of a path, without the empty ones: '/A//b/' -> ['a', 'b'].
+    """
+    return [seg for seg in path.lower().split('/') if seg]
+
+
+def infer_pattern(path: str) -> str:
+    """
+    Pattern with a template for every segment that looks like an id:
+    '/item/123/edit' -> '/item/{id}/edit'.
+    """
+    return '/' + '/'.join(
+        ID_TEMPLATE if ID_SEGMENT_RE.match(seg) else seg for seg in split_path(path))
+
+
+class _Node:
+    __slots__ = ('children', 'template', 'wildcard_key', 'key')
+
+    def __init__(self):
+        self.children = {}              # type: Dict[str, _Node]
+        self.template = None            # type: _Node
+        self.wildcard_key = None        # type: str
+        self.key = None                 # type: str
+
+
+class RouteTable:
+    """
+    Maps the method and path of a request to the key of its endpoint model, with a trie of
+    path segments per method.
+
+    A pattern is a path whose segments can also be '{name}', matching any one segment, and
+    a final '*', matching the rest of the path (also nothing). Paths are matched without
+    case, empty segments or trailing slash. Static segments are tried before templates,
+    and templates before wildcards; as every node is visited at most once, a lookup takes
+    O(path segments) in the usual case and at most O(nodes) with many templates.
+    """
+
+    def __init__(self):
+        self._roots = {}        # type: Dict[str, _Node]
+        self.n_routes = 0
+
+    def add(self, method: str, pattern: str, key: str) -> bool:
+        """
+        Returns False if the pattern already had a route, which is kept.
+        """
+        node = self._roots.setdefault(method, _Node())
+        seg_list = split_path(pattern)
+        is_wildcard = bool(seg_list) and seg_list[-1] == '*'
+        if is_wildcard:
+            seg_list = seg_list[:-1]
+
+        for seg in seg_list:
+            if seg.startswith('{') and seg.endswith('}'):
+                if node.template is None:
+                    node.template = _Node()
+                node = node.template
+            else:
+                node = node.children.setdefault(seg, _Node())
+
+        if is_wildcard:
+            if node.wildcard_key is not None:
+                return False
+            node.wildcard_key = key
+        else:
+            if node.key is not None:
+                return False
+            node.key = key
+        self.n_routes += 1
+        return True
+
+    def match(self, method: str, path: str) -> Optional[str]:
+        """
+        Returns the key of the route of the request, None if there is none.
+        """
+        node = self._roots.get(method)
+        if node is None:
+            return None
+
+        seg_list = split_path(path)
+        n = len(seg_list)
+        # depth first, without recursion so that long paths can not exhaust the stack;
+        # the alternatives are pushed from the lowest to the highest priority
+        stack = [(node, 0)]
+        while stack:
+            node, i = stack.pop()
+            if i < 0:
+                return node         # key of a wildcard, pushed below
+
+            if i == n and node.key is not None:
+                return node.key
+            if node.wildcard_key is not None:
+                stack.append((node.wildcard_key, -1))
+            if i < n:
+                if node.template is not None:
+                    stack.append((node.template, i + 1))
+                child = node.children.get(seg_list[i])
+                if child is not None:
+                    stack.append((child, i + 1))
+
+        return None
+
+    @classmethod
+    def from_keys(cls, key_list: Iterable[str], infer_templates=True) -> 'RouteTable':
+        """
+        Route table of endpoint keys like 'GET /item/123', the same as str(data_sets.Request).
+        Every key gets the route of its own path and, with 'infer_templates', the route of
+        its inferred pattern too, if no other key took it before.
+        """
+        table = cls()
+        for key in key_list:
+            method, path = key.split(' ', 1)
+            table.add(method, path, key)
+            if infer_templates:
+                pattern = infer_pattern(path)
+                if pattern != '/' + '/'.join(split_path(path)):
+                    table.add(method, pattern, key)
+        return table
@@ -5,15 +5,35 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import itertools
+import numpy as np
 import pandas as pd
 import pickle
+import random
 import requests
+import threading
 import time
+from typing import List, Tuple
 from .base import TEST_CONFIG
 from .. import data_sets
 
 
-def _get_from_data_server(ds_url: str, req_class: str, req_n: int) -> data_sets.Request:
+# responses of the proxy to blocked requests: 403 by the detection model, the others by the
+# header phase (malformed, unknown endpoint, body too long)
+BLOCKED_STATUS_LIST = (403, 400, 404, 413)
+
+
+def _add_test_headers(req: data_sets.Request, ds_url: str, req_class: str, req_n: int):
+    # for use in the destination process
+    req.headers['x-proxy-test-ds-url'] = ds_url
+    req.headers['x-proxy-test-req-class'] = req_class
+    req.headers['x-proxy-test-req-n'] = str(req_n)
+
+
+def _get_from_data_server(ds_url: str, req_class: str, req_n) -> data_sets.Request:
+    """
+    :param req_n: number of the request, or 'all' for the list of all requests of the class
+    """
     print('{:25s} | ds_url {} | req_class {} | req_n {}'.format(
         '_get_from_data_server', ds_url, req_class, req_n))
 
@@ -40,18 +60,23 @@ def _get_from_data_server(ds_url: str, req_class: str, req_n: int) -> data_sets.
         raise ValueError('status_code {}'.format(resp.status_code))
 
     req = pickle.loads(resp.content)
+    if req_n == 'all':
+        if not isinstance(req, [].__class__):
+            raise ValueError('pickled content is of class {}'.format(req.__class__))
+        for i, r in enumerate(req):
+            _add_test_headers(r, ds_url, req_class, i)
+        return req
+
     if not isinstance(req, data_sets.Request):
         raise ValueError('pickled content is of class {}'.format(req.__class__))
-
-    # for use in the destination process
-    req.headers['x-proxy-test-ds-url'] = ds_url
-    req.headers['x-proxy-test-req-class'] = req_class
-    req.headers['x-proxy-test-req-n'] = str(req_n)
-
+    _add_test_headers(req, ds_url, req_class, req_n)
     return req
 
 
-def _send(req: data_sets.Request, address, port) -> int:
+def _send(req: data_sets.Request, address, port, session=None,
+          verbose=True) -> Tuple[int, str]:
+    # with a session the connection is kept alive between requests, else one is opened each time
+    client = session or requests
     t_start = time.perf_counter()
 
     try:
@@ -63,23 +88,34 @@ def _send(req: data_sets.Request, address, port) -> int:
 
         if req.method == 'GET':
             options['params'] = dict(req.query_params)
-            resp = requests.get(**options)
+            resp = client.get(**options)
         else:
             options['data'] = dict(req.body_params)
-            resp = requests.post(**options)
+            resp = client.post(**options)
     except (requests.ConnectionError, requests.Timeout) as err:
         raise ValueError(err)
 
     t_end = time.perf_counter()
 
-    print('{:25s} | response code {} in {:5.3f} seconds'.format(
-        '_send', resp.status_code, t_end - t_start))
+    if verbose:
+        print('{:25s} | response code {} in {:5.3f} seconds'.format(
+            '_send', resp.status_code, t_end - t_start))
+
+    # detection stage that decided, only sent by the proxy
+    return resp.status_code, resp.headers.get('x-proxy-test-stage', '-')
+
 
-    return resp.status_code
+def _get_result(status_code: int) -> str:
+    if status_code == 200:
+        return 'passed'
+    if status_code in BLOCKED_STATUS_LIST:
+        return 'blocked'
+    raise ValueError('unexpected status_code {}'.format(status_code))
 
 
-def run_once(address, port) -> pd.DataFrame:
+def run_once(address, port, keep_alive=True) -> pd.DataFrame:
     result_list = []
+    session = requests.Session() if keep_alive else None
 
     for ds_url in data_sets.DS_URL_LIST[TEST_CONFIG['DS_URL_SLICE']]:
         for req_class, req_n_range in TEST_CONFIG['REQ_RANGES']:
@@ -88,44 +124,45 @@ def run_once(address, port) -> pd.DataFrame:
                     req = _get_from_data_server(ds_url, req_class, req_n)
 
                     t_start = time.perf_counter()
-                    status_code = _send(req, address, port)
+                    status_code, stage = _send(req, address, port, session)
                     t_end = time.perf_counter()
                     t = t_end - t_start
-
-                    if status_code == 200:
-                        res = 'passed'
-                    elif status_code == 403:
-                        res = 'blocked'
-                    else:
-                        raise ValueError('unexpected status_code {}'.format(status_code))
+                    res = _get_result(status_code)
                 except ValueError as err:
                     t = 0
                     res = 'with errors'
+                    stage = '-'
                     print('{:25s} | {}'.format('run', err))
 
-                result_list.append([ds_url, req_class, req_n, t, res])
+                result_list.append([ds_url, req_class, req_n, t, res, stage])
 
-    return pd.DataFrame(data=result_list, columns=['ds_url', 'req_class', 'req_n', 't', 'res'])
+    if session:
+        session.close()
 
+    return pd.DataFrame(
+        data=result_list, columns=['ds_url', 'req_class', 'req_n', 't', 'res', 'stage'])
 
-def run():
-    print()
-    print('START - no WAF')
-    df1 = run_once(TEST_CONFIG['DESTINATION_ADDRESS'], TEST_CONFIG['DESTINATION_PORT'])
 
-    print()
-    print('START - with WAF')
-    df2 = run_once(TEST_CONFIG['PROXY_ADDRESS'], TEST_CONFIG['PROXY_PORT'])
+def run():
+    label_list = []
+    df_list = []
+    for keep_alive in TEST_CONFIG['CLIENT_KEEP_ALIVE']:
+        for label, address, port in (
+                ('no WAF', TEST_CONFIG['DESTINATION_ADDRESS'], TEST_CONFIG['DESTINATION_PORT']),
+                ('with WAF', TEST_CONFIG['PROXY_ADDRESS'], TEST_CONFIG['PROXY_PORT']),
+        ):
+            label = '{}, {}'.format(label, 'keep-alive' if keep_alive else 'new conn')
+            print()
+            print('START - {}'.format(label))
+            label_list.append(label)
+            df_list.append(run_once(address, port, keep_alive))
 
-    for label, df in zip(
-            ('no WAF', 'with WAF'),
-            (df1, df2),
-    ):
+    for label, df in zip(label_list, df_list):
         print()
-        print('| {:10s} | {:5s} | {:19s} | {:19s} | {:19s} | {:5s} |'.format(
+        print('| {:20s} | {:5s} | {:19s} | {:19s} | {:19s} | {:5s} |'.format(
             'label', 'class', 'passed', 'blocked', 'with errors', 'total'))
         for req_class, sub_df in df.groupby('req_class'):
-            print('| {:10s} | {:5s} | {} | {} | {} | {:5,d} |'.format(
+            print('| {:20s} | {:5s} | {} | {} | {} | {:5,d} |'.format(
                 label,
                 req_class,
                 '{:5,d} - {:5.3f} s/req'.format(
@@ -138,3 +175,139 @@ def run():
                     sub_df.loc[sub_df['res'] == 'with errors', :].shape[0],
                     sub_df.loc[sub_df['res'] == 'with errors', 't'].mean()),
                 sub_df.shape[0]))
+
+    print()
+    print('| {:20s} | {:5s} | {:13s} | {:41s} |'.format(
+        'label', 'stage', 'requests', 'latency ms: p50 / p90 / p99 / max'))
+    for label, df in zip(label_list, df_list):
+        df = df.loc[df['res'] != 'with errors', :]
+        for stage, sub_df in [('all', df)] + list(df.groupby('stage')):
+            t = sub_df['t'].values * 1000
+            print('| {:20s} | {:5s} | {:5,d} {:6.1%} | '
+                  '{:8.3f} / {:8.3f} / {:8.3f} / {:8.3f} |'.format(
+                      label,
+                      stage,
+                      sub_df.shape[0],
+                      sub_df.shape[0] / max(df.shape[0], 1),
+                      *(np.percentile(t, [50, 90, 99, 100]) if t.shape[0] else [np.nan] * 4)))
+
+
+def _get_corpus() -> List[Tuple[str, data_sets.Request]]:
+    """
+    Requests of a load run, fetched from the data server before it starts.
+    Returns a shuffled list of (req_class, request).
+    """
+    corpus = []
+    for ds_url in data_sets.DS_URL_LIST[TEST_CONFIG['DS_URL_SLICE']]:
+        for req_class, _ in TEST_CONFIG['REQ_RANGES']:
+            try:
+                req_list = _get_from_data_server(ds_url, req_class, 'all')
+            except ValueError as err:
+                print('{:25s} | {}'.format('_get_corpus', err))
+                continue
+            corpus.extend(
+                (req_class, req) for req in req_list[:TEST_CONFIG['LOAD_REQ_PER_CLASS']])
+
+    random.Random(0).shuffle(corpus)
+    return corpus
+
+
+def run_load_once(corpus: List[Tuple[str, data_sets.Request]], address, port) -> Tuple:
+    """
+    Sends LOAD_RPS requests per second during LOAD_DURATION seconds from LOAD_CONCURRENCY
+    threads, each with its own session so connections are reused.
+
+    The load is open loop: request i is due i / LOAD_RPS seconds after the start, whether
+    the previous ones were answered or not, and its latency is measured from that time.
+    If the server, or the threads, can not keep up, the time the request should have been
+    waiting is included, instead of being hidden by a load that slows down with the server
+    (coordinated omission).
+    Returns a DataFrame with one row per request and the seconds the run took.
+    """
+    rps = TEST_CONFIG['LOAD_RPS']
+    n_requests = int(rps * TEST_CONFIG['LOAD_DURATION'])
+    counter = itertools.count()     # next() of a count is atomic in CPython
+    result_lists = [[] for _ in range(TEST_CONFIG['LOAD_CONCURRENCY'])]
+
+    def work(result_list):
+        session = requests.Session()
+        try:
+            while True:
+                i = next(counter)
+                if i >= n_requests:
+                    return
+
+                t_due = t_zero + i / rps
+                delay = t_due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+                req_class, req = corpus[i % len(corpus)]
+                t_start = time.perf_counter()
+                try:
+                    status_code, stage = _send(req, address, port, session, verbose=False)
+                    res = _get_result(status_code)
+                except ValueError:
+                    res = 'with errors'
+                    stage = '-'
+                t_end = time.perf_counter()
+                result_list.append(
+                    [req_class, t_end - t_due, t_start - t_due, res, stage])
+        finally:
+            session.close()
+
+    thread_list = [threading.Thread(target=work, args=(result_list, ))
+                   for result_list in result_lists]
+    t_zero = time.perf_counter() + 0.1      # all threads started
+    for t in thread_list:
+        t.start()
+    for t in thread_list:
+        t.join()
+    t_total = time.perf_counter() - t_zero
+
+    df = pd.DataFrame(
+        data=[row for result_list in result_lists for row in result_list],
+        columns=['req_class', 't', 't_late', 'res', 'stage'])
+    return df, t_total
+
+
+def run_load():
+    corpus = _get_corpus()
+    if not corpus:
+        print('{:25s} | no requests to send'.format('run_load'))
+        return
+
+    label_list = []
+    result_list = []
+    for label, address, port in (
+            ('no WAF', TEST_CONFIG['DESTINATION_ADDRESS'], TEST_CONFIG['DESTINATION_PORT']),
+            ('with WAF', TEST_CONFIG['PROXY_ADDRESS'], TEST_CONFIG['PROXY_PORT']),
+    ):
+        print()
+        print('START - {} | {} req/s | {} threads | {} seconds | {:,d} requests in corpus'.format(
+            label, TEST_CONFIG['LOAD_RPS'], TEST_CONFIG['LOAD_CONCURRENCY'],
+            TEST_CONFIG['LOAD_DURATION'], len(corpus)))
+        label_list.append(label)
+        result_list.append(run_load_once(corpus, address, port))
+
+    print()
+    print('| {:8s} | {:5s} | {:8s} | {:7s} | {:7s} | {:17s} | {:6s} | {:52s} |'.format(
+        'label', 'class', 'requests', 'blocked', 'errors', 'req/s target / ok', 'late',
+        'latency ms: p50 / p90 / p99 / p99.9 / max'))
+    for label, (df, t_total) in zip(label_list, result_list):
+        for req_class, sub_df in [('all', df)] + list(df.groupby('req_class')):
+            ok_df = sub_df.loc[sub_df['res'] != 'with errors', :]
+            t = ok_df['t'].values * 1000
+            print('| {:8s} | {:5s} | {:8,d} | {:7,d} | {:7,d} | {:7,.1f} / {:7,.1f} | {:6.1%} | '
+                  '{:8.2f} / {:8.2f} / {:8.2f} / {:8.2f} / {:8.2f} |'.format(
+                      label,
+                      req_class,
+                      sub_df.shape[0],
+                      int((sub_df['res'] == 'blocked').sum()),
+                      sub_df.shape[0] - ok_df.shape[0],
+                      TEST_CONFIG['LOAD_RPS'] * sub_df.shape[0] / max(df.shape[0], 1),
+                      ok_df.shape[0] / t_total,
+                      # started more than 1 ms after it was due: the threads did not keep up
+                      float((sub_df['t_late'] > 0.001).mean()) if sub_df.shape[0] else 0.,
+                      *(np.percentile(t, [50, 90, 99, 99.9, 100]) if t.shape[0]
+                        else [np.nan] * 5)))
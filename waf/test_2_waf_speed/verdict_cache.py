@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Nico Epp and Ralf Funk
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import collections
+import hashlib
+import threading
+import time
+from typing import Dict, Iterable
+
+
+COUNTER_LIST = (
+    'hits',
+    'misses',
+    'expired',      # found, but older than the TTL
+    'stale',        # found, but the model of its endpoint was swapped after it was scored
+    'stored',
+    'evicted',      # least recently used, removed to make room
+)
+
+
+def _query_param_name(s: str) -> str:
+    return s.split('=', 1)[0].strip().lower()
+
+
+def fingerprint(method: str, path: str, query: str, body: bytes, headers: Dict[str, str],
+                headers_to_exclude: Iterable[str] = ()) -> bytes:
+    """
+    Hash of the parts of a request seen by the detection model, computed from the raw parts
+    without building a data_sets.Request. The query parameters are sorted by name, keeping
+    the order of repeated names (the last one is used by data_sets.Request).
+    A cryptographic hash is used so that an attacker can not make an anomalous request with
+    the fingerprint of a normal one.
+    """
+    h = hashlib.sha256()
+    h.update('{} {}\n'.format(method, path).encode())
+    if query:
+        h.update('&'.join(sorted(query.split('&'), key=_query_param_name)).encode())
+    h.update(b'\n')
+    for k, v in sorted(headers.items()):
+        if k not in headers_to_exclude:
+            h.update('{}: {}\n'.format(k, v).encode())
+    h.update(b'\n')
+    if body:
+        h.update(body)
+    return h.digest()
+
+
+class VerdictCache:
+    """
+    Thread-safe LRU cache of the predictions of requests, by endpoint key and fingerprint.
+    Entries expire after 'ttl' seconds, and all entries of an endpoint become stale when
+    'invalidate' is called for it (e.g. after its model is swapped).
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()   # (key, fingerprint) -> (y, t, generation)
+        self._generations = {}                      # type: Dict[str, int]
+        self._counts = dict((name, 0) for name in COUNTER_LIST)
+
+    def generation(self, key: str) -> int:
+        """
+        To be read before the model used to score the request, and given to 'put'.
+        """
+        return self._generations.get(key, 0)
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+
+    def get(self, key: str, fp: bytes):
+        """
+        Returns the prediction of the request, None if not found.
+        """
+        with self._lock:
+            entry = self._entries.get((key, fp))
+            if entry is None:
+                self._counts['misses'] += 1
+                return None
+
+            y, t, generation = entry
+            if generation != self._generations.get(key, 0):
+                name = 'stale'
+            elif time.monotonic() - t > self._ttl:
+                name = 'expired'
+            else:
+                self._entries.move_to_end((key, fp))
+                self._counts['hits'] += 1
+                return y
+
+            del self._entries[(key, fp)]
+            self._counts[name] += 1
+            self._counts['misses'] += 1
+            return None
+
+    def put(self, key: str, fp: bytes, y: int, generation: int):
+        with self._lock:
+            if generation != self._generations.get(key, 0):
+                return          # scored by a model that was swapped meanwhile
+            self._entries[(key, fp)] = (y, time.monotonic(), generation)
+            self._entries.move_to_end((key, fp))
+            self._counts['stored'] += 1
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self._counts['evicted'] += 1
+
+    def get_counts(self) -> Dict[str, int]:
+        with self._lock:
+            counts = dict(self._counts)
+            counts['size'] = len(self._entries)
+        return counts
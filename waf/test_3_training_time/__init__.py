@@ -11,10 +11,25 @@ import pandas as pd
 import seaborn as sns
 import time
 from sklearn.externals import joblib
+from sklearn.model_selection import train_test_split
 from sklearn.pipeline import make_pipeline, make_union
 from sklearn.svm import OneClassSVM
 from ..base import BASE_PATH
-from .. import data_sets, feature_extraction
+from .. import classification, data_sets, feature_extraction
+
+
+RANDOM_STATE = 2
+NU = 0.01
+GAMMA = 0.01
+MAX_EXP = {                 # the exact OneClassSVM is impractical for more samples
+    'svm': 4,
+    'sharded': 5,
+    'sharded_sv': 5,
+    'nystroem': 6,
+    'rff': 6,
+}
+N_LATENCY_SAMPLES = 200
+CHUNK_SIZE = 10**5
 
 
 _file_memory = joblib.Memory(cachedir=os.path.join(BASE_PATH, 'cache'))
@@ -50,6 +65,110 @@ def _build_and_fit(ds_url: str) -> pd.DataFrame:
     return df
 
 
+@_file_memory.cache
+def _compare_detectors(ds_url: str) -> pd.DataFrame:
+    result_list = []
+
+    normal_list, anomalous_list = data_sets.get(ds_url)
+    train_list, test_list = train_test_split(
+        normal_list, random_state=RANDOM_STATE, train_size=0.5)
+
+    # the feature extraction is the same for all detectors, so it is done only once
+    fu = make_union(*[class_() for class_ in feature_extraction.NUMBERS_TF_LIST])
+    X_train_base = fu.fit_transform(train_list)
+    X_test_normal = fu.transform(test_list)
+    X_test_anomalous = fu.transform(anomalous_list)
+
+    # larger training sets repeat the rows of the corpus, so they only measure training time
+    n_corpus = X_train_base.shape[0]
+
+    for detector in classification.DETECTOR_LIST:
+        n_list = [10**i for i in range(1, MAX_EXP[detector] + 1)]
+        if n_corpus <= n_list[-1]:
+            n_list = sorted(set(n_list + [n_corpus]))
+        for n in n_list:
+            print('ds_url {} | detector {:8s} | n {:9,d}'.format(ds_url, detector, n))
+
+            clf = make_pipeline(*classification.make_steps(
+                detector, random_state=0, nu=NU, gamma=GAMMA))
+            t_start = time.perf_counter()
+            if detector not in classification.APPROXIMATE_DETECTOR_LIST:
+                clf.fit(X_train_base[np.arange(n) % n_corpus])
+            else:
+                # the repeated samples are generated in chunks, so they never are all in memory
+                clf = classification.fit_in_chunks(clf, (
+                    X_train_base[np.arange(start, min(start + CHUNK_SIZE, n)) % n_corpus]
+                    for start in range(0, n, CHUNK_SIZE)))
+            t_end = time.perf_counter()
+            fit_duration = (t_end - t_start) * 1000
+
+            # latency for classifying one request at a time, like in the proxy
+            X_latency = X_test_normal[:N_LATENCY_SAMPLES]
+            t_start = time.perf_counter()
+            for x in X_latency:
+                clf.predict(x.reshape(1, -1))
+            t_end = time.perf_counter()
+            latency = (t_end - t_start) * 1000 / X_latency.shape[0]
+
+            if n <= n_corpus:
+                tp = np.sum(clf.predict(X_test_normal) == 1)
+                tn = np.sum(clf.predict(X_test_anomalous) == -1)
+                fn = X_test_normal.shape[0] - tp
+                fp = X_test_anomalous.shape[0] - tn
+                score_list = [
+                    tp / X_test_normal.shape[0],
+                    fp / X_test_anomalous.shape[0],
+                    (2 * tp) / (2 * tp + fp + fn)]
+            else:
+                score_list = [np.nan] * 3
+
+            result_list.append([ds_url, detector, n, n_corpus, fit_duration, latency] + score_list)
+
+    return pd.DataFrame(data=result_list, columns=[
+        'ds_url', 'detector', 'n_samples', 'n_corpus', 'fit_duration', 'latency',
+        'TPR', 'FPR', 'f_score'])
+
+
+def run_detectors() -> pd.DataFrame:
+    df_list = []
+
+    for ds_url in data_sets.DS_URL_LIST:
+        df_list.append(
+            _compare_detectors(ds_url))
+
+    df = pd.concat(df_list, ignore_index=True)      # type: pd.DataFrame
+
+    print()
+    print('exact vs sharded vs approximate detectors (max durations, mean scores of all groups)')
+    print('sizes above the corpus repeat its rows: training time only, no scores (tiled)')
+    print('{:10s} | {:9s} | {:15s} | {:15s} | {:4s} | {:4s} | {:8s} | {:s}'.format(
+        'detector', 'n_samples', 'fit (ms)', 'latency (ms)', 'TPR', 'FPR', 'f1-score', 'data'))
+    n_power_list = [10**i for i in range(1, max(MAX_EXP.values()) + 1)]
+    for (n_samples, detector), sub_df in df[df['n_samples'].isin(n_power_list)].groupby(
+            ['n_samples', 'detector']):
+        # only the groups where the corpus has that many rows
+        scored_df = sub_df[sub_df['n_samples'] <= sub_df['n_corpus']]
+        if scored_df.empty:
+            score_str = '{:4s} | {:4s} | {:8s}'.format('-', '-', '-')
+        else:
+            score_str = '{:4.2f} | {:4.2f} | {:8.2f}'.format(
+                scored_df['TPR'].mean(), scored_df['FPR'].mean(), scored_df['f_score'].mean())
+        print('{:10s} | {:9,d} | {:15.2f} | {:15.4f} | {} | {}'.format(
+            detector, n_samples,
+            sub_df['fit_duration'].max(), sub_df['latency'].max(), score_str,
+            'tiled {}/{}'.format(len(sub_df) - len(scored_df), len(sub_df))
+            if len(scored_df) < len(sub_df) else 'real'))
+
+    print()
+    print('scores with the whole corpus (mean of all groups)')
+    print('{:10s} | {:4s} | {:4s} | {:8s}'.format('detector', 'TPR', 'FPR', 'f1-score'))
+    for detector, sub_df in df[df['n_samples'] == df['n_corpus']].groupby('detector'):
+        print('{:10s} | {:4.2f} | {:4.2f} | {:8.2f}'.format(
+            detector, sub_df['TPR'].mean(), sub_df['FPR'].mean(), sub_df['f_score'].mean()))
+
+    return df
+
+
 def run() -> pd.DataFrame:
     df_list = []
 